@@ -11,6 +11,8 @@ from django.shortcuts import render_to_response
 from django.template import RequestContext
 
 class RevisionAdmin(admin.ModelAdmin):
+    object_history_template = 'admin/rcsfield/object_history.html'
+    revision_log_limit = 50
 
     def get_urls(self):
         from django.conf.urls.defaults import patterns, url
@@ -50,6 +52,18 @@ class RevisionAdmin(admin.ModelAdmin):
         return urlpatterns
 
 
+    def history_view(self, request, object_id, extra_context=None):
+        """adds the revision log of the versioned fields to the history."""
+        try:
+            obj = self.model._default_manager.get(pk=unquote(object_id))
+            revision_log = obj.get_revision_log(limit=self.revision_log_limit)
+        except self.model.DoesNotExist:
+            revision_log = []
+        context = {'revision_log': revision_log}
+        context.update(extra_context or {})
+        return super(RevisionAdmin, self).history_view(request, object_id, extra_context=context)
+
+
     def rev_view(self, request, object_id, revision, extra_context=None):
         """mostly taken from `self.change_view`."""
         model = self.model
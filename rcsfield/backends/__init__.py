@@ -27,3 +27,28 @@ except ImportError, e:
                                         (RCS_BACKEND, ', '.join(map(repr, available_backends))))
         else:
             raise
+
+if getattr(settings, 'RCS_INDEX', False):
+    # keep a persistent index of the revisions of every key
+    from rcsfield.index import IndexedBackend
+    backend = IndexedBackend(backend)
+
+if getattr(settings, 'RCS_CACHE', False):
+    # wrap the backend in a cache for immutable revision contents
+    from rcsfield.cache import CachedBackend
+    backend = CachedBackend(backend)
+
+if getattr(settings, 'RCS_DIFF_STORE', False):
+    # store the diff against the previous revision on every commit
+    from rcsfield.diffstore import DiffStoreBackend
+    backend = DiffStoreBackend(backend)
+
+if getattr(settings, 'RCS_SEARCH', False):
+    # add the content of every commit to a full-text index
+    from rcsfield.search import SearchBackend
+    backend = SearchBackend(backend)
+
+if getattr(settings, 'RCS_METRICS', False):
+    # time and count every call, including cache hits
+    from rcsfield.metrics import InstrumentedBackend
+    backend = InstrumentedBackend(backend)
@@ -10,30 +10,183 @@ Three functions are exported:
   * fetch(key, revision): knows how to fetch a specific revision of the entity
     referenced by ``key``
 
+  * fetch_stream(key, revision): yields the content of a specific revision
+    in chunks, for contents too large to be held in memory.
+
+  * fetch_many(keys, revision): fetches a specific revision of several
+    entities at once. returns a dict mapping each key to its content.
+
   * commit(key, data): knows how to commit changed ``data`` to the entity
-    referenced by ``key``
+    referenced by ``key``. returns the new revision.
+
+  * commit_many(items): commits a list of ``(key, data)`` tuples in as few
+    commits as possible.
+
+  * bulk_import(chunks): commits an iterable of lists of ``(key, data)``
+    tuples, one commit per list. used to versionize existing content.
 
   * initial(): does optional setup needed for the backend to work. called on
     ``post_syncdb`` signal.
 
-  * get_revisions(key): returns a list of revisions in which the entity
-    identifed by ``key`` was changed.
+  * get_revisions(key, limit=None, before=None, after=None): returns a list
+    of revisions in which the entity identifed by ``key`` was changed,
+    at most ``limit`` of them, only older than ``before`` and newer than
+    ``after``.
+
+  * get_revisions_many(keys, limit=None, before=None): returns a list of
+    revisions in which any of the entities identified by ``keys`` was
+    changed, at most ``limit`` of them and only older than ``before``.
+
+  * get_history(key): returns a list of ``(revision, timestamp)`` tuples for
+    all revisions in which ``key`` was changed, including the head revision.
+
+  * get_revision_log(key, limit=None): returns a list of dicts with
+    ``revision``, ``timestamp``, ``author``, ``message`` and ``size`` (of
+    the content of ``key``) for the revisions in which ``key`` was changed,
+    newest first and including the head revision, from a single log query.
 
   * move(key_from, key_to): knows how to move an entity from ``key_from``
     to ``key_to`` while keeping the history. this method is optional.
 
+  * move_many(moves): moves a list of ``(key_from, key_to)`` tuples in as
+    few commits as possible. this method is optional.
+
+  * compact(retention): removes the revisions not selected by the callable
+    ``retention(key, history)`` from the history. this method is optional.
+
+  * repack(): packs the storage of the repository. this method is optional.
+
+  * annotate(key, revision): returns a list of ``(revision, line)`` tuples
+    with the revision in which each line of ``key`` was last changed.
+
   * diff(key1, rev1, key2, rev2): returns a unified diff of the contents
     of ``key1``@``rev1`` against ``key2``@``rev2``.
 
+  * diff_stream(key1, rev1, key2, rev2): like diff, but streams the
+    contents and diffs them with bounded memory.
+
 """
 
-import difflib
+import threading
+
+from django.conf import settings
+
+from rcsfield.diff import diff_revisions, stream_diff, iter_lines, update_annotation
 
 
 class NoSuchRevision(Exception):
     pass
 
 
+
+class HandlePool(object):
+    """
+    Thread-safe pool of reusable repository handles (``Repo`` objects,
+    working trees, clients, ...).
+
+    ``factory`` is called without arguments to create a new handle.
+    ``stamp`` is an optional callable returning a value which changes
+    whenever the repository changes underneath (e.g. the mtime of a file
+    the VCS rewrites on every commit). Handles created before such a
+    change are thrown away instead of being reused.
+
+    The number of idle handles kept is ``settings.RCS_POOL_SIZE``
+    (default 4), set it to 0 to disable pooling.
+
+    Usage::
+
+        handle = pool.acquire()
+        try:
+            ...
+        finally:
+            pool.release(handle)
+
+    """
+
+    def __init__(self, factory, stamp=None, size=None):
+        if size is None:
+            size = getattr(settings, 'RCS_POOL_SIZE', 4)
+        self.factory = factory
+        self.stamp = stamp
+        self.size = size
+        self._idle = [] # (handle, stamp) tuples
+        self._stamps = {} # id(handle) -> stamp, for handles in use
+        self._lock = threading.Lock()
+
+    def _current_stamp(self):
+        if self.stamp is None:
+            return None
+        try:
+            return self.stamp()
+        except (IOError, OSError):
+            return None
+
+    def acquire(self):
+        """
+        returns an idle handle which is still valid or a new one.
+
+        """
+        current = self._current_stamp()
+        self._lock.acquire()
+        try:
+            while self._idle:
+                handle, stamp = self._idle.pop()
+                if stamp == current:
+                    self._stamps[id(handle)] = stamp
+                    return handle
+        finally:
+            self._lock.release()
+        handle = self.factory()
+        self._lock.acquire()
+        try:
+            self._stamps[id(handle)] = current
+        finally:
+            self._lock.release()
+        return handle
+
+    def release(self, handle, changed=False):
+        """
+        puts ``handle`` back into the pool. pass ``changed=True`` if the
+        handle was used to change the repository, so that it stays valid.
+
+        """
+        if changed:
+            stamp = self._current_stamp()
+        else:
+            stamp = None
+        self._lock.acquire()
+        try:
+            old_stamp = self._stamps.pop(id(handle), None)
+            if not changed:
+                stamp = old_stamp
+            if len(self._idle) < self.size:
+                self._idle.append((handle, stamp))
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """
+        throws away all idle handles.
+
+        """
+        self._lock.acquire()
+        try:
+            self._idle = []
+        finally:
+            self._lock.release()
+
+
+def log_entry(revision, timestamp, author=None, message=None, size=None):
+    """
+    returns an entry of the list returned by ``get_revision_log``. Values
+    a backend can not tell cheaply are ``None``.
+
+    """
+    return {'revision': revision, 'timestamp': timestamp, 'author': author,
+            'message': message, 'size': size}
+
+
+
 class BaseBackend(object):
     """
     Base-class for all rcsfield backends.
@@ -52,11 +205,43 @@ class BaseBackend(object):
     def commit(self, key, data):
         """
         versionize a change of ``key`` with new ``data``.
+        returns the new revision.
 
         """
         raise NotImplementedError
 
 
+    def commit_many(self, items):
+        """
+        versionize changes of several keys. ``items`` is a list of
+        ``(key, data)`` tuples. returns the last new revision.
+
+        This default implementation makes one commit per key, backends
+        should override it to commit all keys at once.
+
+        """
+        rev = None
+        for key, data in items:
+            rev = self.commit(key, data)
+        return rev
+
+
+    def bulk_import(self, chunks):
+        """
+        versionizes large amounts of content. ``chunks`` is an iterable of
+        lists of ``(key, data)`` tuples, every list is committed as one
+        revision. returns a list of ``(keys, revision)`` tuples.
+
+        This default implementation calls ``commit_many`` for every chunk.
+
+        """
+        result = []
+        for chunk in chunks:
+            if chunk:
+                result.append(([key for key, data in chunk], self.commit_many(chunk)))
+        return result
+
+
     def fetch(self, key, rev):
         """
         fetched the data of ``key`` for revision ``rev``.
@@ -65,35 +250,192 @@ class BaseBackend(object):
         raise NotImplementedError
 
 
-    def get_revisions(self, key):
+    def fetch_stream(self, key, rev):
+        """
+        yields the data of ``key`` for revision ``rev`` in chunks.
+
+        This default implementation fetches the whole content at once,
+        backends should override it to read the content incrementally.
+
+        """
+        data = self.fetch(key, rev)
+        if data:
+            yield data
+
+
+    def fetch_many(self, keys, rev):
+        """
+        fetches the data of all ``keys`` for revision ``rev`` and returns
+        a dict mapping each key to its content. Keys which could not be
+        fetched are left out of the result.
+
+        This default implementation simply calls ``fetch`` for every key,
+        backends should override it to resolve the revision only once.
+
+        """
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self.fetch(key, rev)
+            except:
+                pass
+        return result
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
+        """
+        return a list of all revisions in which ``key`` changed, newest
+        first and without the head revision. With ``limit`` at most that
+        many revisions are returned, ``before`` and ``after`` only return
+        revisions older or newer than the given revision (for paging
+        through long histories, the head revision is not cut of when
+        ``before`` is given).
+
+        """
+        raise NotImplementedError
+
+
+    def get_revisions_many(self, keys, limit=None, before=None):
         """
-        return a list of all revisions in which ``key`` changed
+        return a list of all revisions in which any of ``keys`` changed,
+        newest first and without the head revision (like ``get_revisions``).
+        ``limit`` and ``before`` work like for ``get_revisions``.
+
+        This default implementation merges the ``get_history`` of every key,
+        ``before`` has to be one of the revisions returned.
+
+        """
+        timestamps = {}
+        for key in keys:
+            for rev, timestamp in self.get_history(key):
+                timestamps[rev] = timestamp
+        revs = [(timestamp, rev) for rev, timestamp in timestamps.items()]
+        revs.sort(reverse=True)
+        revs = [rev for timestamp, rev in revs]
+        if before is None:
+            revs = revs[1:] # cut of the head revision
+        elif before in revs:
+            revs = revs[revs.index(before) + 1:]
+        else:
+            revs = []
+        if limit:
+            revs = revs[:limit]
+        return revs
+
+
+    def get_history(self, key):
+        """
+        return a list of ``(revision, timestamp)`` tuples for all revisions
+        in which ``key`` changed, newest first and including the head
+        revision. ``timestamp`` is a ``datetime``.
 
         """
         raise NotImplementedError
 
 
+    def get_revision_log(self, key, limit=None):
+        """
+        return a list of ``log_entry`` dicts for the revisions in which
+        ``key`` changed, newest first and including the head revision.
+
+        This default implementation only knows revision and timestamp from
+        ``get_history``.
+
+        """
+        history = self.get_history(key)
+        if limit:
+            history = history[:limit]
+        return [log_entry(rev, timestamp) for rev, timestamp in history]
+
+
     def move(self, key_from, key_to):
         """
         Moves an entity from ``key_from`` to ``key_to`` while keeping
         the history. This is useful to migrate a repository after the
         ``rcskey_format`` of a ``RcsTextField`` was changed.
+        returns the new revision or ``False`` if the move failed.
 
         """
         raise NotImplementedError
 
 
+    def move_many(self, moves):
+        """
+        Moves several entities, ``moves`` is a list of ``(key_from, key_to)``
+        tuples. Moves whose ``key_from`` does not exist (e.g. because it
+        was already moved) or whose ``key_to`` already exists are skipped.
+        returns the last new revision or ``None`` if nothing was moved.
+
+        This default implementation calls ``move`` for every tuple, backends
+        should override it to move all keys in a single commit.
+
+        """
+        rev = None
+        for key_from, key_to in moves:
+            rev = self.move(key_from, key_to) or rev
+        return rev
+
+
+    def compact(self, retention):
+        """
+        Thins out the history. ``retention`` is called with every key and
+        its ``get_history`` and returns the revisions of the key to keep,
+        the newest revision of every key is always kept. Returns a dict
+        with the number of ``revisions_before`` and ``revisions_after``.
+        Revision identifiers may change for backends which have to rewrite
+        their history.
+
+        """
+        raise NotImplementedError
+
+
+    def repack(self):
+        """
+        Packs the storage of the repository, e.g. after ``compact``.
+
+        """
+        pass
+
+
     def diff(self, key1, rev1, key2, rev2):
         """
         Returns a textual unified diff of two entities at specified revisions.
         Takes two parameters for keyname to support diffing renamed files.
+        Uses the diff engine from ``rcsfield.diff``, diffs between two fixed
+        revisions are cached.
+
+        """
+        return diff_revisions(self.fetch, key1, rev1, key2, rev2)
+
+
+    def diff_stream(self, key1, rev1, key2, rev2):
+        """
+        Like ``diff``, but for very large contents: both contents are read
+        twice with ``fetch_stream`` and diffed by
+        ``rcsfield.diff.stream_diff``, so neither is held in memory. These
+        diffs are not cached.
+
+        """
+        return stream_diff(lambda: iter_lines(self.fetch_stream(key1, rev1)),
+                           lambda: iter_lines(self.fetch_stream(key2, rev2)),
+                           'Revision: %s' % rev1, 'Revision: %s' % rev2)
+
+
+    def annotate(self, key, rev):
+        """
+        returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of ``key`` at ``rev`` was last changed.
+
+        This default implementation replays the history of ``key``,
+        backends should override it with the annotate command of their
+        revision control system.
 
         """
-        c1 = self.fetch(key1, rev1)
-        c2 = self.fetch(key2, rev2)
-        diff = difflib.unified_diff(c1.splitlines(1),
-                                    c2.splitlines(1),
-                                    'Revision: %s' % rev1,
-                                    'Revision: %s' % rev2
-                                    )
-        return diff
+        if rev == 'head':
+            revs = [r for r, t in self.get_history(key)]
+        else:
+            revs = [rev] + self.get_revisions(key, before=rev)
+        annotation = []
+        for r in reversed(revs):
+            annotation = update_annotation(annotation, self.fetch(key, r), r)
+        return annotation
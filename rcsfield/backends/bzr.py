@@ -4,12 +4,12 @@ Bazaar backend for django-rcsfield.
 Uses bzrlib http://bazaar-vcs.org to versionize content.
 """
 
-import os, codecs
+import os, codecs, datetime
 from django.conf import settings
 from bzrlib import bzrdir, workingtree, revisiontree, tree, workingtree_4, dirstate
 from bzrlib.errors import NoSuchRevision as BzrNoSuchRevision
 from bzrlib.errors import FileExists
-from rcsfield.backends.base import BaseBackend
+from rcsfield.backends.base import BaseBackend, HandlePool, NoSuchRevision, log_entry
 
 
 
@@ -21,6 +21,23 @@ class BzrBackend(BaseBackend):
 
     def __init__(self, wc_path):
         self.wc_path = os.path.normpath(wc_path)
+        self.pool = HandlePool(lambda: workingtree.WorkingTree.open(self.wc_path),
+                               stamp=self._stamp)
+
+
+    def _stamp(self):
+        """
+        changes whenever the branch or the working tree was changed, so
+        pooled working trees are not reused after that.
+
+        """
+        fobj = open(os.path.join(self.wc_path, '.bzr', 'branch', 'last-revision'))
+        try:
+            last_revision = fobj.read()
+        finally:
+            fobj.close()
+        st = os.stat(os.path.join(self.wc_path, '.bzr', 'checkout', 'dirstate'))
+        return (last_revision, st.st_mtime, st.st_size)
 
 
     def initial(self, prefix):
@@ -45,32 +62,98 @@ class BzrBackend(BaseBackend):
             wt.commit(message="adding initial directory for %s" % prefix)
 
 
+    def _revision_tree(self, wt, rev):
+        """
+        returns the tree of revision ``rev``, the working tree for
+        ``'head'``. Raises ``NoSuchRevision`` for revisions which do not
+        exist (yet), answering them with the head content would get that
+        cached for a revision number which is committed later.
+
+        """
+        if rev == 'head':
+            return wt
+        try:
+            return wt.branch.repository.revision_tree(wt.branch.get_rev_id(int(rev)))
+        except (BzrNoSuchRevision, ValueError):
+            raise NoSuchRevision(rev)
+
+
     def fetch(self, key, rev):
         """
         fetch revision ``rev`` of entity identified by ``key``.
 
         """
-        wt = workingtree.WorkingTree.open(self.wc_path)
+        wt = self.pool.acquire()
         try:
-            rt = wt.branch.repository.revision_tree(wt.branch.get_rev_id(int(rev)))
-        except BzrNoSuchRevision:
-            #if the revision does not exist, we take the head
-            #FIXME: is this a good choice??
-            rt = wt
-        rt.lock_read()
+            rt = self._revision_tree(wt, rev)
+            rt.lock_read()
+            try:
+                try:
+                    # key is the file-path relative to the repository-root
+                    file_path = key
+                    olddata = rt.get_file(rt.path2id(file_path)).read()
+                except:
+                    #raise
+                    #FIXME: may raise bzrlib.errors, for now just ignore them
+                    olddata = ''
+            finally:
+                # needed to leave the tree in a usable state.
+                rt.unlock()
+            return olddata
+        finally:
+            self.pool.release(wt)
+
+
+    def fetch_stream(self, key, rev):
+        """
+        yields revision ``rev`` of entity identified by ``key`` in chunks
+        read from the file object of the revision tree.
+
+        """
+        wt = self.pool.acquire()
         try:
+            rt = self._revision_tree(wt, rev)
+            rt.lock_read()
             try:
-                # key is the file-path relative to the repository-root
-                file_path = key
-                olddata = rt.get_file(rt.path2id(file_path)).read()
-            except:
-                #raise
-                #FIXME: may raise bzrlib.errors, for now just ignore them
-                olddata = ''
+                file_id = rt.path2id(key)
+                if file_id is None:
+                    return
+                fobj = rt.get_file(file_id)
+                while True:
+                    chunk = fobj.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                rt.unlock()
+        finally:
+            self.pool.release(wt)
+
+
+    def fetch_many(self, keys, rev):
+        """
+        fetch revision ``rev`` of all entities identified by ``keys``.
+        The working tree is opened and the revision tree is resolved only
+        once for all keys.
+
+        """
+        wt = self.pool.acquire()
+        try:
+            rt = self._revision_tree(wt, rev)
+            result = {}
+            rt.lock_read()
+            try:
+                for key in keys:
+                    try:
+                        result[key] = rt.get_file(rt.path2id(key)).read()
+                    except:
+                        #FIXME: may raise bzrlib.errors, for now just ignore them
+                        result[key] = ''
+            finally:
+                rt.unlock()
+            return result
         finally:
-            # needed to leave the tree in a usable state.
-            rt.unlock()
-        return olddata
+            self.pool.release(wt)
 
 
     def commit(self, key, data):
@@ -87,21 +170,174 @@ class BzrBackend(BaseBackend):
             return self.commit(key, data)
         fobj.write(data)
         fobj.close()
-        wt = workingtree.WorkingTree.open(self.wc_path)
+        wt = self.pool.acquire()
         try:
-            wt.add([key,])
-        except:
-            raise
-        wt.commit(message='auto commit from django')
+            try:
+                wt.add([key,])
+            except:
+                raise
+            wt.commit(message='auto commit from django')
+            return wt.branch.revno()
+        finally:
+            self.pool.release(wt, changed=True)
 
 
-    def get_revisions(self, key):
+    def commit_many(self, items):
+        """
+        commit changed data of several entities in a single commit.
+        ``items`` is a list of ``(key, data)`` tuples.
+
+        """
+        keys = []
+        for key, data in items:
+            if not os.path.exists(os.path.dirname(os.path.join(self.wc_path, key))):
+                self.initial(os.path.dirname(key))
+            fobj = open(os.path.join(self.wc_path, key), 'w')
+            fobj.write(data)
+            fobj.close()
+            keys.append(key)
+        if not keys:
+            return None
+        wt = self.pool.acquire()
+        try:
+            wt.add(keys)
+            wt.commit(message='auto commit from django')
+            return wt.branch.revno()
+        finally:
+            self.pool.release(wt, changed=True)
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
         """
         returns a list with all revisions at which ``key`` was changed.
-        Revision Numbers are integers starting at 1.
+        Revision Numbers are integers starting at 1. The revision graph is
+        only walked as far as needed for ``limit`` and ``after``.
+
+        """
+        if before is not None:
+            start = int(before) - 1
+        else:
+            start = None
+        if limit:
+            limit += before is None
+        wt = self.pool.acquire()
+        try:
+            wt.lock_read()
+            try:
+                crevs = [revno for revno, rev_id in self._walk_changes(wt, key, start, after, limit)]
+            finally:
+                wt.unlock()
+        finally:
+            self.pool.release(wt)
+        if before is None:
+            crevs = crevs[1:] #cut of the HEAD revision-number
+        return crevs
+
+
+    def get_revision_log(self, key, limit=None):
+        """
+        returns the log of ``key`` with author, message and the size of
+        ``key`` in every revision, walking the revision graph only as far
+        as ``limit``.
+
+        """
+        wt = self.pool.acquire()
+        try:
+            log = []
+            wt.lock_read()
+            try:
+                file_id = wt.path2id(key)
+                repository = wt.branch.repository
+                for revno, rev_id in self._walk_changes(wt, key, limit=limit):
+                    rev = repository.get_revision(rev_id)
+                    inventory = repository.revision_tree(rev_id).inventory
+                    size = None
+                    if inventory.has_id(file_id):
+                        size = inventory[file_id].text_size
+                    log.append(log_entry(revno, datetime.datetime.fromtimestamp(rev.timestamp),
+                                         rev.committer, rev.message, size))
+            finally:
+                wt.unlock()
+            return log
+        finally:
+            self.pool.release(wt)
+
+
+    def _walk_changes(self, wt, key, start=None, stop=None, limit=None):
+        """
+        yields ``(revno, rev_id)`` tuples of the mainline revisions at which
+        ``key`` was changed, newest first, beginning at revno ``start``
+        (default: the branch tip) and ending at revno ``stop`` (exclusive)
+        or after ``limit`` revisions.
+
+        Every file in a revision tree records the revision which last
+        modified it, so this jumps from change to change instead of
+        looking at every revision of the branch.
+
+        """
+        file_id = wt.path2id(key)
+        if file_id is None:
+            return
+        branch = wt.branch
+        repository = branch.repository
+        if start is None:
+            rev_id = branch.last_revision()
+        elif start < 1:
+            return
+        else:
+            rev_id = branch.get_rev_id(start)
+        found = 0
+        while rev_id and rev_id != 'null:':
+            inventory = repository.revision_tree(rev_id).inventory
+            if not inventory.has_id(file_id):
+                return
+            changed_in = inventory[file_id].revision
+            try:
+                revno = branch.revision_id_to_revno(changed_in)
+            except:
+                # changed on a merged branch, report the mainline revision
+                changed_in = rev_id
+                revno = branch.revision_id_to_revno(rev_id)
+            if stop is not None and revno <= int(stop):
+                return
+            yield revno, changed_in
+            found += 1
+            if limit and found >= limit:
+                return
+            parents = repository.get_revision(changed_in).parent_ids
+            if not parents:
+                return
+            rev_id = parents[0]
+
+
+    def get_history(self, key):
+        """
+        returns a list of ``(revision, timestamp)`` tuples for all revisions
+        at which ``key`` was changed, newest first and including the head
+        revision.
+
+        """
+        wt = self.pool.acquire()
+        try:
+            history = []
+            wt.lock_read()
+            try:
+                for revno, rev_id in self._changed_in(wt, key):
+                    rev = wt.branch.repository.get_revision(rev_id)
+                    history.append((revno, datetime.datetime.fromtimestamp(rev.timestamp)))
+            finally:
+                wt.unlock()
+            return history
+        finally:
+            self.pool.release(wt)
+
+
+    def _changed_in(self, wt, key):
+        """
+        returns a list of ``(revno, rev_id)`` tuples for all revisions at
+        which ``key`` was changed, newest first.
 
         """
-        wt = workingtree.WorkingTree.open(self.wc_path)
         file_id = wt.path2id(key)
         revisions = wt.branch.repository.all_revision_ids() # bzr ids
 
@@ -123,11 +359,50 @@ class BzrBackend(BaseBackend):
         crevs = [] #`key` changed in these revisions
         for rev_id in changed_in:
             try:
-                crevs.append(wt.branch.revision_id_to_revno(rev_id))
+                crevs.append((wt.branch.revision_id_to_revno(rev_id), rev_id))
             except:
                 pass
         crevs.sort(reverse=True)
-        return crevs[1:] #cut of the HEAD revision-number
+        return crevs
+
+
+    def annotate(self, key, rev):
+        """
+        returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of ``key`` at ``rev`` was last changed, from bzr's
+        annotate.
+
+        """
+        wt = self.pool.acquire()
+        try:
+            branch = wt.branch
+            branch.lock_read()
+            try:
+                try:
+                    rt = branch.repository.revision_tree(branch.get_rev_id(int(rev)))
+                except (BzrNoSuchRevision, ValueError):
+                    rt = wt.basis_tree()
+                rt.lock_read()
+                try:
+                    file_id = rt.path2id(key)
+                    if file_id is None:
+                        return []
+                    lines = list(rt.annotate_iter(file_id))
+                finally:
+                    rt.unlock()
+                revnos = {}
+                result = []
+                for revision_id, line in lines:
+                    if revision_id not in revnos:
+                        revnos[revision_id] = branch.revision_id_to_revno(revision_id)
+                    if line.endswith('\n'):
+                        line = line[:-1]
+                    result.append((revnos[revision_id], line))
+                return result
+            finally:
+                branch.unlock()
+        finally:
+            self.pool.release(wt)
 
 
     def move(self, key_from, key_to):
@@ -137,13 +412,61 @@ class BzrBackend(BaseBackend):
         ``rcskey_format`` of a ``RcsTextField`` was changed.
 
         """
-        wt = workingtree.WorkingTree.open(self.wc_path)
+        wt = self.pool.acquire()
+        try:
+            try:
+                wt.rename_one(key_from, key_to)
+                wt.commit(message="Moved %s to %s" % (key_from, key_to))
+                return wt.branch.revno()
+            except:
+                return False
+        finally:
+            self.pool.release(wt, changed=True)
+
+
+    def repack(self):
+        """
+        packs the repository. bzr history can not be rewritten in place, so
+        there is no ``compact``.
+
+        """
+        wt = self.pool.acquire()
+        try:
+            wt.branch.repository.pack()
+        finally:
+            self.pool.release(wt)
+
+
+    def move_many(self, moves):
+        """
+        Moves several entities in a single commit. ``moves`` is a list of
+        ``(key_from, key_to)`` tuples, unversioned sources and existing
+        targets are skipped.
+
+        """
+        wt = self.pool.acquire()
         try:
-            wt.rename_one(key_from, key_to)
-            wt.commit(message="Moved %s to %s" % (key_from, key_to))
-            return True
-        except:
-            return False
+            moved = 0
+            wt.lock_tree_write()
+            try:
+                for key_from, key_to in moves:
+                    if wt.path2id(key_from) is None or wt.path2id(key_to) is not None:
+                        continue
+                    parent = os.path.dirname(key_to)
+                    if parent and wt.path2id(parent) is None:
+                        if not os.path.exists(os.path.join(self.wc_path, parent)):
+                            os.makedirs(os.path.join(self.wc_path, parent))
+                        wt.smart_add([os.path.join(self.wc_path, parent)], recurse=False)
+                    wt.rename_one(key_from, key_to)
+                    moved += 1
+            finally:
+                wt.unlock()
+            if not moved:
+                return None
+            wt.commit(message="Moved %d entities" % moved)
+            return wt.branch.revno()
+        finally:
+            self.pool.release(wt, changed=True)
 
 
 
@@ -151,10 +474,21 @@ class BzrBackend(BaseBackend):
 rcs = BzrBackend(settings.BZR_WC_PATH)
 
 fetch = rcs.fetch
+fetch_many = rcs.fetch_many
+fetch_stream = rcs.fetch_stream
 commit = rcs.commit
+commit_many = rcs.commit_many
+bulk_import = rcs.bulk_import
 initial = rcs.initial
 get_revisions = rcs.get_revisions
+get_revisions_many = rcs.get_revisions_many
+get_history = rcs.get_history
+get_revision_log = rcs.get_revision_log
 move = rcs.move
+move_many = rcs.move_many
+repack = rcs.repack
 diff = rcs.diff
+diff_stream = rcs.diff_stream
+annotate = rcs.annotate
 
-__all__ = ('fetch', 'commit', 'initial', 'get_revisions', 'move', 'diff')
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'move', 'move_many', 'repack', 'diff', 'diff_stream', 'annotate')
@@ -0,0 +1,105 @@
+"""
+Persistent ``git cat-file --batch`` reader used by the git backends.
+
+Starting git (or walking trees in Python) for every single read is slow.
+``CatFileBatch`` keeps one ``git cat-file --batch`` process per worker
+process and streams object requests like ``rev:path`` through it. The
+process is restarted automatically if it died or the worker forked.
+
+``stream_blob`` reads a single large blob in chunks instead.
+"""
+
+import os, threading, subprocess
+
+
+class CatFileBatch(object):
+    """
+    Reads objects from the repository at ``git_dir`` through a long-lived
+    ``git cat-file --batch`` process.
+
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._proc = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._proc = subprocess.Popen(['git', '--git-dir=%s' % self.git_dir,
+                                       'cat-file', '--batch'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._pid = os.getpid()
+
+    def _running(self):
+        return self._proc is not None and self._pid == os.getpid() \
+               and self._proc.poll() is None
+
+    def _request(self, spec):
+        self._proc.stdin.write(spec + '\n')
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline()
+        if not header:
+            raise IOError("git cat-file --batch exited")
+        bits = header.split()
+        if len(bits) != 3:
+            # "<spec> missing" or "<spec> ambiguous"
+            return None
+        sha, type, size = bits
+        data = self._proc.stdout.read(int(size))
+        if len(data) != int(size):
+            raise IOError("git cat-file --batch exited")
+        self._proc.stdout.read(1) # trailing newline
+        return sha, type, data
+
+    def get(self, spec):
+        """
+        returns ``(sha, type, data)`` for the object named by ``spec``
+        (e.g. ``<rev>:<path>``) or ``None`` if it does not exist.
+
+        """
+        if '\n' in spec:
+            return None
+        self._lock.acquire()
+        try:
+            if not self._running():
+                self._start()
+            try:
+                return self._request(spec)
+            except (IOError, OSError, ValueError):
+                # the process died underneath us, try once more
+                self.close()
+                self._start()
+                return self._request(spec)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._proc is not None and self._pid == os.getpid():
+            try:
+                self._proc.stdin.close()
+                self._proc.wait()
+            except (IOError, OSError):
+                pass
+        self._proc = None
+
+
+
+def stream_blob(git_dir, spec, chunk_size=65536):
+    """
+    yields the content of the blob named by ``spec`` in chunks of
+    ``chunk_size`` bytes, read from a ``git cat-file blob`` process of its
+    own. Yields nothing if the blob does not exist.
+
+    """
+    proc = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'cat-file', 'blob', spec],
+                            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        proc.stdout.close()
+        proc.wait()
@@ -0,0 +1,372 @@
+"""
+Database backend for django-rcsfield.
+
+Stores all revisions in the ``Changeset`` and ``RevisionContent`` tables
+of the default database, so no repository on the local filesystem is
+needed and every web node can read the history from the shared database.
+
+The head revision of every key is stored in full. Older revisions are
+stored as reverse deltas against the next newer revision of the key,
+except every ``settings.RCS_DB_SNAPSHOT_INTERVAL``-th revision (default
+10) which is kept as a full snapshot. Reconstructing any revision
+therefore applies at most that many deltas.
+
+Revisions are integers starting at 1, one per commit.
+"""
+
+import difflib, datetime
+from django.conf import settings
+from django.db import transaction
+from django.utils import simplejson as json
+
+from rcsfield.backends.base import BaseBackend, log_entry
+
+
+
+def make_delta(source, target):
+    """
+    returns a delta which turns ``source`` into ``target``, both unicode.
+    The delta is a json list of ``[start, end]`` line ranges to copy from
+    ``source`` and strings to insert.
+
+    """
+    a = source.splitlines(True)
+    b = target.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(u''.join(b[j1:j2]))
+    return json.dumps(ops)
+
+
+def apply_delta(source, delta):
+    """
+    applies ``delta`` as created by ``make_delta`` to ``source``.
+
+    """
+    a = source.splitlines(True)
+    out = []
+    for op in json.loads(delta):
+        if isinstance(op, list):
+            out.extend(a[op[0]:op[1]])
+        else:
+            out.append(op)
+    return u''.join(out)
+
+
+def atomic(func, *args):
+    """
+    calls ``func`` with ``args`` in its own transaction, or in a savepoint
+    if a transaction is managed already, so either all or none of its
+    writes are kept.
+
+    """
+    if not transaction.is_managed():
+        return transaction.commit_on_success(func)(*args)
+    if not hasattr(transaction, 'savepoint'):
+        return func(*args) # no savepoints, the caller's transaction has to do
+    sid = transaction.savepoint()
+    try:
+        result = func(*args)
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+    return result
+
+
+
+class DbBackend(BaseBackend):
+    """
+    Rcsfield backend which stores revisions in django model tables.
+
+    """
+
+    def __init__(self, snapshot_interval=10):
+        self.snapshot_interval = snapshot_interval
+
+
+    def initial(self, prefix):
+        """
+        The tables are created by syncdb, nothing else to set up.
+
+        """
+        pass
+
+
+    def _content(self, row):
+        """
+        reconstructs the full content of ``row``.
+
+        """
+        from rcsfield.models import RevisionContent
+        if row.kind == RevisionContent.FULL:
+            return row.data
+        base = RevisionContent.objects.filter(key=row.key, sequence__gt=row.sequence,
+                                              kind=RevisionContent.FULL).order_by('sequence')[0]
+        content = base.data
+        deltas = RevisionContent.objects.filter(key=row.key,
+                                                sequence__gte=row.sequence,
+                                                sequence__lt=base.sequence).order_by('-sequence')
+        for delta in deltas:
+            content = apply_delta(content, delta.data)
+        return content
+
+
+    def fetch(self, key, rev):
+        """
+        fetch revision ``rev`` of entity identified by ``key``.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = RevisionContent.objects.filter(key=key)
+        if rev != 'head':
+            rows = rows.filter(changeset__id__lte=int(rev))
+        try:
+            row = rows.order_by('-sequence')[0]
+        except IndexError:
+            return ''
+        return self._content(row).encode('utf-8')
+
+
+    def commit(self, key, data):
+        """
+        commit changed ``data`` to the entity identified by ``key``.
+
+        """
+        return self.commit_many([(key, data)])
+
+
+    def commit_many(self, items, message='auto commit from django'):
+        """
+        commit changed data of several entities in a single revision.
+        ``items`` is a list of ``(key, data)`` tuples. Either all of them
+        are committed or none.
+
+        """
+        if not items:
+            return None
+        return atomic(self._commit_many, items, message)
+
+
+    def _commit_many(self, items, message):
+        from rcsfield.models import Changeset, RevisionContent
+        changeset = Changeset.objects.create(timestamp=datetime.datetime.now(),
+                                             message=message)
+        for key, data in items:
+            content = data.decode('utf-8')
+            try:
+                head = RevisionContent.objects.filter(key=key).order_by('-sequence')[0]
+            except IndexError:
+                head = None
+            if head is None:
+                sequence = 1
+            else:
+                sequence = head.sequence + 1
+            # the new head is stored before the old one is turned into a delta
+            # against it, so the old content is never lost
+            RevisionContent.objects.create(key=key, changeset=changeset, sequence=sequence,
+                                           kind=RevisionContent.FULL, data=content)
+            if head is not None and head.sequence % self.snapshot_interval != 0:
+                # the old head becomes a reverse delta against the new one
+                head.data = make_delta(content, head.data)
+                head.kind = RevisionContent.DELTA
+                head.save()
+        return changeset.pk
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
+        """
+        returns a list with all revisions at which ``key`` was changed.
+        Revision Numbers are integers starting at 1.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = RevisionContent.objects.filter(key=key)
+        if before is not None:
+            rows = rows.filter(changeset__lt=int(before))
+        if after is not None:
+            rows = rows.filter(changeset__gt=int(after))
+        crevs = rows.values_list('changeset', flat=True)
+        if limit:
+            crevs = crevs[:limit + (before is None)]
+        crevs = list(crevs)
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+
+    def get_revisions_many(self, keys, limit=None, before=None):
+        """
+        returns a list with all revisions at which any of ``keys`` was
+        changed.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = RevisionContent.objects.filter(key__in=keys)
+        if before is not None:
+            rows = rows.filter(changeset__lt=int(before))
+        crevs = rows.order_by('-changeset').values_list('changeset', flat=True).distinct()
+        if limit:
+            crevs = crevs[:limit + (before is None)]
+        crevs = list(crevs)
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+
+    def get_history(self, key):
+        """
+        returns a list of ``(revision, timestamp)`` tuples for all revisions
+        at which ``key`` was changed, newest first and including the head
+        revision.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = RevisionContent.objects.filter(key=key).select_related('changeset')
+        return [(row.changeset_id, row.changeset.timestamp) for row in rows]
+
+
+    def get_revision_log(self, key, limit=None):
+        """
+        returns the log of ``key`` with the message of every revision from
+        one query. Sizes are only known for revisions stored in full, there
+        are no authors.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = RevisionContent.objects.filter(key=key).select_related('changeset')
+        if limit:
+            rows = rows[:limit]
+        log = []
+        for row in rows:
+            size = None
+            if row.kind == RevisionContent.FULL:
+                size = len(row.data.encode('utf-8'))
+            log.append(log_entry(row.changeset_id, row.changeset.timestamp,
+                                 message=row.changeset.message, size=size))
+        return log
+
+
+    def compact(self, retention):
+        """
+        deletes the revisions of every key not selected by ``retention``
+        and stores the remaining ones again as reverse deltas. Revision
+        numbers stay the same, fetching a deleted revision returns the
+        next older kept one. Every key is rewritten atomically.
+
+        """
+        from rcsfield.models import Changeset, RevisionContent
+        before = after = 0
+        keys = RevisionContent.objects.values_list('key', flat=True).order_by('key').distinct()
+        for key in list(keys):
+            counts = atomic(self._compact_key, key, retention)
+            before += counts[0]
+            after += counts[1]
+        Changeset.objects.filter(revisioncontent__isnull=True).delete()
+        return {'revisions_before': before, 'revisions_after': after}
+
+
+    def _compact_key(self, key, retention):
+        """
+        rewrites the rows of ``key``, returns the number of revisions
+        before and after.
+
+        """
+        from rcsfield.models import RevisionContent
+        rows = list(RevisionContent.objects.filter(key=key).select_related('changeset'))
+        if not rows:
+            return 0, 0
+        kept = dict.fromkeys(retention(key, [(row.changeset_id, row.changeset.timestamp)
+                                             for row in rows]))
+        kept[rows[0].changeset_id] = None
+        if len(kept) == len(rows):
+            return len(rows), len(rows)
+        # reconstruct every revision walking down from the head
+        contents = []
+        content = None
+        for row in rows:
+            if row.kind == RevisionContent.FULL:
+                content = row.data
+            else:
+                content = apply_delta(content, row.data)
+            if row.changeset_id in kept:
+                contents.append((row.changeset_id, content))
+        contents.reverse()
+        RevisionContent.objects.filter(key=key).delete()
+        for position, (changeset, content) in enumerate(contents):
+            sequence = position + 1
+            if sequence == len(contents) or sequence % self.snapshot_interval == 0:
+                kind, data = RevisionContent.FULL, content
+            else:
+                kind, data = RevisionContent.DELTA, make_delta(contents[position + 1][1], content)
+            RevisionContent.objects.create(key=key, changeset_id=changeset, sequence=sequence,
+                                           kind=kind, data=data)
+        return len(rows), len(contents)
+
+
+    def move(self, key_from, key_to):
+        """
+        Moves an entity from ``key_from`` to ``key_to`` while keeping
+        the history. The move is recorded as a new revision of ``key_to``.
+
+        """
+        from rcsfield.models import RevisionContent
+        if not RevisionContent.objects.filter(key=key_from).count() or \
+           RevisionContent.objects.filter(key=key_to).count():
+            return False
+        RevisionContent.objects.filter(key=key_from).update(key=key_to)
+        return self.commit_many([(key_to, self.fetch(key_to, 'head'))],
+                                message="Moved %s to %s" % (key_from, key_to))
+
+
+    def move_many(self, moves):
+        """
+        Moves several entities in a single revision. ``moves`` is a list of
+        ``(key_from, key_to)`` tuples, missing sources and existing
+        targets are skipped.
+
+        """
+        from rcsfield.models import RevisionContent
+        sources = dict(moves)
+        existing = set(RevisionContent.objects.filter(key__in=sources.keys() + sources.values())
+                                              .values_list('key', flat=True).distinct())
+        moved = []
+        for key_from, key_to in moves:
+            if key_from not in existing or key_to in existing:
+                continue
+            RevisionContent.objects.filter(key=key_from).update(key=key_to)
+            existing.discard(key_from)
+            existing.add(key_to)
+            moved.append(key_to)
+        if not moved:
+            return None
+        contents = self.fetch_many(moved, 'head')
+        return self.commit_many([(key, contents[key]) for key in moved],
+                                message="Moved %d entities" % len(moved))
+
+
+
+rcs = DbBackend(getattr(settings, 'RCS_DB_SNAPSHOT_INTERVAL', 10))
+
+fetch = rcs.fetch
+fetch_many = rcs.fetch_many
+fetch_stream = rcs.fetch_stream
+commit = rcs.commit
+commit_many = rcs.commit_many
+bulk_import = rcs.bulk_import
+initial = rcs.initial
+get_revisions = rcs.get_revisions
+get_revisions_many = rcs.get_revisions_many
+get_history = rcs.get_history
+get_revision_log = rcs.get_revision_log
+move = rcs.move
+move_many = rcs.move_many
+compact = rcs.compact
+diff = rcs.diff
+diff_stream = rcs.diff_stream
+annotate = rcs.annotate
+
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'move', 'move_many', 'compact', 'diff', 'diff_stream', 'annotate')
@@ -19,9 +19,18 @@ def ignore(*args, **kwargs):
 
 
 fetch = complain
+fetch_many = complain
+fetch_stream = complain
 commit = complain
+commit_many = complain
+bulk_import = complain
 initial = complain
 get_revisions = complain
+get_revisions_many = complain
+get_history = complain
+get_revision_log = complain
 diff = complain
+diff_stream = complain
+annotate = complain
 
-__all__ = ('fetch', 'commit', 'initial', 'get_revisions', 'diff')
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'diff', 'diff_stream', 'annotate')
@@ -0,0 +1,73 @@
+"""
+``git fast-import`` writer used by the git backends for bulk imports.
+
+Committing thousands of keys through the porcelain (or one loose object
+at a time) is slow. ``fast_import`` streams chunks of ``(key, data)``
+tuples into a single ``git fast-import`` process, which writes one commit
+per chunk straight into a pack file and moves the ref once at the end.
+"""
+
+import os, time, tempfile, subprocess
+
+
+class FastImportError(Exception):
+    pass
+
+
+
+def _data(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return 'data %d\n%s\n' % (len(data), data)
+
+
+def fast_import(git_dir, ref, chunks, author, message='auto commit from django'):
+    """
+    imports ``chunks``, an iterable of lists of ``(key, data)`` tuples,
+    into ``ref`` of the repository at ``git_dir``, one commit per chunk on
+    top of the current tip of ``ref``.
+
+    returns a list of ``(keys, sha)`` tuples, one per non-empty chunk.
+
+    """
+    parent = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'rev-parse', '--verify', '-q', ref],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    fd, marks = tempfile.mkstemp(prefix='rcsfield-marks-')
+    os.close(fd)
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'fast-import', '--quiet',
+                             '--export-marks=%s' % marks],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errors)
+    imported = []
+    try:
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                mark = len(imported) + 1
+                out = ['commit %s\n' % ref,
+                       'mark :%d\n' % mark,
+                       'committer %s %d +0000\n' % (author, int(time.time())),
+                       _data(message)]
+                if mark == 1 and parent:
+                    out.append('from %s\n' % parent)
+                for key, data in chunk:
+                    out.append('M 100644 inline %s\n' % key)
+                    out.append(_data(data))
+                out.append('\n')
+                proc.stdin.write(''.join(out))
+                imported.append(([key for key, data in chunk], mark))
+            proc.stdin.close()
+        except IOError:
+            pass # fast-import died, reported below
+        if proc.wait() != 0:
+            errors.seek(0)
+            raise FastImportError(errors.read())
+        shas = {}
+        for line in open(marks):
+            mark, sha = line.split()
+            shas[int(mark[1:])] = sha
+    finally:
+        os.unlink(marks)
+        errors.close()
+    return [(keys, shas[mark]) for keys, mark in imported]
@@ -0,0 +1,444 @@
+"""
+Bare Git backend for django-rcsfield.
+
+Stores content directly in the object database of a bare git repository.
+Blobs, trees and commits are written as loose objects and a single ref is
+updated, no working copy is ever checked out. Paths are resolved and
+content is read through a persistent ``git cat-file --batch`` process,
+revision lists come from ``git log --first-parent``.
+
+Settings::
+
+    GIT_BARE_REPO_PATH = '/path/to/repo.git'
+    GIT_BARE_REF = 'refs/heads/master'                  # optional
+    GIT_BARE_AUTHOR = 'django-rcsfield <rcsfield@localhost>'  # optional
+"""
+
+import os, time, datetime, threading
+from django.conf import settings
+
+from rcsfield.backends.base import BaseBackend, log_entry
+from rcsfield.backends.fastimport import fast_import
+from rcsfield.backends.gitobjects import ObjectStore, RefChanged, RefLocked, TREE_MODE, rewrite_history
+
+
+# how often a commit is retried when the ref was moved or is locked by
+# another process, 10ms apart
+COMMIT_RETRIES = 500
+
+
+class GitBareBackend(BaseBackend):
+    """
+    Rcsfield backend which writes directly to the object database of a
+    bare git repository.
+
+    """
+
+    def __init__(self, repo_path, ref='refs/heads/master',
+                 author='django-rcsfield <rcsfield@localhost>'):
+        self.repo_path = os.path.normpath(repo_path)
+        self.ref = ref
+        self.author = author
+        self.store = ObjectStore(self.repo_path)
+        self._lock = threading.Lock()
+
+
+    def initial(self, prefix):
+        """
+        Set up the bare git repo at ``settings.GIT_BARE_REPO_PATH``.
+        Directories only exist as trees in git, so ``prefix`` needs no setup.
+
+        """
+        if not os.path.exists(os.path.join(self.repo_path, 'objects')):
+            if not os.path.exists(self.repo_path):
+                os.makedirs(self.repo_path)
+            self.store.git(['init', '--bare'])
+
+
+    def _resolve(self, rev):
+        if rev in ('head', 'HEAD'):
+            return self.store.resolve_ref(self.ref)
+        if len(rev) == 40:
+            return rev
+        return self.store.resolve_ref('refs/heads/%s' % rev) or \
+               self.store.resolve_ref('refs/tags/%s' % rev)
+
+
+    def _entry(self, tree, key, trees=None):
+        """
+        returns the ``(mode, sha)`` of ``key`` in ``tree`` or ``None``.
+        ``trees`` is a dict caching parsed trees by sha, trees are
+        immutable so it can be kept for the length of a call.
+
+        """
+        entry = None
+        for bit in key.split('/'):
+            if tree is None:
+                return None
+            if trees is None:
+                entries = self.store.read_tree(tree)
+            else:
+                entries = trees.get(tree)
+                if entries is None:
+                    entries = trees[tree] = self.store.read_tree(tree)
+            entry = entries.get(bit)
+            if entry is None:
+                return None
+            tree = entry[0] == TREE_MODE and entry[1] or None
+        return entry
+
+
+    def fetch(self, key, rev):
+        """
+        fetch revision ``rev`` of entity identified by ``key``.
+
+        """
+        try:
+            commit = self._resolve(rev)
+            obj = commit and self.store.read_path(commit, key)
+        except:
+            return ''
+        if not obj or obj[0] != 'blob':
+            return ''
+        return obj[1]
+
+
+    def fetch_stream(self, key, rev):
+        """
+        yields revision ``rev`` of entity identified by ``key`` in chunks.
+
+        """
+        try:
+            commit = self._resolve(rev)
+            entry = self._entry(self.store.read_commit(commit)['tree'], key)
+        except:
+            entry = None
+        if entry is None:
+            return iter([])
+        return self.store.stream(entry[1])
+
+
+    def fetch_many(self, keys, rev):
+        """
+        fetch revision ``rev`` of all entities identified by ``keys``.
+        The commit is resolved only once, the paths by the persistent
+        ``git cat-file`` process.
+
+        """
+        try:
+            commit = self._resolve(rev)
+        except:
+            commit = None
+        result = {}
+        for key in keys:
+            try:
+                obj = commit and self.store.read_path(commit, key)
+            except:
+                obj = None
+            if obj and obj[0] == 'blob':
+                result[key] = obj[1]
+            else:
+                result[key] = ''
+        return result
+
+
+    def _commit_changes(self, changes, message):
+        """
+        writes a commit applying ``changes`` on top of the ref and moves the
+        ref to it. retries if the ref was changed or locked concurrently, up
+        to ``COMMIT_RETRIES`` times.
+
+        """
+        self._lock.acquire()
+        try:
+            for attempt in range(COMMIT_RETRIES):
+                parent = self.store.resolve_ref(self.ref)
+                if parent:
+                    tree = self.store.read_commit(parent)['tree']
+                else:
+                    tree = None
+                new_tree = self.store.update_tree(tree, changes)
+                if new_tree is None:
+                    new_tree = self.store.write_tree({})
+                if new_tree == tree:
+                    return None # nothing changed
+                lines = ['tree %s' % new_tree]
+                if parent:
+                    lines.append('parent %s' % parent)
+                stamp = '%s %d +0000' % (self.author, int(time.time()))
+                lines.append('author %s' % stamp)
+                lines.append('committer %s' % stamp)
+                sha = self.store.write('commit', '\n'.join(lines) + '\n\n' + message + '\n')
+                locked = None
+                try:
+                    self.store.update_ref(self.ref, sha, parent)
+                    return sha
+                except RefChanged:
+                    time.sleep(0.01)
+                except RefLocked, e:
+                    locked = e
+                    time.sleep(0.01)
+            if locked is not None:
+                raise RefLocked("%s still exists after %d attempts, remove it if no other "
+                                "process is writing to the repository" % (locked, COMMIT_RETRIES))
+            raise RefChanged("%s kept changing, gave up after %d attempts" % (self.ref, COMMIT_RETRIES))
+        finally:
+            self._lock.release()
+
+
+    def commit(self, key, data):
+        """
+        commit changed ``data`` to the entity identified by ``key``.
+
+        """
+        return self.commit_many([(key, data)])
+
+
+    def commit_many(self, items):
+        """
+        commit changed data of several entities in a single commit.
+        ``items`` is a list of ``(key, data)`` tuples.
+
+        """
+        if not os.path.exists(os.path.join(self.repo_path, 'objects')):
+            self.initial('')
+        changes = {}
+        for key, data in items:
+            changes[key] = self.store.write('blob', data)
+        if not changes:
+            return None
+        return self._commit_changes(changes, 'auto commit from django')
+
+
+    def bulk_import(self, chunks):
+        """
+        imports ``chunks`` of ``(key, data)`` tuples with ``git fast-import``,
+        one commit per chunk.
+
+        """
+        if not os.path.exists(os.path.join(self.repo_path, 'objects')):
+            self.initial('')
+        self._lock.acquire()
+        try:
+            return fast_import(self.repo_path, self.ref, chunks, self.author)
+        finally:
+            self._lock.release()
+
+
+    def _changed_in(self, key, start=None, stop=None, limit=None):
+        """
+        returns a list of ``(sha, time)`` tuples of the commits on the
+        first-parent history of the ref in which ``key`` changed, newest
+        first, from ``git log``. The log begins at commit ``start``
+        (default: the ref) and ends before commit ``stop`` or after
+        ``limit`` changes were found.
+
+        """
+        return self._changed_in_any([key], start, stop, limit)
+
+
+    def _changed_in_any(self, keys, start=None, stop=None, limit=None):
+        """
+        like ``_changed_in`` for the commits in which any of ``keys``
+        changed.
+
+        """
+        if start is None:
+            sha = self.store.resolve_ref(self.ref)
+        else:
+            sha = self._resolve(start)
+        if stop is not None:
+            stop = self._resolve(stop)
+        if not sha or sha == stop:
+            return []
+        args = ['--literal-pathspecs', 'log', '--first-parent', '--format=%H %ct']
+        if limit:
+            args.append('-n%d' % limit)
+        if stop:
+            args.append('%s..%s' % (stop, sha))
+        else:
+            args.append(sha)
+        try:
+            output = self.store.git(args + ['--'] + list(keys))
+        except IOError:
+            return []
+        changed = []
+        for line in output.splitlines():
+            sha, t = line.split()
+            changed.append((sha, int(t)))
+        return changed
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
+        """
+        returns a list with all revisions at which ``key`` was changed.
+        Revisions are Git hashes, listed by ``git log`` which stops as soon
+        as ``limit`` revisions or ``after`` is reached.
+
+        """
+        start = None
+        if before is not None:
+            parents = self.store.read_commit(self._resolve(before))['parents']
+            if not parents:
+                return []
+            start = parents[0]
+        if limit:
+            limit += before is None
+        crevs = [sha for sha, t in self._changed_in(key, start, after, limit)]
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+
+    def get_revisions_many(self, keys, limit=None, before=None):
+        """
+        returns a list with all revisions at which any of ``keys`` was
+        changed, from a single ``git log`` over all paths which stops after
+        ``limit`` revisions.
+
+        """
+        start = None
+        if before is not None:
+            parents = self.store.read_commit(self._resolve(before))['parents']
+            if not parents:
+                return []
+            start = parents[0]
+        if limit:
+            limit += before is None
+        crevs = [sha for sha, t in self._changed_in_any(keys, start, None, limit)]
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+
+    def get_history(self, key):
+        """
+        returns a list of ``(revision, timestamp)`` tuples for all revisions
+        at which ``key`` was changed, newest first and including the head
+        revision.
+
+        """
+        return [(sha, datetime.datetime.fromtimestamp(t))
+                for sha, t in self._changed_in(key)]
+
+
+    def get_revision_log(self, key, limit=None):
+        """
+        returns the log of ``key`` with author, message and the size of
+        ``key`` in every revision.
+
+        """
+        log = []
+        trees = {}
+        for sha, t in self._changed_in(key, limit=limit):
+            commit = self.store.read_commit(sha)
+            entry = self._entry(commit['tree'], key, trees)
+            size = None
+            if entry is not None:
+                size = len(self.store.read(entry[1])[1])
+            log.append(log_entry(sha, datetime.datetime.fromtimestamp(t),
+                                 commit['author'].decode('utf-8'),
+                                 commit['message'].decode('utf-8'), size))
+        return log
+
+
+    def annotate(self, key, rev):
+        """
+        returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of ``key`` at ``rev`` was last changed, from
+        ``git blame``.
+
+        """
+        commit = self._resolve(rev)
+        if commit is None:
+            return []
+        return self.store.blame(commit, key)
+
+
+    def move(self, key_from, key_to):
+        """
+        Moves an entity from ``key_from`` to ``key_to`` in a single commit.
+
+        """
+        try:
+            head = self.store.resolve_ref(self.ref)
+            entry = self._entry(self.store.read_commit(head)['tree'], key_from)
+            if entry is None:
+                return False
+            return self._commit_changes({key_from: None, key_to: entry[1]},
+                                        "Moved %s to %s" % (key_from, key_to))
+        except:
+            return False
+
+
+    def compact(self, retention):
+        """
+        rewrites the history of the ref keeping only the changes selected
+        by ``retention``. All commit shas change.
+
+        """
+        self._lock.acquire()
+        try:
+            before, after = rewrite_history(self.store, self.ref, retention)
+        finally:
+            self._lock.release()
+        return {'revisions_before': before, 'revisions_after': after}
+
+
+    def repack(self):
+        """
+        drops the objects of rewritten history and packs all loose objects.
+
+        """
+        self.store.git(['reflog', 'expire', '--expire=now', '--all'])
+        self.store.git(['gc', '--prune=now', '--quiet'])
+
+
+    def move_many(self, moves):
+        """
+        Moves several entities in a single commit. ``moves`` is a list of
+        ``(key_from, key_to)`` tuples, missing sources and existing
+        targets are skipped.
+
+        """
+        head = self.store.resolve_ref(self.ref)
+        if not head:
+            return None
+        tree = self.store.read_commit(head)['tree']
+        changes = {}
+        for key_from, key_to in moves:
+            entry = self._entry(tree, key_from)
+            if entry is None or self._entry(tree, key_to) is not None:
+                continue
+            changes[key_from] = None
+            changes[key_to] = entry[1]
+        if not changes:
+            return None
+        return self._commit_changes(changes, "Moved %d entities" % (len(changes) // 2))
+
+
+
+rcs = GitBareBackend(settings.GIT_BARE_REPO_PATH,
+                     getattr(settings, 'GIT_BARE_REF', 'refs/heads/master'),
+                     getattr(settings, 'GIT_BARE_AUTHOR', 'django-rcsfield <rcsfield@localhost>'))
+
+fetch = rcs.fetch
+fetch_many = rcs.fetch_many
+fetch_stream = rcs.fetch_stream
+commit = rcs.commit
+commit_many = rcs.commit_many
+bulk_import = rcs.bulk_import
+initial = rcs.initial
+get_revisions = rcs.get_revisions
+get_revisions_many = rcs.get_revisions_many
+get_history = rcs.get_history
+get_revision_log = rcs.get_revision_log
+move = rcs.move
+move_many = rcs.move_many
+compact = rcs.compact
+repack = rcs.repack
+diff = rcs.diff
+diff_stream = rcs.diff_stream
+annotate = rcs.annotate
+
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'move', 'move_many', 'compact', 'repack', 'diff', 'diff_stream', 'annotate')
@@ -4,12 +4,15 @@ Git backend for django-rcsfield.
 Uses Git to versionize content.
 """
 
-import os
+import os, time, datetime, subprocess
 from git import Git, Repo
 from git.errors import InvalidGitRepositoryError, NoSuchPathError, GitCommandError
 from django.conf import settings
 
-from rcsfield.backends.base import BaseBackend
+from rcsfield.backends.base import BaseBackend, HandlePool, log_entry
+from rcsfield.backends.catfile import CatFileBatch, stream_blob
+from rcsfield.backends.fastimport import fast_import
+from rcsfield.backends.gitobjects import ObjectStore, rewrite_history
 
 
 class GitBackend(BaseBackend):
@@ -20,6 +23,8 @@ class GitBackend(BaseBackend):
 
     def __init__(self, repo_path):
         self.repo_path = os.path.normpath(repo_path)
+        self.pool = HandlePool(lambda: Repo(self.repo_path))
+        self.catfile = CatFileBatch(os.path.join(self.repo_path, '.git'))
 
 
     def initial(self, prefix):
@@ -42,19 +47,55 @@ class GitBackend(BaseBackend):
         if not os.path.exists(field_path):
             os.makedirs(field_path)
 
+    def _rev(self, rev):
+        if rev == 'head':
+            return 'HEAD'
+        return str(rev)
+
     def fetch(self, key, rev):
         """
         fetch revision ``rev`` of entity identified by ``key``.
 
         """
-        repo = Repo(self.repo_path)
         try:
-            tree = repo.tree(rev)
-            for bit in key.split('/'):
-                tree = tree/bit
-            return tree.data
+            obj = self.catfile.get('%s:%s' % (self._rev(rev), key))
         except:
             return ''
+        if obj is None or obj[1] != 'blob':
+            return ''
+        return obj[2]
+
+    def fetch_stream(self, key, rev):
+        """
+        yields revision ``rev`` of entity identified by ``key`` in chunks
+        read from ``git cat-file``.
+
+        """
+        return stream_blob(os.path.join(self.repo_path, '.git'), '%s:%s' % (self._rev(rev), key))
+
+    def fetch_many(self, keys, rev):
+        """
+        fetch revision ``rev`` of all entities identified by ``keys``.
+        The tree of ``rev`` is resolved only once.
+
+        """
+        try:
+            root = self.catfile.get('%s^{tree}' % self._rev(rev))
+        except:
+            root = None
+        if root is None:
+            return dict([(key, '') for key in keys])
+        result = {}
+        for key in keys:
+            try:
+                obj = self.catfile.get('%s:%s' % (root[0], key))
+            except:
+                obj = None
+            if obj is None or obj[1] != 'blob':
+                result[key] = ''
+            else:
+                result[key] = obj[2]
+        return result
 
     def commit(self, key, data):
         """
@@ -70,23 +111,182 @@ class GitBackend(BaseBackend):
             return self.commit(key, data)
         fobj.write(data)
         fobj.close()
-        repo = Repo(self.repo_path)
+        repo = self.pool.acquire()
         try:
             repo.git.add(os.path.join(self.repo_path, key))
-        except:
-            raise
-        repo.git.commit(message='auto commit from django')
+            repo.git.commit(message='auto commit from django')
+            return repo.git.rev_parse('HEAD')
+        finally:
+            self.pool.release(repo, changed=True)
 
 
-    def get_revisions(self, key):
+    def commit_many(self, items):
+        """
+        commit changed data of several entities in a single commit.
+        ``items`` is a list of ``(key, data)`` tuples.
+
+        """
+        paths = []
+        for key, data in items:
+            path = os.path.join(self.repo_path, key)
+            if not os.path.exists(os.path.dirname(path)):
+                self.initial(os.path.dirname(path))
+            fobj = open(path, 'w')
+            fobj.write(data)
+            fobj.close()
+            paths.append(path)
+        if not paths:
+            return None
+        repo = self.pool.acquire()
+        try:
+            repo.git.add(*paths)
+            repo.git.commit(message='auto commit from django')
+            return repo.git.rev_parse('HEAD')
+        finally:
+            self.pool.release(repo, changed=True)
+
+
+    def bulk_import(self, chunks):
+        """
+        imports ``chunks`` of ``(key, data)`` tuples with ``git fast-import``,
+        one commit per chunk, and updates the working copy afterwards.
+
+        """
+        repo = self.pool.acquire()
+        try:
+            ref = repo.git.symbolic_ref('HEAD')
+            # the same identity ``git commit`` uses, without the timestamp
+            author = repo.git.var('GIT_COMMITTER_IDENT').rsplit(' ', 2)[0]
+            result = fast_import(os.path.join(self.repo_path, '.git'), ref, chunks, author)
+            if result:
+                repo.git.read_tree('-m', '-u', 'HEAD')
+            return result
+        finally:
+            self.pool.release(repo, changed=True)
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
         """
         returns a list with all revisions at which ``key`` was changed.
-        Revisions are Git hashes.
+        Revisions are Git hashes. ``limit``, ``before`` and ``after`` are
+        passed on to ``git log``.
+
+        """
+        args = ['--format=%H']
+        if limit:
+            args.append('-n%d' % (limit + (before is None)))
+        if before is None:
+            tip = 'HEAD'
+        else:
+            tip = '%s^' % before
+        if after is not None:
+            tip = '%s..%s' % (after, tip)
+        repo = self.pool.acquire()
+        try:
+            try:
+                crevs = repo.git.log(*(args + [tip, '--', key])).split()
+            except GitCommandError:
+                crevs = [] # e.g. ``before`` is the root commit
+        finally:
+            self.pool.release(repo)
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+    def get_revisions_many(self, keys, limit=None, before=None):
+        """
+        returns a list with all revisions at which any of ``keys`` was
+        changed, from a single ``git log`` over all paths.
+
+        """
+        args = ['--format=%H']
+        if limit:
+            args.append('-n%d' % (limit + (before is None)))
+        if before is None:
+            tip = 'HEAD'
+        else:
+            tip = '%s^' % before
+        repo = self.pool.acquire()
+        try:
+            try:
+                crevs = repo.git.log(*(args + [tip, '--'] + list(keys))).split()
+            except GitCommandError:
+                crevs = []
+        finally:
+            self.pool.release(repo)
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
 
+    def get_history(self, key):
         """
-        repo = Repo(self.repo_path)
-        crevs = [r.id for r in repo.log(path=key)]
-        return crevs[1:] # cut of the head revision-number
+        returns a list of ``(revision, timestamp)`` tuples for all revisions
+        at which ``key`` was changed, newest first and including the head
+        revision.
+
+        """
+        repo = self.pool.acquire()
+        try:
+            return [(c.id, datetime.datetime.fromtimestamp(time.mktime(c.committed_date)))
+                    for c in repo.log(path=key)]
+        finally:
+            self.pool.release(repo)
+
+    def get_revision_log(self, key, limit=None):
+        """
+        returns the log of ``key`` with author, message and the size of
+        ``key`` in every revision, from one ``git log`` and one
+        ``git cat-file --batch-check`` call.
+
+        """
+        args = ['--format=%x01%H%x00%ct%x00%an <%ae>%x00%s', '--raw', '--no-abbrev']
+        if limit:
+            args.append('-n%d' % limit)
+        repo = self.pool.acquire()
+        try:
+            try:
+                output = repo.git.log(*(args + ['HEAD', '--', key]))
+            except GitCommandError:
+                return []
+        finally:
+            self.pool.release(repo)
+        log = []
+        blobs = []
+        for record in output.split('\x01')[1:]:
+            sha, timestamp, author, rest = record.split('\x00', 3)
+            lines = rest.split('\n')
+            # ``--raw`` lines look like ":100644 100644 <old> <new> M\tpath"
+            raw = [l for l in lines if l.startswith(':')]
+            message = '\n'.join([l for l in lines if not l.startswith(':')]).strip()
+            blob = raw and raw[-1].split()[3] or None
+            log.append(log_entry(sha, datetime.datetime.fromtimestamp(int(timestamp)),
+                                 author.decode('utf-8'), message.decode('utf-8')))
+            blobs.append(blob)
+        wanted = [b for b in blobs if b and b.strip('0')]
+        if wanted:
+            proc = subprocess.Popen(['git', '--git-dir=%s' % os.path.join(self.repo_path, '.git'),
+                                     'cat-file', '--batch-check'],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            sizes = {}
+            for line in proc.communicate('\n'.join(wanted) + '\n')[0].splitlines():
+                bits = line.split()
+                if len(bits) == 3:
+                    sizes[bits[0]] = int(bits[2])
+            for entry, blob in zip(log, blobs):
+                entry['size'] = sizes.get(blob)
+        return log
+
+
+    def annotate(self, key, rev):
+        """
+        returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of ``key`` at ``rev`` was last changed, from
+        ``git blame``.
+
+        """
+        store = ObjectStore(os.path.join(self.repo_path, '.git'))
+        return store.blame(self._rev(rev), key)
+
 
     def move(self, key_from, key_to):
         """
@@ -95,23 +295,97 @@ class GitBackend(BaseBackend):
         ``rcskey_format`` of a ``RcsTextField`` was changed.
 
         """
-        repo = Repo(self.repo_path)
+        repo = self.pool.acquire()
         try:
-            repo.git.mv(key_from, key_to)
-            repo.git.commit(message="Moved %s to %s" % (key_from, key_to))
-            return True
-        except:
-            return False
+            try:
+                repo.git.mv(key_from, key_to)
+                repo.git.commit(message="Moved %s to %s" % (key_from, key_to))
+                return repo.git.rev_parse('HEAD')
+            except:
+                return False
+        finally:
+            self.pool.release(repo, changed=True)
+
+
+    def compact(self, retention):
+        """
+        rewrites the history of the current branch keeping only the changes
+        selected by ``retention``. All commit shas change, the working copy
+        stays the same.
+
+        """
+        repo = self.pool.acquire()
+        try:
+            ref = repo.git.symbolic_ref('HEAD')
+            store = ObjectStore(os.path.join(self.repo_path, '.git'))
+            before, after = rewrite_history(store, ref, retention)
+            return {'revisions_before': before, 'revisions_after': after}
+        finally:
+            self.pool.release(repo, changed=True)
+
+
+    def repack(self):
+        """
+        drops the objects of rewritten history and packs all loose objects.
+
+        """
+        repo = self.pool.acquire()
+        try:
+            repo.git.reflog('expire', '--expire=now', '--all')
+            repo.git.gc('--prune=now', '--quiet')
+        finally:
+            self.pool.release(repo)
+
+
+    def move_many(self, moves):
+        """
+        Moves several entities in a single commit. ``moves`` is a list of
+        ``(key_from, key_to)`` tuples, missing sources and existing
+        targets are skipped.
+
+        """
+        paths = []
+        for key_from, key_to in moves:
+            path_from = os.path.join(self.repo_path, key_from)
+            path_to = os.path.join(self.repo_path, key_to)
+            if not os.path.exists(path_from) or os.path.exists(path_to):
+                continue
+            if not os.path.exists(os.path.dirname(path_to)):
+                os.makedirs(os.path.dirname(path_to))
+            os.rename(path_from, path_to)
+            paths.extend([key_from, key_to])
+        if not paths:
+            return None
+        repo = self.pool.acquire()
+        try:
+            # stages the removals and additions, git detects the renames
+            repo.git.add('-A', '--', *paths)
+            repo.git.commit(message="Moved %d entities" % (len(paths) // 2))
+            return repo.git.rev_parse('HEAD')
+        finally:
+            self.pool.release(repo, changed=True)
 
 
 
 rcs = GitBackend(settings.GIT_REPO_PATH)
 
 fetch = rcs.fetch
+fetch_many = rcs.fetch_many
+fetch_stream = rcs.fetch_stream
 commit = rcs.commit
+commit_many = rcs.commit_many
+bulk_import = rcs.bulk_import
 initial = rcs.initial
 get_revisions = rcs.get_revisions
+get_revisions_many = rcs.get_revisions_many
+get_history = rcs.get_history
+get_revision_log = rcs.get_revision_log
 move = rcs.move
+move_many = rcs.move_many
+compact = rcs.compact
+repack = rcs.repack
 diff = rcs.diff
+diff_stream = rcs.diff_stream
+annotate = rcs.annotate
 
-__all__ = ('fetch', 'commit', 'initial', 'get_revisions', 'move', 'diff')
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'move', 'move_many', 'compact', 'repack', 'diff', 'diff_stream', 'annotate')
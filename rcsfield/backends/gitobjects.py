@@ -0,0 +1,437 @@
+"""
+Object level access to git repositories for the git backends.
+
+``ObjectStore`` reads and writes blobs, trees and commits of a repository
+directly (loose objects with zlib, packed ones through ``git cat-file``)
+and moves refs with git's lock file convention, so content can be
+committed without a working copy and without starting git for every
+object.
+"""
+
+import os, zlib, errno, datetime, threading, subprocess
+
+from rcsfield.backends.catfile import CatFileBatch, stream_blob
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+
+TREE_MODE = '40000'
+BLOB_MODE = '100644'
+
+
+class RefChanged(Exception):
+    """
+    The ref was moved by someone else while we were committing.
+
+    """
+    pass
+
+
+class RefLocked(Exception):
+    """
+    The ``.lock`` file of the ref exists, either another process is moving
+    the ref right now or a crashed one left it behind.
+
+    """
+    pass
+
+
+
+class ObjectStore(object):
+    """
+    Minimal reader and writer for the object database and refs of a bare
+    git repository.
+
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.catfile = CatFileBatch(git_dir)
+
+    def git(self, args, input=None):
+        """
+        runs git with ``args`` against the repository and returns stdout.
+
+        """
+        proc = subprocess.Popen(['git', '--git-dir=%s' % self.git_dir] + args,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(input)
+        if proc.returncode != 0:
+            raise IOError("git %s failed: %s" % (' '.join(args), err.strip()))
+        return out
+
+    def _object_path(self, sha):
+        return os.path.join(self.git_dir, 'objects', sha[:2], sha[2:])
+
+    def read(self, sha):
+        """
+        returns ``(type, data)`` of the object ``sha``.
+
+        """
+        try:
+            fobj = open(self._object_path(sha), 'rb')
+        except IOError:
+            return self._read_packed(sha)
+        try:
+            raw = zlib.decompress(fobj.read())
+        finally:
+            fobj.close()
+        header, data = raw.split('\0', 1)
+        return header.split(' ', 1)[0], data
+
+    def stream(self, sha, chunk_size=65536):
+        """
+        yields the content of the object ``sha`` in chunks, decompressing
+        loose objects incrementally. A chunk is at most ``chunk_size``
+        bytes, even for highly compressible content.
+
+        """
+        try:
+            fobj = open(self._object_path(sha), 'rb')
+        except IOError:
+            for chunk in stream_blob(self.git_dir, sha, chunk_size):
+                yield chunk
+            return
+        try:
+            decompressor = zlib.decompressobj()
+            header = '' # the "<type> <size>\0" header is skipped
+            eof = False
+            while True:
+                if decompressor.unconsumed_tail:
+                    data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+                else:
+                    raw = fobj.read(chunk_size)
+                    if raw:
+                        data = decompressor.decompress(raw, chunk_size)
+                    else:
+                        eof = True
+                        data = decompressor.flush()
+                if header is not None:
+                    header += data
+                    if '\0' not in header:
+                        if eof:
+                            break
+                        continue
+                    data = header.split('\0', 1)[1]
+                    header = None
+                if data:
+                    yield data
+                if eof:
+                    break
+        finally:
+            fobj.close()
+
+    def read_path(self, rev, path):
+        """
+        returns ``(type, data)`` of the object at ``path`` in the commit
+        ``rev`` or ``None``. The path is resolved by the persistent
+        ``git cat-file --batch`` process, no trees are parsed in Python.
+
+        """
+        obj = self.catfile.get('%s:%s' % (rev, path))
+        if obj is None:
+            return None
+        return obj[1], obj[2]
+
+    def _read_packed(self, sha):
+        obj = self.catfile.get(sha)
+        if obj is None:
+            raise KeyError(sha)
+        return obj[1], obj[2]
+
+    def write(self, type, data):
+        """
+        stores ``data`` as a loose object of ``type`` and returns its sha.
+
+        """
+        raw = '%s %d\0%s' % (type, len(data), data)
+        sha = sha1(raw).hexdigest()
+        path = self._object_path(sha)
+        if os.path.exists(path):
+            return sha
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = '%s.%d.%s.tmp' % (path, os.getpid(), threading.currentThread().getName())
+        fobj = open(tmp, 'wb')
+        try:
+            fobj.write(zlib.compress(raw, 1))
+        finally:
+            fobj.close()
+        os.rename(tmp, path)
+        return sha
+
+    def read_tree(self, sha):
+        """
+        returns a dict mapping names to ``(mode, sha)`` for the tree ``sha``.
+
+        """
+        entries = {}
+        if sha is None:
+            return entries
+        type, data = self.read(sha)
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            mode = data[pos:space]
+            name = data[space+1:nul]
+            entries[name] = (mode, data[nul+1:nul+21].encode('hex'))
+            pos = nul + 21
+        return entries
+
+    def write_tree(self, entries):
+        def sort_key(name):
+            if entries[name][0] == TREE_MODE:
+                return name + '/'
+            return name
+        names = entries.keys()
+        names.sort(key=sort_key)
+        data = ''.join(['%s %s\0%s' % (entries[n][0], n, entries[n][1].decode('hex'))
+                        for n in names])
+        return self.write('tree', data)
+
+    def update_tree(self, tree, changes):
+        """
+        applies ``changes``, a dict mapping paths relative to ``tree`` to
+        blob shas (or ``None`` to remove the path), and returns the sha of
+        the new tree or ``None`` if it ended up empty.
+
+        """
+        entries = self.read_tree(tree)
+        subchanges = {}
+        for path, blob in changes.items():
+            if '/' in path:
+                name, rest = path.split('/', 1)
+                subchanges.setdefault(name, {})[rest] = blob
+            elif blob is None:
+                entries.pop(path, None)
+            else:
+                entries[path] = (BLOB_MODE, blob)
+        for name, sub in subchanges.items():
+            old = entries.get(name)
+            if old is not None and old[0] == TREE_MODE:
+                subtree = self.update_tree(old[1], sub)
+            else:
+                subtree = self.update_tree(None, sub)
+            if subtree is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = (TREE_MODE, subtree)
+        if not entries:
+            return None
+        return self.write_tree(entries)
+
+    def diff_trees(self, old, new, prefix=''):
+        """
+        returns a dict mapping the paths of all blobs which differ between
+        the trees ``old`` and ``new`` (either may be ``None``) to their sha
+        in ``new``, or ``None`` if they were removed.
+
+        """
+        changes = {}
+        if old == new:
+            return changes
+        a = self.read_tree(old)
+        b = self.read_tree(new)
+        for name in set(a.keys()) | set(b.keys()):
+            ea, eb = a.get(name), b.get(name)
+            if ea == eb:
+                continue
+            path = prefix + name
+            subtree_a = ea is not None and ea[0] == TREE_MODE and ea[1] or None
+            subtree_b = eb is not None and eb[0] == TREE_MODE and eb[1] or None
+            if subtree_a or subtree_b:
+                changes.update(self.diff_trees(subtree_a, subtree_b, path + '/'))
+            if eb is not None and not subtree_b:
+                changes[path] = eb[1]
+            elif ea is not None and not subtree_a:
+                changes[path] = None
+        return changes
+
+    def read_commit(self, sha):
+        """
+        returns a dict with ``tree``, ``parents``, ``time``, ``author`` and
+        ``message`` of the commit ``sha``.
+
+        """
+        type, data = self.read(sha)
+        headers, message = (data.split('\n\n', 1) + [''])[:2]
+        commit = {'parents': [], 'time': 0, 'author': None, 'message': message.strip()}
+        for line in headers.split('\n'):
+            if line.startswith('tree '):
+                commit['tree'] = line[5:]
+            elif line.startswith('parent '):
+                commit['parents'].append(line[7:])
+            elif line.startswith('author '):
+                commit['author'] = line[7:].rsplit(' ', 2)[0]
+            elif line.startswith('committer '):
+                commit['time'] = int(line.rsplit(' ', 2)[1])
+        return commit
+
+    def blame(self, rev, path):
+        """
+        returns a list of ``(sha, line)`` tuples, the commit which last
+        changed each line of ``path`` at ``rev``, from ``git blame``.
+
+        """
+        try:
+            output = self.git(['blame', '--porcelain', rev, '--', path])
+        except IOError:
+            return []
+        result = []
+        sha = None
+        for line in output.split('\n'):
+            if line.startswith('\t'):
+                result.append((sha, line[1:]))
+                continue
+            # header lines look like "<sha> <orig line> <final line> [<count>]"
+            bits = line.split(' ')
+            if len(bits[0]) == 40 and len(bits) >= 3 and bits[1].isdigit():
+                sha = bits[0]
+        return result
+
+    def resolve_ref(self, ref):
+        """
+        returns the sha ``ref`` points to or ``None``.
+
+        """
+        try:
+            fobj = open(os.path.join(self.git_dir, ref))
+            try:
+                return fobj.read().strip()
+            finally:
+                fobj.close()
+        except IOError:
+            pass
+        try:
+            fobj = open(os.path.join(self.git_dir, 'packed-refs'))
+        except IOError:
+            return None
+        try:
+            for line in fobj:
+                bits = line.strip().split(' ')
+                if len(bits) == 2 and bits[1] == ref:
+                    return bits[0]
+        finally:
+            fobj.close()
+        return None
+
+    def update_ref(self, ref, new, old):
+        """
+        points ``ref`` to ``new`` if it still points to ``old``. Uses git's
+        ``.lock`` file convention so concurrent writers are excluded.
+
+        """
+        path = os.path.join(self.git_dir, ref)
+        lock = path + '.lock'
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise RefLocked(lock)
+            raise
+        try:
+            if self.resolve_ref(ref) != old:
+                os.close(fd)
+                os.unlink(lock)
+                raise RefChanged(ref)
+            os.write(fd, new + '\n')
+            os.close(fd)
+            os.rename(lock, path)
+        except RefChanged:
+            raise
+        except:
+            if os.path.exists(lock):
+                os.unlink(lock)
+            raise
+
+
+
+
+def rewrite_history(store, ref, retention):
+    """
+    rewrites the first-parent history of ``ref`` in ``store`` so that it
+    only contains the changes selected by ``retention``.
+
+    ``retention`` is called with every path and a list of ``(sha, datetime)``
+    tuples of the commits in which it changed, newest first, and returns
+    the shas of the changes to keep. The newest change of every path and
+    the changes which (re-)add a path are always kept, so the tree at the
+    tip stays the same. Commits left without changes are dropped, author,
+    committer and message of the others are kept.
+
+    returns ``(commits_before, commits_after)``.
+
+    """
+    head = store.resolve_ref(ref)
+    if not head:
+        return 0, 0
+    commits = []
+    sha = head
+    while sha:
+        commit = store.read_commit(sha)
+        commits.append((sha, commit))
+        sha = commit['parents'] and commit['parents'][0] or None
+    commits.reverse()
+
+    changes = [] # the changed paths of every commit, oldest first
+    history = {} # path -> [(sha, time)], oldest first
+    keep = {} # path -> {sha: True}
+    tree = None
+    for sha, commit in commits:
+        diff = store.diff_trees(tree, commit['tree'])
+        for path, blob in diff.items():
+            changed = history.setdefault(path, [])
+            if blob is None or not changed or changed[-1][1] is None:
+                # removals and additions
+                keep.setdefault(path, {})[sha] = True
+            changed.append((sha, blob is not None and commit['time'] or None))
+        changes.append(diff)
+        tree = commit['tree']
+
+    for path, changed in history.items():
+        changed = [(sha, datetime.datetime.fromtimestamp(t)) for sha, t in changed if t is not None]
+        changed.reverse()
+        kept = keep.setdefault(path, {})
+        if changed:
+            kept[changed[0][0]] = True
+            for sha in retention(path, changed):
+                kept[sha] = True
+
+    new_head = new_tree = None
+    count = 0
+    for (sha, commit), diff in zip(commits, changes):
+        kept = {}
+        for path, blob in diff.items():
+            if sha in keep[path]:
+                kept[path] = blob
+        if not kept:
+            continue
+        new_tree = store.update_tree(new_tree, kept) or store.write_tree({})
+        headers, message = store.read(sha)[1].split('\n\n', 1)
+        lines = ['tree %s' % new_tree]
+        if new_head:
+            lines.append('parent %s' % new_head)
+        skipping = False
+        for line in headers.split('\n'):
+            if line.startswith(' ') and skipping:
+                continue # continuation of a signature
+            skipping = line.split(' ', 1)[0] in ('tree', 'parent', 'gpgsig', 'mergetag')
+            if not skipping:
+                lines.append(line)
+        new_head = store.write('commit', '\n'.join(lines) + '\n\n' + message)
+        count += 1
+
+    if new_tree != commits[-1][1]['tree']:
+        raise ValueError("rewritten history of %s does not end in the same tree" % ref)
+    store.update_ref(ref, new_head, head)
+    return len(commits), count
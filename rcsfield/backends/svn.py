@@ -4,10 +4,10 @@ SVN backend for django-rcsfield.
 Uses SVN  to versionize content.
 """
 
-import os, codecs, pysvn
+import os, codecs, datetime, tempfile, pysvn
 from django.conf import settings
 
-from rcsfield.backends.base import BaseBackend
+from rcsfield.backends.base import BaseBackend, HandlePool, log_entry
 
 
 
@@ -17,25 +17,42 @@ class SvnBackend(BaseBackend):
 
     """
 
+    def __init__(self, wc_path, root):
+        self.wc_path = os.path.normpath(wc_path)
+        self.root = root
+        self.pool = HandlePool(pysvn.Client)
+
+
     def initial(self, prefix):
         """
         Check out the svn working copy at ``settings.SVN_WC_PATH``.
 
         """
         c = pysvn.Client()
-        if not os.path.exists(settings.SVN_WC_PATH):
-            os.makedirs(settings.SVN_WC_PATH)
-        c.checkout(settings.SVN_ROOT, settings.SVN_WC_PATH)
+        if not os.path.exists(self.wc_path):
+            os.makedirs(self.wc_path)
+        c.checkout(self.root, self.wc_path)
 
-        if not os.path.exists(os.path.join(settings.SVN_WC_PATH, prefix)):
-            os.makedirs(os.path.join(settings.SVN_WC_PATH, prefix))
+        if not os.path.exists(os.path.join(self.wc_path, prefix)):
+            os.makedirs(os.path.join(self.wc_path, prefix))
             try:
-                c.add(os.path.join(settings.SVN_WC_PATH, prefix.split('/')[0]), recurse=True)
+                c.add(os.path.join(self.wc_path, prefix.split('/')[0]), recurse=True)
             except:
                 # svn fails if the directory is already under version control, but we don't care
                 pass
-            c.checkin(settings.SVN_WC_PATH, log_message="created inital directory")
-        c.update(settings.SVN_WC_PATH)
+            c.checkin(self.wc_path, log_message="created inital directory")
+        c.update(self.wc_path)
+
+
+    def _revision(self, rev):
+        """
+        returns the ``pysvn.Revision`` for ``rev``, a revision number or
+        ``'head'``.
+
+        """
+        if rev == 'head':
+            return pysvn.Revision(pysvn.opt_revision_kind.head)
+        return pysvn.Revision(pysvn.opt_revision_kind.number, int(rev))
 
 
     def fetch(self, key, rev):
@@ -43,10 +60,63 @@ class SvnBackend(BaseBackend):
         fetch revision ``rev`` of entity identified by ``key``.
 
         """
-        c = pysvn.Client()
-        svnrev = pysvn.Revision(pysvn.opt_revision_kind.number, int(rev))
-        olddata = c.cat(os.path.join(settings.SVN_WC_PATH, key), revision = svnrev)
-        return olddata
+        c = self.pool.acquire()
+        try:
+            svnrev = self._revision(rev)
+            olddata = c.cat(os.path.join(self.wc_path, key), revision = svnrev)
+            return olddata
+        finally:
+            self.pool.release(c)
+
+
+    def fetch_stream(self, key, rev):
+        """
+        yields revision ``rev`` of entity identified by ``key`` in chunks.
+        The revision is exported to a temporary file first, so it is never
+        held in memory as a whole.
+
+        """
+        svnrev = self._revision(rev)
+        fd, path = tempfile.mkstemp(prefix='rcsfield-')
+        os.close(fd)
+        try:
+            c = self.pool.acquire()
+            try:
+                c.export(os.path.join(self.wc_path, key), path, force=True, revision=svnrev)
+            finally:
+                self.pool.release(c)
+            fobj = open(path, 'rb')
+            try:
+                while True:
+                    chunk = fobj.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                fobj.close()
+        finally:
+            os.unlink(path)
+
+
+    def fetch_many(self, keys, rev):
+        """
+        fetch revision ``rev`` of all entities identified by ``keys``
+        using a single client.
+
+        """
+        c = self.pool.acquire()
+        try:
+            svnrev = self._revision(rev)
+            result = {}
+            for key in keys:
+                try:
+                    result[key] = c.cat(os.path.join(self.wc_path, key), revision = svnrev)
+                except pysvn.ClientError:
+                    # the key did not exist in this revision
+                    pass
+            return result
+        finally:
+            self.pool.release(c)
 
 
     def commit(self, key, data):
@@ -55,47 +125,202 @@ class SvnBackend(BaseBackend):
 
         """
         try:
-            fobj = open(os.path.join(settings.SVN_WC_PATH, key), 'w')
+            fobj = open(os.path.join(self.wc_path, key), 'w')
         except IOError:
             #parent directory seems to be missing
-            self.initial(os.path.dirname(os.path.join(settings.SVN_WC_PATH, key)))
+            self.initial(os.path.dirname(os.path.join(self.wc_path, key)))
             return self.commit(key, data)
         fobj.write(data)
         fobj.close()
-        c = pysvn.Client()
+        c = self.pool.acquire()
         try:
-            #svn add will throw an error, if the file is already under version control
-            c.add(os.path.join(settings.SVN_WC_PATH, key))
-        except:
-            #but we don't care ...
-            pass
-        c.checkin(os.path.join(settings.SVN_WC_PATH, key), log_message="auto checkin from django")
-        c.update(settings.SVN_WC_PATH)
+            try:
+                #svn add will throw an error, if the file is already under version control
+                c.add(os.path.join(self.wc_path, key))
+            except:
+                #but we don't care ...
+                pass
+            rev = c.checkin(os.path.join(self.wc_path, key), log_message="auto checkin from django")
+            c.update(self.wc_path)
+            if rev is not None:
+                return rev.number
+        finally:
+            self.pool.release(c)
 
 
-    def get_revisions(self, key):
+    def commit_many(self, items):
         """
-        get all revisions in which ``key`` was changed.
-        TODO: this is really slow =(
+        commit changed data of several entities in a single commit.
+        ``items`` is a list of ``(key, data)`` tuples.
 
         """
-        c = pysvn.Client()
-        revs = c.log(settings.SVN_WC_PATH, discover_changed_paths=True)
+        paths = []
+        for key, data in items:
+            path = os.path.join(self.wc_path, key)
+            if not os.path.exists(os.path.dirname(path)):
+                self.initial(os.path.dirname(path))
+            fobj = open(path, 'w')
+            fobj.write(data)
+            fobj.close()
+            paths.append(path)
+        if not paths:
+            return None
+        c = self.pool.acquire()
+        try:
+            for path in paths:
+                try:
+                    #svn add will throw an error, if the file is already under version control
+                    c.add(path)
+                except:
+                    pass
+            rev = c.checkin(paths, log_message="auto checkin from django")
+            c.update(self.wc_path)
+            if rev is not None:
+                return rev.number
+        finally:
+            self.pool.release(c)
+
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
+        """
+        get all revisions in which ``key`` was changed. Only the log of
+        ``key`` itself is asked for, limited to ``limit`` entries between
+        ``after`` and ``before``.
+
+        """
+        if before is not None:
+            if int(before) <= 1:
+                return []
+            start = pysvn.Revision(pysvn.opt_revision_kind.number, int(before) - 1)
+        else:
+            start = pysvn.Revision(pysvn.opt_revision_kind.head)
+        end = pysvn.Revision(pysvn.opt_revision_kind.number, int(after or 0))
+        c = self.pool.acquire()
+        try:
+            try:
+                revs = c.log(os.path.join(self.wc_path, key), revision_start=start,
+                             revision_end=end, limit=limit and limit + (before is None) or 0)
+            except pysvn.ClientError:
+                revs = []
+        finally:
+            self.pool.release(c)
+        crevs = [r.revision.number for r in revs]
+        if after is not None:
+            crevs = [r for r in crevs if r > int(after)]
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        return crevs
+
+
+    def get_revision_log(self, key, limit=None):
+        """
+        returns the log of ``key`` with author and message from a single
+        ``svn log`` of ``key``. The size is not part of the log and left
+        out.
+
+        """
+        c = self.pool.acquire()
+        try:
+            try:
+                revs = c.log(os.path.join(self.wc_path, key), limit=limit or 0)
+            except pysvn.ClientError:
+                revs = []
+        finally:
+            self.pool.release(c)
+        return [log_entry(r.revision.number, datetime.datetime.fromtimestamp(r.date),
+                          r.get('author'), r.get('message')) for r in revs]
+
+
+    def annotate(self, key, rev):
+        """
+        returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of ``key`` at ``rev`` was last changed, from
+        ``svn blame``.
+
+        """
+        if rev == 'head':
+            svnrev = pysvn.Revision(pysvn.opt_revision_kind.head)
+        else:
+            svnrev = pysvn.Revision(pysvn.opt_revision_kind.number, int(rev))
+        c = self.pool.acquire()
+        try:
+            try:
+                lines = c.annotate(os.path.join(self.wc_path, key), revision_end=svnrev)
+            except pysvn.ClientError:
+                return []
+        finally:
+            self.pool.release(c)
+        return [(l['revision'].number, l['line']) for l in lines]
+
+
+    def get_revisions_many(self, keys, limit=None, before=None):
+        """
+        get all revisions in which any of ``keys`` was changed, walking
+        the log only once.
+
+        """
+        paths = dict([('/'+key, True) for key in keys])
+        if before is not None:
+            if int(before) <= 1:
+                return []
+            start = pysvn.Revision(pysvn.opt_revision_kind.number, int(before) - 1)
+        else:
+            start = pysvn.Revision(pysvn.opt_revision_kind.head)
+        c = self.pool.acquire()
+        try:
+            revs = c.log(self.wc_path, revision_start=start, discover_changed_paths=True)
+        finally:
+            self.pool.release(c)
         crevs = []
         for r in revs:
-            if '/'+key in [p.path for p in r.changed_paths]:
-                crevs.append(r.revision.number)
+            for p in r.changed_paths:
+                if p.path in paths:
+                    crevs.append(r.revision.number)
+                    break
         crevs.sort(reverse=True)
-        return crevs[1:] # cut of the head revision-number
+        if before is None:
+            crevs = crevs[1:] # cut of the head revision-number
+        if limit:
+            crevs = crevs[:limit]
+        return crevs
+
+
+    def get_history(self, key):
+        """
+        returns a list of ``(revision, timestamp)`` tuples for all revisions
+        at which ``key`` was changed, newest first and including the head
+        revision.
+
+        """
+        c = self.pool.acquire()
+        try:
+            revs = c.log(self.wc_path, discover_changed_paths=True)
+            history = []
+            for r in revs:
+                if '/'+key in [p.path for p in r.changed_paths]:
+                    history.append((r.revision.number, datetime.datetime.fromtimestamp(r.date)))
+            history.sort(reverse=True)
+            return history
+        finally:
+            self.pool.release(c)
 
 
 
-rcs = SvnBackend()
+rcs = SvnBackend(settings.SVN_WC_PATH, settings.SVN_ROOT)
 
 fetch = rcs.fetch
+fetch_many = rcs.fetch_many
+fetch_stream = rcs.fetch_stream
 commit = rcs.commit
+commit_many = rcs.commit_many
+bulk_import = rcs.bulk_import
 initial = rcs.initial
 get_revisions = rcs.get_revisions
+get_revisions_many = rcs.get_revisions_many
+get_history = rcs.get_history
+get_revision_log = rcs.get_revision_log
 diff = rcs.diff
+diff_stream = rcs.diff_stream
+annotate = rcs.annotate
 
-__all__ = ('fetch', 'commit', 'initial', 'get_revisions', 'diff')
+__all__ = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import', 'initial', 'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'diff', 'diff_stream', 'annotate')
@@ -0,0 +1,276 @@
+"""
+Backend benchmarks for django-rcsfield.
+
+Builds synthetic repositories of a given size in a temporary directory
+(local bzr and git repositories, a ``file://`` svn repository, and a
+test database for the ``db`` backend, created like the test runner does)
+and times the backend operations on them. The configured database is not
+touched and settings changed for a run are restored afterwards. Results are plain dicts, ready to be dumped as json
+and compared between runs.
+
+Usually run through the management command::
+
+    ./manage.py rcsbenchmark --backends=gitcore,bzr --revisions=1000,10000 \\
+                             --keys=10,1000 --output=results.json
+
+"""
+
+import os, sys, time, random, shutil, tempfile, platform, subprocess
+
+from django.conf import settings
+
+
+BACKENDS = {
+    # name: (module, class, setting with the repository path)
+    'gitcore': ('rcsfield.backends.gitcore', 'GitBackend', 'GIT_REPO_PATH'),
+    'gitbare': ('rcsfield.backends.gitbare', 'GitBareBackend', 'GIT_BARE_REPO_PATH'),
+    'bzr': ('rcsfield.backends.bzr', 'BzrBackend', 'BZR_WC_PATH'),
+    'svn': ('rcsfield.backends.svn', 'SvnBackend', 'SVN_WC_PATH'),
+    'db': ('rcsfield.backends.db', 'DbBackend', None),
+}
+
+
+def _import(module, name):
+    return getattr(__import__(module, {}, {}, [name]), name)
+
+
+def _default(changed, setting, value):
+    """
+    sets ``setting`` to ``value`` unless it is configured already and
+    remembers it in ``changed`` to be removed by ``restore``.
+
+    """
+    if not hasattr(settings, setting):
+        setattr(settings, setting, value)
+        changed.append(setting)
+
+
+def restore(changed):
+    """
+    removes the settings added by ``make_backend`` again.
+
+    """
+    while changed:
+        delattr(settings, changed.pop())
+
+
+def make_backend(name, directory, changed):
+    """
+    returns a fresh backend instance of type ``name`` whose repository
+    lives in ``directory``. the names of settings it had to add are
+    appended to ``changed``.
+
+    """
+    module, klass, setting = BACKENDS[name]
+    path = os.path.join(directory, name)
+    if setting:
+        # the backend modules create a default instance on import
+        _default(changed, setting, path)
+    if name == 'svn':
+        repo = os.path.join(directory, 'svnrepo')
+        subprocess.call(['svnadmin', 'create', repo])
+        _default(changed, 'SVN_ROOT', 'file://' + repo)
+        return _import(module, klass)(path, 'file://' + repo)
+    if name == 'db':
+        return _import(module, klass)(getattr(settings, 'RCS_DB_SNAPSHOT_INTERVAL', 10))
+    return _import(module, klass)(path)
+
+
+def summarize(samples):
+    """
+    returns count, total, mean, median, p95, min and max of ``samples``
+    (in seconds).
+
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    if not count:
+        return {'count': 0}
+    return {
+        'count': count,
+        'total': sum(samples),
+        'mean': sum(samples) / count,
+        'median': samples[count // 2],
+        'p95': samples[min(count - 1, int(count * 0.95))],
+        'min': samples[0],
+        'max': samples[-1],
+    }
+
+
+def timed(samples, func, *args):
+    start = time.time()
+    result = func(*args)
+    samples.append(time.time() - start)
+    return result
+
+
+class Synthetic(object):
+    """
+    Deterministic synthetic content: every key is a document of ``lines``
+    lines, every revision rewrites a few of them.
+
+    """
+
+    def __init__(self, keys, lines=50, seed=0):
+        self.random = random.Random(seed)
+        self.keys = ['rcsbenchmark/%07d.txt' % i for i in range(keys)]
+        self.docs = {}
+        self.lines = lines
+
+    def change(self, n):
+        key = self.keys[n % len(self.keys)]
+        doc = self.docs.get(key)
+        if doc is None:
+            doc = ['line %d of %s\n' % (i, key) for i in range(self.lines)]
+        for i in range(3):
+            doc[self.random.randrange(self.lines)] = 'changed in %d\n' % n
+        self.docs[key] = doc
+        return key, ''.join(doc)
+
+
+def run_backend(name, revisions, keys, samples=100, directory=None, lines=50):
+    """
+    builds a repository with ``revisions`` commits spread over ``keys``
+    keys with backend ``name`` and times its operations. returns a list of
+    result dicts.
+
+    the ``db`` backend runs on a test database, which is created before
+    and destroyed after the run.
+
+    """
+    cleanup = directory is None
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='rcsbench-')
+    rnd = random.Random(1)
+    results = []
+    def record(operation, timings):
+        result = {'backend': name, 'revisions': revisions, 'keys': keys,
+                  'operation': operation}
+        result.update(summarize(timings))
+        results.append(result)
+
+    changed = []
+    if name == 'db':
+        from django.db import connection
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        rcs = make_backend(name, directory, changed)
+        rcs.initial('rcsbenchmark')
+        content = Synthetic(keys, lines)
+        history = {} # key -> revisions
+        timings = []
+        for n in range(revisions):
+            key, data = content.change(n)
+            rev = timed(timings, rcs.commit, key, data)
+            if rev is not None:
+                history.setdefault(key, []).append(rev)
+        record('commit', timings)
+
+        known = [key for key in history if history[key]]
+        if not known:
+            return results
+
+        timings = []
+        for i in range(samples):
+            key = rnd.choice(known)
+            timed(timings, rcs.fetch, key, rnd.choice(history[key]))
+        record('fetch', timings)
+
+        timings = []
+        for i in range(max(1, samples // 10)):
+            some = rnd.sample(known, min(len(known), 100))
+            rev = rnd.choice(history[some[0]])
+            timed(timings, rcs.fetch_many, some, rev)
+        record('fetch_many(100)', timings)
+
+        timings = []
+        for i in range(samples):
+            timed(timings, rcs.get_revisions, rnd.choice(known))
+        record('get_revisions', timings)
+
+        # time computing the diffs, not hits of the diff cache
+        from rcsfield import diff as rcsdiff
+        max_bytes = rcsdiff._cache.max_bytes
+        rcsdiff._cache.max_bytes = 0
+        try:
+            timings = []
+            for i in range(samples):
+                key = rnd.choice(known)
+                revs = history[key]
+                timed(timings, lambda: list(rcs.diff(key, rnd.choice(revs), key, rnd.choice(revs))))
+            record('diff', timings)
+        finally:
+            rcsdiff._cache.max_bytes = max_bytes
+
+        timings = []
+        for i in range(min(samples, len(known))):
+            key = known[i]
+            try:
+                timed(timings, rcs.move, key, key + '.moved')
+            except (NotImplementedError, AttributeError):
+                break
+        record('move', timings)
+    finally:
+        restore(changed)
+        if cleanup:
+            shutil.rmtree(directory, ignore_errors=True)
+        if name == 'db':
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def run_model(model, samples=20):
+    """
+    times ``RevisionQuerySet`` iteration and the backend work done by
+    ``RevisionAdmin.diff_view`` on existing rows of ``model``, using the
+    configured backend.
+
+    """
+    results = []
+    fields = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+    objects = list(model._default_manager.all()[:samples])
+    revs = []
+    for obj in objects:
+        revs.extend(obj.get_changed_revisions())
+    if not revs:
+        return results
+    rnd = random.Random(1)
+    label = '%s.%s' % (model._meta.app_label, model.__name__)
+
+    timings = []
+    for i in range(samples):
+        rev = rnd.choice(revs)
+        def iterate():
+            for obj in model._default_manager.rev(rev).all():
+                for field in fields:
+                    getattr(obj, field.attname)
+        timed(timings, iterate)
+    result = {'backend': 'configured', 'model': label, 'operation': 'RevisionQuerySet.iterator'}
+    result.update(summarize(timings))
+    results.append(result)
+
+    timings = []
+    for obj in objects:
+        obj_revs = obj.get_changed_revisions()
+        if len(obj_revs) < 2:
+            continue
+        def diff_view():
+            # the same backend calls as RevisionAdmin.diff_view, without
+            # rendering the template
+            old = model._default_manager.rev(obj_revs[0]).get(pk=obj.pk)
+            for field in fields:
+                list(getattr(old, 'get_%s_diff' % field.name)(obj_revs[1]))
+        timed(timings, diff_view)
+    result = {'backend': 'configured', 'model': label, 'operation': 'RevisionAdmin.diff_view'}
+    result.update(summarize(timings))
+    results.append(result)
+    return results
+
+
+def environment():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
@@ -0,0 +1,312 @@
+"""
+Revision-content cache for django-rcsfield.
+
+The content of a key at a specific revision never changes, so it can be
+cached forever. ``CachedBackend`` wraps the backend module selected by
+``settings.RCS_BACKEND`` and keeps fetched contents and diffs in a bounded
+in-process LRU cache, optionally backed by django's cache framework as a
+second tier.
+
+Enable it in your settings::
+
+    RCS_CACHE = True
+    RCS_CACHE_MAX_BYTES = 16 * 1024 * 1024  # size of the in-process cache
+    RCS_CACHE_DJANGO = True                 # also use django's cache
+    RCS_CACHE_TIMEOUT = 60 * 60 * 24 * 30   # timeout for django's cache
+
+Only revisions which unambiguously identify a point in history are cached:
+revision numbers (bzr, svn) and full 40-character hashes (git). ``head``,
+branch names and other symbolic refs always go to the backend.
+
+Annotations are cached per key and revision as well, ``annotate(key,
+'head')`` resolves ``head`` to the revision in which the key last changed.
+When a key whose annotation is cached is committed again, the annotation
+of the new revision is derived from the cached one instead of running the
+annotate command of the backend again.
+
+"""
+
+import re
+import threading
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+
+
+_HASH_RE = re.compile(r'^[0-9a-fA-F]{40}$')
+
+
+def normalize_revision(rev):
+    """
+    Returns a canonical string for ``rev`` if it identifies an immutable
+    revision, ``None`` otherwise.
+
+    """
+    if isinstance(rev, (int, long)):
+        return str(rev)
+    if not isinstance(rev, basestring):
+        return None
+    rev = rev.strip()
+    if rev.isdigit():
+        return str(int(rev))
+    if _HASH_RE.match(rev):
+        return rev.lower()
+    return None
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its
+    values in bytes.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._map = {} # key -> [prev, next, key, value, size]
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                self.size -= link[4]
+            link = [None, None, key, value, size]
+            self._map[key] = link
+            self._append(link)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+                self.size -= oldest[4]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = link
+        self._root[0] = link
+
+
+class CachedBackend(object):
+    """
+    Wraps a backend module and caches ``fetch``, ``fetch_many``, ``diff``
+    and ``annotate`` results for immutable revisions. Everything else is
+    passed through to the wrapped backend.
+
+    """
+
+    def __init__(self, backend, max_bytes=None, use_django_cache=None, timeout=None):
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'RCS_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        if use_django_cache is None:
+            use_django_cache = getattr(settings, 'RCS_CACHE_DJANGO', False)
+        if timeout is None:
+            timeout = getattr(settings, 'RCS_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+        self.backend = backend
+        self.local = LRUCache(max_bytes)
+        self.timeout = timeout
+        self.shared = None
+        if use_django_cache:
+            from django.core.cache import cache
+            self.shared = cache
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _cache_key(self, *bits):
+        return 'rcsfield:%s:%s' % (self.backend.__name__,
+                                   md5_constructor('\0'.join(bits)).hexdigest())
+
+    def _get(self, cache_key):
+        value = self.local.get(cache_key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(cache_key)
+            if value is not None:
+                self.local.set(cache_key, value, _sizeof(value))
+        return value
+
+    def _set(self, cache_key, value):
+        self.local.set(cache_key, value, _sizeof(value))
+        if self.shared is not None:
+            self.shared.set(cache_key, value, self.timeout)
+
+    def fetch(self, key, rev):
+        nrev = normalize_revision(rev)
+        if nrev is None:
+            return self.backend.fetch(key, rev)
+        cache_key = self._cache_key('fetch', key, nrev)
+        data = self._get(cache_key)
+        if data is None:
+            data = self.backend.fetch(key, rev)
+            if data:
+                # empty content may be an error the backend swallowed
+                self._set(cache_key, data)
+        return data
+
+    def fetch_many(self, keys, rev):
+        nrev = normalize_revision(rev)
+        if nrev is None:
+            return self._fetch_many(keys, rev)
+        result = {}
+        missing = {}
+        for key in keys:
+            cache_key = self._cache_key('fetch', key, nrev)
+            data = self._get(cache_key)
+            if data is None:
+                missing[key] = cache_key
+            else:
+                result[key] = data
+        if missing:
+            fetched = self._fetch_many(missing.keys(), rev)
+            for key, data in fetched.items():
+                if data:
+                    self._set(missing[key], data)
+            result.update(fetched)
+        return result
+
+    def _fetch_many(self, keys, rev):
+        if hasattr(self.backend, 'fetch_many'):
+            return self.backend.fetch_many(keys, rev)
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self.backend.fetch(key, rev)
+            except:
+                pass
+        return result
+
+    def diff(self, key1, rev1, key2, rev2):
+        nrev1 = normalize_revision(rev1)
+        nrev2 = normalize_revision(rev2)
+        if nrev1 is None or nrev2 is None:
+            return self.backend.diff(key1, rev1, key2, rev2)
+        cache_key = self._cache_key('diff', key1, nrev1, key2, nrev2)
+        lines = self._get(cache_key)
+        if lines is None:
+            lines = list(self.backend.diff(key1, rev1, key2, rev2))
+            self._set(cache_key, lines)
+        return iter(lines)
+
+    def annotate(self, key, rev):
+        previous = None
+        head = rev in ('head', 'HEAD')
+        if head:
+            log = self.backend.get_revision_log(key, 2)
+            if not log:
+                return self.backend.annotate(key, rev)
+            rev = log[0]['revision']
+            if len(log) > 1:
+                previous = log[1]['revision']
+        nrev = normalize_revision(rev)
+        if nrev is None:
+            return self.backend.annotate(key, rev)
+        cache_key = self._cache_key('annotate', key, nrev)
+        annotation = self._get(cache_key)
+        if annotation is None:
+            if previous is not None:
+                annotation = self._derive_annotation(key, previous, rev)
+            if annotation is None:
+                annotation = self.backend.annotate(key, rev)
+            self._set(cache_key, annotation)
+        if head:
+            # remember it, so the next commit can derive its annotation
+            self._set(self._cache_key('annotate-head', key), nrev)
+        return annotation
+
+    def commit(self, key, data):
+        rev = self.backend.commit(key, data)
+        if rev is not None:
+            self._update_annotations([(key, data)], rev)
+        return rev
+
+    def commit_many(self, items):
+        rev = self.backend.commit_many(items)
+        if rev is not None:
+            self._update_annotations(items, rev)
+        return rev
+
+    def _derive_annotation(self, key, previous, rev, data=None):
+        """
+        returns the annotation of ``key`` at ``rev`` derived from the cached
+        annotation of ``previous``, or ``None`` if that is not cached.
+
+        """
+        from rcsfield.diff import update_annotation
+        nprevious = normalize_revision(previous)
+        if nprevious is None:
+            return None
+        annotation = self._get(self._cache_key('annotate', key, nprevious))
+        if annotation is None:
+            return None
+        if data is None:
+            data = self.fetch(key, rev)
+        return update_annotation(annotation, data, rev)
+
+    def _update_annotations(self, items, rev):
+        """
+        derives the annotation of the new revision ``rev`` for the committed
+        keys whose annotation of the previous revision is cached.
+
+        """
+        nrev = normalize_revision(rev)
+        if nrev is None:
+            return
+        for key, data in items:
+            head = self._get(self._cache_key('annotate-head', key))
+            if head is None:
+                continue # never annotated
+            # make sure nobody else committed the key in between
+            previous = self.backend.get_revisions(key, 1)
+            if not previous or normalize_revision(previous[0]) != head:
+                continue
+            annotation = self._derive_annotation(key, previous[0], rev, data)
+            if annotation is not None:
+                self._set(self._cache_key('annotate', key, nrev), annotation)
+                self._set(self._cache_key('annotate-head', key), nrev)
+
+
+def _sizeof(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum([_sizeof(v) for v in value])
+    return 0
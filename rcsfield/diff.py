@@ -0,0 +1,449 @@
+"""
+Diff engine for django-rcsfield.
+
+``difflib.unified_diff`` can be quadratic on large documents. The default
+engine here is a patience diff over interned line ids: common prefixes
+and suffixes are stripped first, lines which are unique on both sides
+are matched with a longest increasing subsequence and the regions between
+them are diffed recursively.
+
+The engine can be replaced with ``settings.RCS_DIFF_ENGINE``, a dotted
+path to a callable with the signature of ``difflib.unified_diff``::
+
+    RCS_DIFF_ENGINE = 'difflib.unified_diff'
+
+Diffs between two immutable revisions never change, ``diff_revisions``
+caches them in an in-process LRU of ``settings.RCS_DIFF_CACHE_MAX_BYTES``
+(default 4MB, 0 disables the cache).
+
+``update_annotation`` derives the annotation (the revision which last
+changed each line) of a new revision from the annotation of the previous
+one.
+
+For very large contents ``stream_diff`` diffs two line iterators (e.g.
+``iter_lines(backend.fetch_stream(key, rev))``) without holding either
+content in memory, see ``diff_stream`` of the backends.
+
+"""
+
+import bisect
+import difflib
+from array import array
+from itertools import islice
+
+from django.conf import settings
+
+from rcsfield.cache import LRUCache, normalize_revision
+
+
+# regions smaller than this (len(a) * len(b)) without unique common lines
+# are handed to difflib, larger ones are reported as replaced.
+SMALL_REGION = 10000
+
+
+def _intern(a, b):
+    """
+    maps every distinct line to a small integer, so lines are compared by
+    id instead of by content.
+
+    """
+    ids = {}
+    def convert(lines):
+        result = []
+        for line in lines:
+            result.append(ids.setdefault(line, len(ids)))
+        return result
+    return convert(a), convert(b)
+
+
+def _unique_lcs(a, alo, ahi, b, blo, bhi):
+    """
+    returns matching ``(i, j)`` pairs of lines which occur exactly once in
+    ``a[alo:ahi]`` and ``b[blo:bhi]``, forming the longest increasing
+    sequence (patience sorting).
+
+    """
+    counts = {}
+    for i in xrange(alo, ahi):
+        line = a[i]
+        count, pos = counts.get(line, (0, None))
+        counts[line] = (count + 1, i)
+    bcounts = {}
+    for j in xrange(blo, bhi):
+        line = b[j]
+        if counts.get(line, (0,))[0] == 1:
+            count, pos = bcounts.get(line, (0, None))
+            bcounts[line] = (count + 1, j)
+    pairs = [(counts[line][1], pos) for line, (count, pos) in bcounts.items() if count == 1]
+    if not pairs:
+        return []
+    pairs.sort()
+
+    # patience sorting on the b positions
+    tops = [] # smallest b position ending a sequence of each length
+    backpointers = []
+    top_index = [] # index into pairs for each pile top
+    for n, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tops, j)
+        if k == len(tops):
+            tops.append(j)
+            top_index.append(n)
+        else:
+            tops[k] = j
+            top_index[k] = n
+        if k > 0:
+            backpointers.append(top_index[k-1])
+        else:
+            backpointers.append(None)
+    result = []
+    n = top_index[-1]
+    while n is not None:
+        result.append(pairs[n])
+        n = backpointers[n]
+    result.reverse()
+    return result
+
+
+def _match(a, alo, ahi, b, blo, bhi, matches):
+    """
+    appends ``(i, j, size)`` matching blocks of ``a[alo:ahi]`` and
+    ``b[blo:bhi]`` to ``matches``.
+
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # common prefix
+        start = 0
+        while alo + start < ahi and blo + start < bhi and a[alo+start] == b[blo+start]:
+            start += 1
+        # common suffix
+        end = 0
+        while ahi - end > alo + start and bhi - end > blo + start and a[ahi-end-1] == b[bhi-end-1]:
+            end += 1
+        if start:
+            matches.append((alo, blo, start))
+        if end:
+            matches.append((ahi - end, bhi - end, end))
+        alo += start
+        blo += start
+        ahi -= end
+        bhi -= end
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_lcs(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            last_i, last_j = alo, blo
+            for i, j in anchors:
+                stack.append((last_i, i, last_j, j))
+                matches.append((i, j, 1))
+                last_i, last_j = i + 1, j + 1
+            stack.append((last_i, ahi, last_j, bhi))
+        elif (ahi - alo) * (bhi - blo) <= SMALL_REGION:
+            sm = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+            for i, j, size in sm.get_matching_blocks():
+                if size:
+                    matches.append((alo + i, blo + j, size))
+        # else: no usable anchors in a large region, report it as replaced
+
+
+def get_opcodes(a, b):
+    """
+    returns a list of opcodes like ``difflib.SequenceMatcher.get_opcodes``
+    turning the lines ``a`` into the lines ``b``.
+
+    """
+    ia, ib = _intern(a, b)
+    return _opcodes(ia, ib)
+
+
+def _opcodes(ia, ib):
+    """
+    returns the opcodes between the sequences of line ids ``ia`` and ``ib``.
+
+    """
+    matches = []
+    _match(ia, 0, len(ia), ib, 0, len(ib), matches)
+    matches.sort()
+
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in matches + [(len(ia), len(ib), 0)]:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                # merge adjacent matches
+                tag, i1, i2, j1, j2 = opcodes.pop()
+                opcodes.append(('equal', i1, ai + size, j1, bj + size))
+            else:
+                opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    if not opcodes:
+        opcodes.append(('equal', 0, 1, 0, 1))
+    return opcodes
+
+
+def _grouped_opcodes(codes, n=3):
+    """
+    groups opcodes into hunks with ``n`` lines of context, see
+    ``difflib.SequenceMatcher.get_grouped_opcodes``.
+
+    """
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2-n), i2, max(j1, j2-n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1+n), j1, min(j2, j1+n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2-i1 > nn:
+            group.append((tag, i1, min(i2, i1+n), j1, min(j2, j1+n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2-n), max(j1, j2-n)
+        group.append((tag, i1, i2, j1 ,j2))
+    if group and not (len(group)==1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d' % beginning
+    if not length:
+        beginning -= 1
+    return '%d,%d' % (beginning, length)
+
+
+def unified_diff(a, b, fromfile='', tofile='', n=3):
+    """
+    drop-in replacement for ``difflib.unified_diff`` using the patience
+    diff above.
+
+    """
+    started = False
+    for group in _grouped_opcodes(get_opcodes(a, b), n):
+        if not started:
+            started = True
+            yield '--- %s\n' % fromfile
+            yield '+++ %s\n' % tofile
+        first, last = group[0], group[-1]
+        yield '@@ -%s +%s @@\n' % (_format_range(first[1], last[2]),
+                                   _format_range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+
+def iter_lines(chunks):
+    """
+    yields the lines, including line endings, of the content delivered in
+    ``chunks`` (e.g. by ``fetch_stream``). Only one chunk and one line are
+    held at a time.
+
+    """
+    rest = ''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def _line_ids(lines):
+    ids = array('l')
+    for line in lines:
+        ids.append(hash(line))
+    return ids
+
+
+def _next_line(lines):
+    try:
+        return lines.next()
+    except StopIteration:
+        return None
+
+
+def _verify(codes, a, b):
+    """
+    returns ``codes``, computed on line hashes, with the lines of ``equal``
+    runs compared by their text. Lines whose hashes collide are turned into
+    ``replace`` opcodes. ``a`` and ``b`` are iterators over the lines.
+
+    """
+    a, b = iter(a), iter(b)
+    result = []
+    def add(tag, i1, i2, j1, j2):
+        if result and result[-1][0] == tag and result[-1][2] == i1 and result[-1][4] == j1:
+            result[-1] = (tag, result[-1][1], i2, result[-1][3], j2)
+        else:
+            result.append((tag, i1, i2, j1, j2))
+    for tag, i1, i2, j1, j2 in codes:
+        if tag != 'equal':
+            for line in islice(a, i2 - i1):
+                pass
+            for line in islice(b, j2 - j1):
+                pass
+            add(tag, i1, i2, j1, j2)
+            continue
+        for k in xrange(i2 - i1):
+            if _next_line(a) == _next_line(b):
+                add('equal', i1 + k, i1 + k + 1, j1 + k, j1 + k + 1)
+            else:
+                add('replace', i1 + k, i1 + k + 1, j1 + k, j1 + k + 1)
+    return result
+
+
+class _LineReader(object):
+    """
+    reads ranges of lines from an iterator, in increasing order.
+
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.pos = 0
+
+    def take(self, start, stop):
+        while self.pos < start:
+            self.lines.next()
+            self.pos += 1
+        while self.pos < stop:
+            line = self.lines.next()
+            self.pos += 1
+            yield line
+
+
+def stream_diff(old, new, fromfile='', tofile='', n=3):
+    """
+    like ``unified_diff`` but ``old`` and ``new`` are callables returning
+    fresh iterators over the lines to diff. The diff is computed on arrays
+    of line hashes (8 bytes per line). The lines are read a second time to
+    compare the ones with equal hashes, so that hash collisions are not
+    taken for unchanged lines. They are read a third time while writing
+    the output, so the contents are never held in memory. The
+    ``RCS_DIFF_ENGINE`` setting does not apply.
+
+    """
+    codes = _verify(_opcodes(_line_ids(old()), _line_ids(new())), old(), new())
+    a = _LineReader(old())
+    b = _LineReader(new())
+    started = False
+    for group in _grouped_opcodes(codes, n):
+        if not started:
+            started = True
+            yield '--- %s\n' % fromfile
+            yield '+++ %s\n' % tofile
+        first, last = group[0], group[-1]
+        yield '@@ -%s +%s @@\n' % (_format_range(first[1], last[2]),
+                                   _format_range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a.take(i1, i2):
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a.take(i1, i2):
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b.take(j1, j2):
+                    yield '+' + line
+
+
+def split_lines(data):
+    """
+    returns the lines of ``data`` without their trailing newline, the way
+    the annotate commands of the revision control systems report them.
+
+    """
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def update_annotation(previous, data, rev):
+    """
+    returns the annotation, a list of ``(revision, line)`` tuples, of the
+    content ``data`` committed in ``rev``. Lines which did not change since
+    ``previous``, the annotation of the revision before, keep their
+    revision, all others are attributed to ``rev``.
+
+    """
+    lines = split_lines(data)
+    result = []
+    for tag, i1, i2, j1, j2 in get_opcodes([line for r, line in previous], lines):
+        if tag == 'equal':
+            result.extend(previous[i1:i2])
+        else:
+            result.extend([(rev, line) for line in lines[j1:j2]])
+    return result
+
+
+def get_engine():
+    """
+    returns the diff function configured in ``settings.RCS_DIFF_ENGINE``.
+
+    """
+    path = getattr(settings, 'RCS_DIFF_ENGINE', None)
+    if not path:
+        return unified_diff
+    module, attr = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)
+
+
+def diff(old, new, rev1, rev2):
+    """
+    returns a generator of unified diff lines between the contents ``old``
+    and ``new``.
+
+    """
+    return get_engine()(old.splitlines(1), new.splitlines(1),
+                        'Revision: %s' % rev1, 'Revision: %s' % rev2)
+
+
+_cache = LRUCache(getattr(settings, 'RCS_DIFF_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+
+def diff_revisions(fetch, key1, rev1, key2, rev2):
+    """
+    returns an iterator over the unified diff of ``key1``@``rev1`` against
+    ``key2``@``rev2``, fetching the contents with ``fetch``. Diffs between
+    immutable revisions are cached.
+
+    """
+    nrev1 = normalize_revision(rev1)
+    nrev2 = normalize_revision(rev2)
+    if nrev1 is None or nrev2 is None or not _cache.max_bytes:
+        return diff(fetch(key1, rev1), fetch(key2, rev2), rev1, rev2)
+    cache_key = (key1, nrev1, key2, nrev2)
+    lines = _cache.get(cache_key)
+    if lines is None:
+        lines = list(diff(fetch(key1, rev1), fetch(key2, rev2), rev1, rev2))
+        _cache.set(cache_key, lines, sum([len(l) for l in lines]))
+    return iter(lines)
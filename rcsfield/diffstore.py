@@ -0,0 +1,233 @@
+"""
+Precomputed diffs between consecutive revisions for django-rcsfield.
+
+Nearly all diffs shown (e.g. by the ``historytrail`` links) compare a
+revision of a key with the previous one. ``DiffStoreBackend`` wraps the
+backend module selected by ``settings.RCS_BACKEND``, computes that diff
+once on ``commit``, while the new content is in memory anyway, and keeps
+it zlib compressed in a local SQLite file. ``diff`` of two consecutive
+revisions of a key is then answered without fetching or diffing anything.
+
+Enable it in your settings::
+
+    RCS_DIFF_STORE = True
+    RCS_DIFF_STORE_PATH = '/var/lib/rcsfield/diffs.db'
+
+Diffs of other revision pairs and of revisions committed before the store
+was enabled are computed by the backend as usual.
+
+The store remembers the head revision of every key it saw committed, so
+the previous revision of a commit is usually known without asking the
+backend. That is only a hint, other processes may have committed the key
+meanwhile: the old content is always fetched at the revision the diff is
+stored for, so a stored diff is correct for its revision pair even if it
+does not span a single change. Errors of the store are logged on the
+``rcsfield`` logger, they never fail a commit.
+
+"""
+
+import zlib
+import marshal
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from rcsfield.cache import normalize_revision
+from rcsfield.diff import diff
+from rcsfield.sqlitestore import SQLiteStore
+
+
+logger = logging.getLogger('rcsfield')
+
+
+class DiffStore(SQLiteStore):
+    """
+    Diffs of keys against their previous revision. Only the hunks are
+    stored, the ``---``/``+++`` header is added when a diff is read, with
+    the revisions as the caller passed them.
+
+    """
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS rcs_diffs ('
+                     'key TEXT NOT NULL, revision TEXT NOT NULL, previous TEXT NOT NULL, '
+                     'hunks BLOB NOT NULL, PRIMARY KEY (key, revision))')
+        conn.execute('CREATE TABLE IF NOT EXISTS rcs_heads ('
+                     'key TEXT NOT NULL PRIMARY KEY, revision TEXT NOT NULL)')
+        conn.commit()
+
+    def add(self, key, previous, rev, lines):
+        """
+        stores ``lines`` of the diff of ``key`` from ``previous`` to
+        ``rev`` and ``rev`` as the head revision of ``key``.
+
+        """
+        hunks = buffer(zlib.compress(marshal.dumps(list(lines)[2:])))
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO rcs_diffs (key, revision, previous, hunks) '
+                     'VALUES (?, ?, ?, ?)', (key.decode('utf-8'), rev, previous, hunks))
+        conn.execute('INSERT OR REPLACE INTO rcs_heads (key, revision) VALUES (?, ?)',
+                     (key.decode('utf-8'), rev))
+        conn.commit()
+
+    def head(self, key):
+        """
+        returns the head revision of ``key`` or ``None`` if it is not known.
+
+        """
+        row = self.connection().execute('SELECT revision FROM rcs_heads WHERE key = ?',
+                                        (key.decode('utf-8'),)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def set_head(self, key, rev):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO rcs_heads (key, revision) VALUES (?, ?)',
+                     (key.decode('utf-8'), rev))
+        conn.commit()
+
+    def get(self, key, previous, rev):
+        """
+        returns the hunks of the diff of ``key`` from ``previous`` to
+        ``rev`` or ``None`` if it is not stored.
+
+        """
+        row = self.connection().execute(
+            'SELECT hunks FROM rcs_diffs WHERE key = ? AND revision = ? AND previous = ?',
+            (key.decode('utf-8'), rev, previous)).fetchone()
+        if row is None:
+            return None
+        return marshal.loads(zlib.decompress(row[0]))
+
+    def move(self, key_from, key_to):
+        conn = self.connection()
+        conn.execute('UPDATE rcs_diffs SET key = ? WHERE key = ?',
+                     (key_to.decode('utf-8'), key_from.decode('utf-8')))
+        # the move is a new revision of ``key_to``, its head is not known
+        conn.execute('DELETE FROM rcs_heads WHERE key = ?', (key_from.decode('utf-8'),))
+        conn.commit()
+
+    def clear(self):
+        conn = self.connection()
+        conn.execute('DELETE FROM rcs_diffs')
+        conn.execute('DELETE FROM rcs_heads')
+        conn.commit()
+
+
+
+class DiffStoreBackend(object):
+    """
+    Wraps a backend module, stores the diff against the previous revision
+    of every committed key and answers ``diff`` of consecutive revisions
+    from the ``DiffStore``. Everything else is passed through to the
+    wrapped backend.
+
+    """
+
+    def __init__(self, backend, path=None):
+        if path is None:
+            path = getattr(settings, 'RCS_DIFF_STORE_PATH', None)
+        if not path:
+            raise ImproperlyConfigured("RCS_DIFF_STORE_PATH must be set to store diffs.")
+        self.backend = backend
+        self.store = DiffStore(path)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _head(self, key):
+        try:
+            return self.store.head(key)
+        except Exception:
+            logger.exception("rcsfield: reading the head of %s from the diff store failed" % key)
+            return None
+
+    def commit(self, key, data):
+        previous = self._head(key)
+        rev = self.backend.commit(key, data)
+        if rev is not None:
+            self._store_diff(key, previous, data, rev)
+        return rev
+
+    def commit_many(self, items):
+        previous = dict([(key, self._head(key)) for key, data in items])
+        rev = self.backend.commit_many(items)
+        if rev is not None:
+            for key, data in items:
+                self._store_diff(key, previous[key], data, rev)
+        return rev
+
+    def bulk_import(self, chunks):
+        result = self.backend.bulk_import(chunks)
+        for keys, rev in result:
+            if rev is None:
+                continue
+            for key in keys:
+                try:
+                    self.store.set_head(key, normalize_revision(rev))
+                except Exception:
+                    logger.exception("rcsfield: updating the head of %s in the diff store failed" % key)
+        return result
+
+    def _store_diff(self, key, previous, data, rev):
+        """
+        stores the diff of ``key`` from revision ``previous`` against
+        ``data`` committed in ``rev``. ``previous`` is the head revision of
+        ``key`` before the commit as recorded by the store, the backend is
+        only asked for keys the store did not see committed yet. The old
+        content is fetched at ``previous``, so the diff is stored for the
+        revisions it was computed from.
+
+        """
+        nrev = normalize_revision(rev)
+        if nrev is None:
+            return
+        try:
+            if previous is None:
+                revs = self.backend.get_revisions(key, 1)
+                if revs:
+                    previous = normalize_revision(revs[0])
+            if previous is None:
+                self.store.set_head(key, nrev) # new key
+                return
+            if previous == nrev:
+                return
+            old = self.backend.fetch(key, previous)
+            if old == data:
+                return # unchanged key
+            self.store.add(key, previous, nrev, diff(old, data, previous, rev))
+        except Exception:
+            logger.exception("rcsfield: storing the diff of %s in %s failed" % (key, rev))
+
+    def diff(self, key1, rev1, key2, rev2):
+        nrev1 = normalize_revision(rev1)
+        nrev2 = normalize_revision(rev2)
+        if key1 == key2 and nrev1 is not None and nrev2 is not None:
+            hunks = self.store.get(key1, nrev1, nrev2)
+            if hunks is not None:
+                if not hunks:
+                    return iter([])
+                return iter(['--- Revision: %s\n' % rev1, '+++ Revision: %s\n' % rev2] + hunks)
+        return self.backend.diff(key1, rev1, key2, rev2)
+
+    def move(self, key_from, key_to):
+        rev = self.backend.move(key_from, key_to)
+        if rev:
+            self.store.move(key_from, key_to)
+        return rev
+
+    def move_many(self, moves):
+        rev = self.backend.move_many(moves)
+        if rev:
+            for key_from, key_to in moves:
+                self.store.move(key_from, key_to)
+        return rev
+
+    def clear_diffs(self):
+        """
+        drops all stored diffs, e.g. after the history was compacted.
+
+        """
+        self.store.clear()
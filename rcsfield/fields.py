@@ -3,14 +3,181 @@ from django.conf import settings
 from django.db.models import signals, TextField
 from django.utils.functional import curry
 from django.utils import simplejson as json
+from django.utils.hashcompat import md5_constructor
 
 from manager import RevisionManager
 
 from rcsfield.backends import backend
+from rcsfield import writebehind
+from rcsfield import transactions
+from rcsfield import diff as rcsdiff
 from rcsfield.widgets import RcsTextFieldWidget, JsonWidget
 
 
 
+class RevisionCoordinator(object):
+    """
+    Commits all versioned fields of a model instance together.
+
+    Every model with at least one ``RcsTextField`` gets one coordinator,
+    which is connected to ``post_save`` and commits the changed fields of
+    the saved instance as a single changeset via ``backend.commit_many``.
+
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = []
+
+
+    def post_save(self, instance=None, created=False, **kwargs):
+        """
+        commit the content of all versioned fields to the repository.
+        called via post_save signal
+
+        fields whose content did not change since it was loaded from the
+        db (by a ``RevisionManager``) or last committed are left out.
+
+        """
+        items = []
+        digests = []
+        for field in self.fields:
+            if not created and (field.attname not in instance.__dict__ or
+                                instance.__dict__.get(field.loaded_attname)):
+                # deferred and never loaded, or loaded and never accessed
+                field.skipped_commits += 1
+                continue
+            data = field.get_rcsdata(instance)
+            digest = field.get_rcsdigest(data)
+            if not created and getattr(instance, field.digest_attname, None) == digest:
+                field.skipped_commits += 1
+                continue
+            items.append((field.get_rcskey(instance), data))
+            digests.append((field.digest_attname, digest))
+        if not items:
+            return
+        self.commit(items)
+        for attname, digest in digests:
+            setattr(instance, attname, digest)
+
+
+    def commit(self, items):
+        """
+        commits ``items``, a list of ``(key, data)`` tuples, in one
+        changeset. They are buffered until the end of the transaction if
+        transaction-scoped commits are enabled (see
+        ``rcsfield.transactions``) or queued when write-behind is enabled
+        (see ``rcsfield.writebehind``).
+
+        """
+        if transactions.active():
+            transactions.add(items)
+        elif writebehind.enabled():
+            for key, data in items:
+                writebehind.put(key, data)
+        elif len(items) == 1:
+            backend.commit(*items[0])
+        else:
+            backend.commit_many(items)
+
+
+    def get_changed_revisions(self, instance, limit=None, before=None):
+        """
+        returns all revisions in which any versioned field of ``instance``
+        changed, newest first and without the head revision. With ``limit``
+        only the newest ``limit`` revisions are returned, with ``before``
+        only the ones older than that revision.
+
+        """
+        keys = [field.get_rcskey(instance) for field in self.fields]
+        if len(keys) == 1:
+            return backend.get_revisions(keys[0], limit=limit, before=before)
+        return backend.get_revisions_many(keys, limit=limit, before=before)
+
+
+    def get_revision_log(self, instance, limit=None):
+        """
+        returns the merged ``get_revision_log`` of all versioned fields of
+        ``instance``, newest first and including the head revision. The
+        ``size`` of an entry is the total size of the fields changed in it.
+
+        """
+        keys = [field.get_rcskey(instance) for field in self.fields]
+        if len(keys) == 1:
+            return backend.get_revision_log(keys[0], limit)
+        merged = {}
+        for key in keys:
+            for entry in backend.get_revision_log(key, limit):
+                other = merged.get(entry['revision'])
+                if other is None:
+                    merged[entry['revision']] = dict(entry)
+                elif other['size'] is not None and entry['size'] is not None:
+                    other['size'] += entry['size']
+        log = [(entry['timestamp'], entry) for entry in merged.values()]
+        log.sort(reverse=True)
+        log = [entry for timestamp, entry in log]
+        if limit:
+            log = log[:limit]
+        return log
+
+
+
+class RevisionDescriptor(object):
+    """
+    Attribute descriptor for versioned fields.
+
+    Behaves like a plain attribute which runs ``field.to_python`` on
+    assignment (like ``models.SubfieldBase``), but can also hold a pending
+    historical value: ``RevisionQuerySet`` registers a loader with
+    ``set_loader`` and the content is only fetched from the backend when
+    the attribute is accessed for the first time.
+
+    Content loaded from the db is only hashed when it is accessed for the
+    first time (see ``RcsTextField.mark_loaded``), until then it can not
+    have changed.
+
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.loader_attname = '_%s_rcsloader' % field.attname
+
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        pending = instance.__dict__.pop(self.loader_attname, None)
+        if pending is not None:
+            loader, key = pending
+            try:
+                instance.__dict__[self.field.attname] = self.field.to_python(unicode(loader(key), 'utf-8'))
+            except:
+                # for now just ignore errors raised in the backend
+                # and return the content from the db (aka head revision)
+                instance.__dict__.pop('%s_revision' % self.field.attname, None)
+        if instance.__dict__.pop(self.field.loaded_attname, False):
+            # remember the content loaded from the db before it can change
+            self.field.set_rcsdigest(instance)
+        return instance.__dict__[self.field.attname]
+
+
+    def __set__(self, instance, value):
+        instance.__dict__.pop(self.loader_attname, None)
+        instance.__dict__.pop(self.field.loaded_attname, None)
+        instance.__dict__[self.field.attname] = self.field.to_python(value)
+
+
+    def set_loader(self, instance, loader, key, rev):
+        """
+        replace the value on ``instance`` with ``loader(key)`` on first
+        access. ``rev`` is the revision the loader fetches.
+
+        """
+        instance.__dict__[self.loader_attname] = (loader, key)
+        instance.__dict__['%s_revision' % self.field.attname] = rev
+
+
+
 class RcsTextField(models.TextField):
     """
     save contents of the TextField in a revison control repository.
@@ -48,6 +215,7 @@ class RcsTextField(models.TextField):
         else:
             self.rcskey_format = "%s/%s/%s/%s.txt"
         self.IS_VERSIONED = True # so we can figure out that this field is versionized
+        self.skipped_commits = 0 # saves which did not change the content
         TextField.__init__(self, *args, **kwargs)
 
 
@@ -55,43 +223,85 @@ class RcsTextField(models.TextField):
         return "TextField"
 
 
-    def post_save(self, instance=None, **kwargs):
+    def get_rcskey(self, instance):
         """
-        create a file and add to the repository, if not already existing
-        called via post_save signal
+        returns the key under which the content of this field is
+        versionized for ``instance``.
 
         """
-        data = getattr(instance, self.attname)
-        key = self.rcskey_format % (instance._meta.app_label,
-                                    instance.__class__.__name__,
-                                    self.attname,instance.id)
-        try:
-            backend.commit(key, data.encode('utf-8'))
-        except:
-            raise
+        return self.rcskey_format % (instance._meta.app_label,
+                                     instance.__class__.__name__,
+                                     self.attname, instance.pk)
 
 
-    def get_changed_revisions(self, instance, field):
+    def get_rcsdata(self, instance):
         """
-        FIXME: for now this returns the same as get_FIELD_revisions, later
-        on it should return all revisions where _any_ rcsfield on the model
-        changed.
+        returns the content of this field on ``instance`` as it is
+        committed to the repository.
+
+        """
+        return getattr(instance, self.attname).encode('utf-8')
+
+
+    def get_rcsdigest(self, data):
+        return md5_constructor(data).hexdigest()
 
+
+    def mark_loaded(self, instance):
+        """
+        marks the content of this field on ``instance`` as loaded from the
+        db. Its digest is taken on first access, so post_save can tell
+        whether the content changed. Instances created by the user are
+        never marked, their content is always committed.
+
+        """
+        if self.attname in instance.__dict__:
+            instance.__dict__[self.loaded_attname] = True
+
+
+    def set_rcsdigest(self, instance):
+        if instance.__dict__.get(self.attname) is not None:
+            setattr(instance, self.digest_attname,
+                    self.get_rcsdigest(self.get_rcsdata(instance)))
+
+
+    def get_changed_revisions(self, instance, field, limit=None, before=None):
         """
-        return backend.get_revisions(self.rcskey_format % (instance._meta.app_label,
-                                                           instance.__class__.__name__,
-                                                           field.attname,
-                                                           instance.id))
+        returns all revisions where _any_ rcsfield on the model changed.
 
+        """
+        return instance._rcs_coordinator.get_changed_revisions(instance, limit, before)
 
-    def get_FIELD_revisions(self, instance, field):
-        return backend.get_revisions(self.rcskey_format % (instance._meta.app_label,
-                                                           instance.__class__.__name__,
-                                                           field.attname,
-                                                           instance.id))
 
+    def get_revision_log(self, instance, field, limit=None):
+        """
+        returns author, timestamp, message and size of the revisions where
+        _any_ rcsfield on the model changed, including the head revision.
 
-    def get_FIELD_diff(self, instance, rev1, rev2=None, field=None):
+        """
+        return instance._rcs_coordinator.get_revision_log(instance, limit)
+
+
+    def get_FIELD_revision_log(self, instance, field, limit=None):
+        return backend.get_revision_log(field.get_rcskey(instance), limit)
+
+
+    def get_FIELD_revisions(self, instance, field, limit=None, before=None, after=None):
+        return backend.get_revisions(field.get_rcskey(instance), limit, before, after)
+
+
+    def get_FIELD_annotate(self, instance, rev='head', field=None):
+        """
+        Returns a list of ``(revision, line)`` tuples with the revision in
+        which each line of the field ``field`` at revision ``rev`` was last
+        changed.
+
+        """
+        return [(r, unicode(line, 'utf-8'))
+                for r, line in backend.annotate(field.get_rcskey(instance), rev)]
+
+
+    def get_FIELD_diff(self, instance, rev1, rev2=None, field=None, stream=False):
         """
         Returns a generator which yields lines of a textual diff between
         two revisions.
@@ -105,6 +315,11 @@ class RcsTextField(models.TextField):
            the field ``field`` at revision 7 against revision 3..
            Direction is ---3/+++7
 
+        With ``stream=True`` the revisions are streamed from the repository
+        and diffed with bounded memory, for very large contents. Like
+        without it, ``rev2='head'`` diffs against the content of the
+        field on ``instance``, which may not be saved yet.
+
         """
 
 
@@ -114,40 +329,38 @@ class RcsTextField(models.TextField):
         if rev1 == rev2: #do not attempt to diff identical content for performance reasons
             return ""
 
+        key = field.get_rcskey(instance)
+        if stream:
+            if rev2 == 'head':
+                data = field.get_rcsdata(instance)
+                return rcsdiff.stream_diff(lambda: rcsdiff.iter_lines(backend.fetch_stream(key, rev1)),
+                                           lambda: rcsdiff.iter_lines([data]),
+                                           'Revision: %s' % rev1, 'Revision: %s' % rev2)
+            return backend.diff_stream(key, rev1, key, rev2)
+
         if rev2 == 'head':
-            import difflib
-            old = backend.fetch(self.rcskey_format % (instance._meta.app_label,
-                                                      instance.__class__.__name__,
-                                                      field.attname,
-                                                      instance.id),
-                                rev1,
-                               )
-            diff = difflib.unified_diff(old.splitlines(1),
-                                       getattr(instance, field.attname).splitlines(1),
-                                       'Revision: %s' % rev1,
-                                       'Revision: %s' % getattr(instance, "%s_revision" % field.attname, 'head'),
-                                       )
-            return diff
+            old = backend.fetch(key, rev1)
+            return rcsdiff.diff(old, getattr(instance, field.attname), rev1,
+                                getattr(instance, "%s_revision" % field.attname, 'head'))
 
         else: #diff two arbitrary revisions
-            return backend.diff(self.rcskey_format % (instance._meta.app_label,
-                                                      instance.__class__.__name__,
-                                                      field.attname,
-                                                      instance.id),
-                                rev1,
-                                self.rcskey_format % (instance._meta.app_label,
-                                                      instance.__class__.__name__,
-                                                      field.attname,
-                                                      instance.id),
-                                rev2,
-                               )
+            return backend.diff(key, rev1, key, rev2)
 
     def contribute_to_class(self, cls, name):
         super(RcsTextField, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, RevisionDescriptor(self))
         setattr(cls, 'get_%s_revisions' % self.name, curry(self.get_FIELD_revisions, field=self))
         setattr(cls, 'get_changed_revisions', curry(self.get_changed_revisions, field=self))
+        setattr(cls, 'get_%s_revision_log' % self.name, curry(self.get_FIELD_revision_log, field=self))
+        setattr(cls, 'get_revision_log', curry(self.get_revision_log, field=self))
         setattr(cls, 'get_%s_diff' % self.name, curry(self.get_FIELD_diff, field=self))
-        signals.post_save.connect(self.post_save, sender=cls)
+        setattr(cls, 'get_%s_annotate' % self.name, curry(self.get_FIELD_annotate, field=self))
+        self.digest_attname = '_%s_rcsdigest' % self.attname
+        self.loaded_attname = '_%s_rcsloaded' % self.attname
+        if getattr(cls, '_rcs_coordinator', None) is None or cls._rcs_coordinator.model is not cls:
+            cls._rcs_coordinator = RevisionCoordinator(cls)
+            signals.post_save.connect(cls._rcs_coordinator.post_save, sender=cls)
+        cls._rcs_coordinator.fields.append(self)
 
 
     #def formfield(self, **kwargs):
@@ -160,9 +373,10 @@ class RcsTextField(models.TextField):
 class RcsJsonField(RcsTextField):
     """
     Save arbitrary data structures serialized as json and versionize them.
+    Values are converted with ``to_python`` on assignment by the
+    ``RevisionDescriptor`` of ``RcsTextField``.
 
     """
-    __metaclass__ = models.SubfieldBase
 
     def to_python(self, value):
         if value == "":
@@ -185,17 +399,5 @@ class RcsJsonField(RcsTextField):
         defaults.update({'widget': JsonWidget}) # needs to be here and not in the form-field because otherwise contrib.admin will override our widget
         return super(RcsJsonField, self).formfield(**defaults)
 
-    def post_save(self, instance=None, **kwargs):
-        """
-        create a file and add to the repository, if not already existing
-        called via post_save signal
-
-        """
-        data = getattr(instance, self.attname)
-        key = self.rcskey_format % (instance._meta.app_label,
-                                    instance.__class__.__name__,
-                                    self.attname,instance.id)
-        try:
-            backend.commit(key, json.dumps(data)) #.decode().encode('utf-8'))
-        except:
-            raise
+    def get_rcsdata(self, instance):
+        return json.dumps(getattr(instance, self.attname)) #.decode().encode('utf-8')
@@ -0,0 +1,249 @@
+"""
+Persistent revision index for django-rcsfield.
+
+Asking the revision control backend for the revisions of a key means
+walking (parts of) the repository history. ``IndexedBackend`` wraps the
+backend module selected by ``settings.RCS_BACKEND`` and records every
+``commit`` and ``move`` in the ``RevisionIndex`` table, so that
+``get_revisions`` becomes a single indexed query.
+
+Enable it in your settings::
+
+    RCS_INDEX = True
+
+and build the index for already existing history with::
+
+    ./manage.py rebuild_rcsindex
+
+Only keys whose complete history is indexed (``IndexedKey``) are answered
+from the index: keys rebuilt by ``rebuild_rcsindex`` and keys created
+while the index was enabled. All other keys are answered by the backend,
+even if some of their later commits were recorded already.
+
+``get_revision_log`` is answered from the index as well, it only knows
+revisions and timestamps, ``author``, ``message`` and ``size`` are
+``None``.
+
+"""
+
+import datetime
+
+from django.db.models import Max
+
+from rcsfield.backends.base import log_entry
+
+
+def _to_revision(value):
+    """
+    revisions are stored as strings, give numeric revisions back as ints
+    like the backends do.
+
+    """
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+class IndexedBackend(object):
+    """
+    Wraps a backend module, keeps the ``RevisionIndex`` up to date on
+    ``commit`` and ``move`` and answers ``get_revisions`` and
+    ``get_revision_log`` of fully indexed keys from it.
+
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def commit(self, key, data):
+        rev = self.backend.commit(key, data)
+        if rev is not None:
+            self.add(key, rev, new=True)
+        return rev
+
+    def commit_many(self, items):
+        rev = self.backend.commit_many(items)
+        if rev is not None:
+            for key, data in items:
+                self.add(key, rev, new=True)
+        return rev
+
+    def bulk_import(self, chunks):
+        """
+        indexes the imported revisions. Keys without content before the
+        import (one ``fetch_many`` per chunk) are created by it and marked
+        as fully indexed.
+
+        """
+        from rcsfield.models import IndexedKey
+        created = {}
+        def check(chunks):
+            for chunk in chunks:
+                if chunk:
+                    keys = [key for key, data in chunk]
+                    heads = self.backend.fetch_many(keys, 'head')
+                    for key in keys:
+                        if not heads.get(key) and not self.is_indexed(key):
+                            created[key] = True
+                yield chunk
+        result = self.backend.bulk_import(check(chunks))
+        for keys, rev in result:
+            if rev is not None:
+                for key in keys:
+                    if created.pop(key, False):
+                        IndexedKey.objects.get_or_create(key=key)
+                    self.add(key, rev)
+        return result
+
+    def move(self, key_from, key_to):
+        rev = self.backend.move(key_from, key_to)
+        if rev:
+            from rcsfield.models import RevisionIndex, IndexedKey
+            RevisionIndex.objects.filter(key=key_from).update(key=key_to)
+            IndexedKey.objects.filter(key=key_from).update(key=key_to)
+            self.add(key_to, rev)
+        return rev
+
+    def move_many(self, moves):
+        rev = self.backend.move_many(moves)
+        if rev:
+            from rcsfield.models import RevisionIndex, IndexedKey
+            sources = dict(moves)
+            indexed = set(RevisionIndex.objects.filter(key__in=sources.keys() + sources.values())
+                                               .values_list('key', flat=True).distinct())
+            for key_from, key_to in moves:
+                if key_to in indexed:
+                    continue # skipped by the backend
+                if key_from in indexed:
+                    RevisionIndex.objects.filter(key=key_from).update(key=key_to)
+                    IndexedKey.objects.filter(key=key_from).update(key=key_to)
+                self.add(key_to, rev)
+        return rev
+
+    def is_indexed(self, key):
+        """
+        returns ``True`` if the complete history of ``key`` is indexed.
+
+        """
+        from rcsfield.models import IndexedKey
+        return IndexedKey.objects.filter(key=key).exists()
+
+    def get_revisions(self, key, limit=None, before=None, after=None):
+        from rcsfield.models import RevisionIndex
+        if not self.is_indexed(key):
+            return self.backend.get_revisions(key, limit, before, after)
+        rows = RevisionIndex.objects.filter(key=key)
+        for bound, lookup in ((before, 'sequence__lt'), (after, 'sequence__gt')):
+            if bound is not None:
+                try:
+                    sequence = rows.get(revision=str(bound)).sequence
+                except (RevisionIndex.DoesNotExist, RevisionIndex.MultipleObjectsReturned):
+                    return self.backend.get_revisions(key, limit, before, after)
+                rows = rows.filter(**{lookup: sequence})
+        revs = rows.values_list('revision', flat=True)
+        if limit:
+            revs = revs[:limit + (before is None)]
+        revs = [_to_revision(r) for r in revs]
+        if before is None:
+            revs = revs[1:] # cut of the head revision-number
+        return revs
+
+    def get_revision_log(self, key, limit=None):
+        """
+        answers from the index if ``key`` is fully indexed, without author,
+        message and size.
+
+        """
+        from rcsfield.models import RevisionIndex
+        if not self.is_indexed(key):
+            return self.backend.get_revision_log(key, limit)
+        rows = RevisionIndex.objects.filter(key=key).values_list('revision', 'timestamp')
+        if limit:
+            rows = rows[:limit]
+        return [log_entry(_to_revision(rev), timestamp) for rev, timestamp in rows]
+
+    def get_revisions_many(self, keys, limit=None, before=None):
+        """
+        answers with a single query if all ``keys`` are indexed.
+
+        """
+        from rcsfield.models import RevisionIndex, IndexedKey
+        if IndexedKey.objects.filter(key__in=keys).count() < len(dict.fromkeys(keys)):
+            return self.backend.get_revisions_many(keys, limit, before)
+        rows = RevisionIndex.objects.filter(key__in=keys)
+        if before is not None:
+            bound = rows.filter(revision=str(before)).values_list('timestamp', flat=True)[:1]
+            if not bound:
+                return self.backend.get_revisions_many(keys, limit, before)
+            rows = rows.filter(timestamp__lte=bound[0]).exclude(revision=str(before))
+        rows = rows.order_by('-timestamp', '-sequence').values_list('revision', flat=True)
+        if limit:
+            # every revision has at most one row per key
+            rows = rows[:(limit + 1) * len(keys)]
+        revs = []
+        seen = {}
+        for rev in rows:
+            if rev not in seen:
+                seen[rev] = True
+                revs.append(_to_revision(rev))
+        if before is None:
+            revs = revs[1:] # cut of the head revision-number
+        if limit:
+            revs = revs[:limit]
+        return revs
+
+    def get_indexed_revisions(self, key):
+        """
+        returns all indexed revisions of ``key`` newest first (including
+        head) or ``None`` if ``key`` is not indexed.
+
+        """
+        from rcsfield.models import RevisionIndex
+        if not self.is_indexed(key):
+            return None
+        revs = RevisionIndex.objects.filter(key=key).values_list('revision', flat=True)
+        return [_to_revision(r) for r in revs]
+
+    def add(self, key, rev, timestamp=None, new=False):
+        """
+        records that ``key`` changed in revision ``rev``. With ``new`` the
+        key is marked as fully indexed if ``rev`` is its first revision.
+
+        """
+        from rcsfield.models import RevisionIndex, IndexedKey
+        if new and not self.is_indexed(key) and not self.backend.get_revisions(key, 1):
+            IndexedKey.objects.get_or_create(key=key)
+        rev = str(rev)
+        if rev.isdigit():
+            sequence = int(rev)
+        else:
+            last = RevisionIndex.objects.filter(key=key).aggregate(Max('sequence'))['sequence__max']
+            sequence = (last or 0) + 1
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        RevisionIndex.objects.create(key=key, revision=rev, sequence=sequence,
+                                     timestamp=timestamp)
+
+    def rebuild(self, key):
+        """
+        replaces the index entries of ``key`` with its history as recorded
+        by the backend.
+
+        """
+        from rcsfield.models import RevisionIndex, IndexedKey
+        history = self.backend.get_history(key)
+        RevisionIndex.objects.filter(key=key).delete()
+        IndexedKey.objects.get_or_create(key=key)
+        count = len(history)
+        for position, (rev, timestamp) in enumerate(history):
+            rev = str(rev)
+            if rev.isdigit():
+                sequence = int(rev)
+            else:
+                sequence = count - position
+            RevisionIndex.objects.create(key=key, revision=rev, sequence=sequence,
+                                         timestamp=timestamp)
+        return count
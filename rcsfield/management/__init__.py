@@ -6,7 +6,7 @@ into django's syncdb process
 import os
 from django.conf import settings
 from django.db.models import get_models, signals
-from fields import RcsTextField
+from rcsfield.fields import RcsTextField
 
 
 
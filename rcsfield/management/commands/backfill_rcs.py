@@ -0,0 +1,78 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+
+
+def _chunks(backend, model, fields, chunk_size, start_pk, stats, verbosity):
+    """
+    yields lists of ``(key, data)`` tuples for the versioned fields of all
+    rows of ``model``, ``chunk_size`` rows at a time in primary key order.
+    content which is already the head revision in the repository is left out.
+
+    """
+    rows = model._default_manager.order_by('pk')
+    last_pk = start_pk
+    while True:
+        if last_pk is None:
+            chunk = list(rows[:chunk_size])
+        else:
+            chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        items = []
+        for obj in chunk:
+            for field in fields:
+                items.append((field.get_rcskey(obj), field.get_rcsdata(obj)))
+        heads = backend.fetch_many([key for key, data in items], 'head')
+        items = [(key, data) for key, data in items if heads.get(key) != data]
+        last_pk = chunk[-1].pk
+        stats['rows'] += len(chunk)
+        stats['keys'] += len(items)
+        if verbosity >= 2:
+            sys.stderr.write("%s: %d rows, %d changed keys, last pk %s\n" % (
+                model.__name__, stats['rows'], stats['keys'], last_pk))
+        yield items
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', default=1000, type='int',
+            help='Number of rows committed per revision.'),
+        make_option('--start-pk', dest='start_pk', default=None,
+            help='Only backfill rows with a primary key greater than this, to resume an interrupted run.'),
+    )
+    help = "Commits the current content of the versioned fields of existing rows to the repository in bulk."
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        from rcsfield.backends import backend
+        verbosity = int(options['verbosity'])
+        start_pk = options.get('start_pk')
+
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.'))
+                if model is None:
+                    raise CommandError("Unknown model %r" % label)
+                models.append(model)
+        else:
+            models = get_models()
+
+        for model in models:
+            fields = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+            if not fields:
+                continue
+            first_pk = start_pk
+            if first_pk is not None:
+                first_pk = model._meta.pk.to_python(first_pk)
+            stats = {'rows': 0, 'keys': 0}
+            result = backend.bulk_import(_chunks(backend, model, fields, options['chunk_size'],
+                                                 first_pk, stats, verbosity))
+            if verbosity >= 1:
+                print "Committed %d keys of %d rows in %d revisions for %s.%s" % (
+                    stats['keys'], stats['rows'], len(result),
+                    model._meta.app_label, model.__name__)
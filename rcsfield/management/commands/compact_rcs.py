@@ -0,0 +1,148 @@
+import os, time, random
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+
+
+def _repository_size(backend):
+    """
+    returns the size in bytes of the repository of ``backend`` on disk, or
+    of the content stored by the ``db`` backend.
+
+    """
+    rcs = getattr(backend, 'rcs', None)
+    path = getattr(rcs, 'repo_path', None) or getattr(rcs, 'wc_path', None)
+    if path is None:
+        from rcsfield.models import RevisionContent
+        return sum([len(data) for data in RevisionContent.objects.values_list('data', flat=True).iterator()])
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def _measure(backend, keys, samples):
+    """
+    returns the repository size and the latency of ``fetch`` and
+    ``get_revisions`` for a sample of ``keys``. Keys which can not be
+    fetched (e.g. removed from the repository) are not timed.
+
+    """
+    from rcsfield.benchmark import summarize, timed
+    keys = random.Random(1).sample(keys, min(samples, len(keys)))
+    fetch, revisions = [], []
+    for key in keys:
+        try:
+            timed(fetch, backend.fetch, key, 'head')
+        except Exception:
+            continue
+        timed(revisions, backend.get_revisions, key)
+    return {'size': _repository_size(backend), 'fetch': summarize(fetch),
+            'get_revisions': summarize(revisions)}
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-days', dest='keep_days', default=None, type='int',
+            help='Keep all revisions of the last days, overrides RCS_RETENTION.'),
+        make_option('--snapshots', dest='snapshots', default=None,
+            type='choice', choices=['daily', 'weekly', 'monthly', 'none'],
+            help='Keep one revision per day, week or month before that, overrides RCS_RETENTION.'),
+        make_option('--no-repack', action='store_false', dest='repack', default=True,
+            help='Do not repack the repository afterwards.'),
+        make_option('--repack-only', action='store_true', dest='repack_only', default=False,
+            help='Only repack the repository, keep the history. The default for backends which can not rewrite it.'),
+        make_option('--samples', dest='samples', default=20, type='int',
+            help='Number of keys to time fetch and get_revisions on before and after.'),
+    )
+    help = "Thins out the history of versioned fields according to a retention policy and repacks the repository."
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        from rcsfield.backends import backend
+        from rcsfield.retention import Retention, get_policy
+        verbosity = int(options['verbosity'])
+
+        if options['repack_only'] or not hasattr(backend, 'compact'):
+            if not hasattr(backend, 'repack'):
+                raise CommandError("The configured backend can neither rewrite its history nor repack.")
+            if not options['repack']:
+                raise CommandError("Nothing to do, the history is not rewritten and --no-repack was given.")
+            size = _repository_size(backend)
+            start = time.time()
+            backend.repack()
+            if verbosity >= 1:
+                print "Repacked the repository in %.1fs, size %d bytes before, %d after" % (
+                    time.time() - start, size, _repository_size(backend))
+            return
+
+        override = None
+        if options['keep_days'] is not None or options['snapshots'] is not None:
+            snapshots = options['snapshots'] or 'daily'
+            if snapshots == 'none':
+                snapshots = None
+            override = Retention(options['keep_days'] or 90, snapshots)
+
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.'))
+                if model is None:
+                    raise CommandError("Unknown model %r" % label)
+                models.append(model)
+        else:
+            models = get_models()
+
+        policies = {} # key -> Retention
+        for model in models:
+            fields = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+            fields = [(f, override or get_policy(model, f)) for f in fields]
+            fields = [(f, policy) for f, policy in fields if policy is not None]
+            if not fields:
+                continue
+            for obj in model._default_manager.all().iterator():
+                for field, policy in fields:
+                    policies[field.get_rcskey(obj)] = policy
+        if not policies:
+            if verbosity >= 1:
+                print "No retention policy applies, nothing to do."
+            return
+
+        def retention(key, history):
+            policy = policies.get(key)
+            if policy is None:
+                return [rev for rev, timestamp in history]
+            return policy(key, history)
+
+        before = _measure(backend, policies.keys(), options['samples'])
+        start = time.time()
+        result = backend.compact(retention)
+        if options['repack'] and hasattr(backend, 'repack'):
+            backend.repack()
+        if hasattr(backend, 'rebuild'):
+            # revision identifiers may have changed, rebuild the whole index
+            from rcsfield.models import RevisionIndex
+            for key in list(RevisionIndex.objects.values_list('key', flat=True).distinct()):
+                backend.rebuild(key)
+        if hasattr(backend, 'clear_diffs'):
+            # the previous revisions of the stored diffs may be gone
+            backend.clear_diffs()
+        if hasattr(backend, 'reindex_search'):
+            for key in policies:
+                backend.reindex_search(key)
+        duration = time.time() - start
+        after = _measure(backend, policies.keys(), options['samples'])
+
+        if verbosity >= 1:
+            print "Compacted %d keys in %.1fs: %d revisions before, %d after" % (
+                len(policies), duration, result['revisions_before'], result['revisions_after'])
+            for name, values in (('before', before), ('after', after)):
+                print "%-6s size %10d bytes  fetch mean %.5fs  get_revisions mean %.5fs" % (
+                    name, values['size'], values['fetch'].get('mean', 0),
+                    values['get_revisions'].get('mean', 0))
@@ -0,0 +1,63 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from django.utils import simplejson as json
+
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--backends', dest='backends', default='gitcore,gitbare,bzr,svn,db',
+            help='Comma separated list of backends to benchmark. The db backend runs on a test database, like the test runner creates.'),
+        make_option('--revisions', dest='revisions', default='1000',
+            help='Comma separated list of repository sizes in revisions, e.g. 1000,10000,100000.'),
+        make_option('--keys', dest='keys', default='10,1000',
+            help='Comma separated list of numbers of keys the revisions are spread over.'),
+        make_option('--samples', dest='samples', default='100', type='int',
+            help='Number of timed calls per operation.'),
+        make_option('--model', dest='models', action='append', default=[],
+            help='app_label.ModelName to time RevisionQuerySet iteration and diff_view on, using the configured backend. May be given more than once.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the json results to, defaults to stdout.'),
+    )
+    help = "Benchmarks the rcsfield backends on synthetic repositories and writes the results as json."
+
+    def handle(self, *args, **options):
+        from rcsfield import benchmark
+        verbosity = int(options['verbosity'])
+        backends = [b for b in options['backends'].split(',') if b]
+        for name in backends:
+            if name not in benchmark.BACKENDS:
+                raise CommandError("Unknown backend %r, choose from %s" % (name, ', '.join(benchmark.BACKENDS.keys())))
+
+        results = []
+        for name in backends:
+            for revisions in [int(r) for r in options['revisions'].split(',')]:
+                for keys in [int(k) for k in options['keys'].split(',')]:
+                    if verbosity >= 1:
+                        sys.stderr.write("%s: %d revisions over %d keys\n" % (name, revisions, keys))
+                    try:
+                        results.extend(benchmark.run_backend(name, revisions, keys, options['samples']))
+                    except ImportError, e:
+                        sys.stderr.write("skipping %s: %s\n" % (name, e))
+                        break
+
+        for label in options['models']:
+            model = get_model(*label.split('.'))
+            if model is None:
+                raise CommandError("Unknown model %r" % label)
+            results.extend(benchmark.run_model(model, options['samples']))
+
+        if verbosity >= 2:
+            for r in [r for r in results if r['count']]:
+                sys.stderr.write("%(operation)-28s %(count)6d calls  mean %(mean).5fs  p95 %(p95).5fs\n" % r)
+
+        output = json.dumps({'environment': benchmark.environment(), 'results': results}, indent=2)
+        if options['output']:
+            fobj = open(options['output'], 'w')
+            fobj.write(output)
+            fobj.close()
+        else:
+            print output
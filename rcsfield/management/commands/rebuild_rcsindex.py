@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import get_models
+
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the rcsfield revision index from the history in the repository."
+
+    def handle_noargs(self, **options):
+        from rcsfield.backends import backend
+        verbosity = int(options['verbosity'])
+
+        if not hasattr(backend, 'rebuild'):
+            raise CommandError("The revision index is not enabled, set RCS_INDEX = True in your settings.")
+
+        for model in get_models():
+            fields = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+            if not fields:
+                continue
+            keys = revisions = 0
+            for obj in model._default_manager.all().iterator():
+                for field in fields:
+                    revisions += backend.rebuild(field.get_rcskey(obj))
+                    keys += 1
+            if verbosity >= 1:
+                print "Indexed %d revisions of %d keys for %s.%s" % (revisions, keys,
+                                                                     model._meta.app_label,
+                                                                     model.__name__)
@@ -0,0 +1,66 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', dest='clear', default=False,
+            help='Empty the search index first, this also drops the history of deleted objects.'),
+        make_option('--start-pk', dest='start_pk', default=None,
+            help='Only index rows with a primary key greater than this, to resume an interrupted run.'),
+        make_option('--optimize', action='store_true', dest='optimize', default=False,
+            help='Only drop stale entries and merge the index, keeping the history of deleted objects.'),
+    )
+    help = "Adds every revision of the versioned fields of existing rows to the full-text search index."
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        from rcsfield.backends import backend
+        verbosity = int(options['verbosity'])
+        start_pk = options.get('start_pk')
+
+        if not hasattr(backend, 'reindex_search'):
+            raise CommandError("The search index is not enabled, set RCS_SEARCH = True in your settings.")
+
+        if options['optimize']:
+            count = backend.optimize_search()
+            if verbosity >= 1:
+                print "Optimized the search index, %d entries" % count
+            return
+
+        if args:
+            models = []
+            for label in args:
+                model = get_model(*label.split('.'))
+                if model is None:
+                    raise CommandError("Unknown model %r" % label)
+                models.append(model)
+        else:
+            models = get_models()
+
+        if options['clear']:
+            backend.index.clear()
+
+        for model in models:
+            fields = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+            if not fields:
+                continue
+            rows = model._default_manager.order_by('pk')
+            if start_pk is not None:
+                rows = rows.filter(pk__gt=model._meta.pk.to_python(start_pk))
+            keys = revisions = 0
+            for obj in rows.iterator():
+                for field in fields:
+                    revisions += backend.reindex_search(field.get_rcskey(obj))
+                    keys += 1
+                if verbosity >= 2:
+                    sys.stderr.write("%s: %d keys, %d revisions, last pk %s\n" % (
+                        model.__name__, keys, revisions, obj.pk))
+            if verbosity >= 1:
+                print "Indexed %d revisions of %d keys for %s.%s" % (revisions, keys,
+                                                                     model._meta.app_label,
+                                                                     model.__name__)
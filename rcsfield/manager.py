@@ -1,3 +1,5 @@
+import threading
+
 from django.db import models, backend, connection, transaction
 from django.conf import settings
 from django.db.models.query import QuerySet
@@ -10,6 +12,68 @@ except ImportError:
 from rcsfield.backends import backend
 
 
+def _get_descriptor(cls, attname):
+    """
+    returns the descriptor of ``attname`` on ``cls`` or its bases.
+
+    """
+    for klass in cls.__mro__:
+        if attname in klass.__dict__:
+            return klass.__dict__[attname]
+    raise AttributeError(attname)
+
+
+def _versioned_fields(model):
+    return [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+
+
+
+class RevisionLoader(object):
+    """
+    Fetches the contents of ``keys`` at revision ``rev`` with one
+    ``fetch_many`` call the first time any of them is needed.
+
+    """
+
+    def __init__(self, keys, rev):
+        self.keys = keys
+        self.rev = rev
+        self.data = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        fetches the contents, unless that already happened. Safe to call
+        from a worker thread while the objects are being accessed.
+
+        """
+        self._lock.acquire()
+        try:
+            if self.data is not None:
+                return
+            try:
+                if hasattr(backend, 'fetch_many'):
+                    self.data = backend.fetch_many(self.keys, self.rev)
+                else:
+                    # external backends may not implement fetch_many
+                    data = {}
+                    for k in self.keys:
+                        try:
+                            data[k] = backend.fetch(k, self.rev)
+                        except:
+                            pass
+                    self.data = data
+            except:
+                self.data = {}
+        finally:
+            self._lock.release()
+
+    def __call__(self, key):
+        self.load()
+        return self.data[key]
+
+
+
 class RevisionQuerySet(QuerySet):
     """
     subclasses QuerySet to fetch older revisions from rcs backend
@@ -25,20 +89,98 @@ class RevisionQuerySet(QuerySet):
         wraps the original iterator and replaces versioned fields with the
         apropriate data from the given revision
 
+        the old contents are loaded lazily: nothing is fetched from the
+        backend until a versioned field is accessed. Then the content of
+        that field is fetched for the whole chunk of
+        ``GET_ITERATOR_CHUNK_SIZE`` objects with a single ``fetch_many``
+        call. Deferred fields (``defer()``/``only()``) are never fetched.
+
+        """
+        if not hasattr(self, '_rev') or self._rev == 'head':
+            fields = _versioned_fields(self.model)
+            for obj in super(RevisionQuerySet, self).iterator():
+                for field in fields:
+                    field.mark_loaded(obj)
+                yield obj
+            return
+
+        chunk = []
+        for obj in super(RevisionQuerySet, self).iterator():
+            chunk.append(obj)
+            if len(chunk) >= GET_ITERATOR_CHUNK_SIZE:
+                self._set_loaders(chunk)
+                for fetched in chunk:
+                    yield fetched
+                chunk = []
+        self._set_loaders(chunk)
+        for fetched in chunk:
+            yield fetched
+
+
+    def prefetch(self, concurrency=None):
+        """
+        iterates over the objects like ``iterator``, but fetches the old
+        contents of all versioned fields in the ``rcsfield.workers`` pool,
+        up to ``concurrency`` chunks ahead of the caller (default: the
+        size of the pool). Objects are yielded in order once their chunk
+        has been fetched.
+
         """
+        from rcsfield import workers
+        if not hasattr(self, '_rev') or self._rev == 'head':
+            for obj in self.iterator():
+                yield obj
+            return
+        if concurrency is None:
+            concurrency = workers.pool.size
+
+        pending = [] # (objects, results) per chunk
+        chunk = []
         for obj in super(RevisionQuerySet, self).iterator():
-            for field in obj._meta.fields:
-                if hasattr(field, 'IS_VERSIONED') and field.IS_VERSIONED and hasattr(self, '_rev') and not self._rev == 'head':
-                    file_path = getattr(field, 'rcskey_format') % (obj._meta.app_label,obj.__class__.__name__, field.attname,obj.id)
-                    try:
-                        olddata = backend.fetch(file_path, self._rev)
-                        setattr(obj, field.attname, unicode(olddata, 'utf-8'))
-                        setattr(obj, '%s_revision' % field.attname, self._rev)
-                    except:
-                        # for now just ignore errors raised in the backend
-                        # and return the content from the db (aka head revision)
-                        pass
-            yield obj
+            chunk.append(obj)
+            if len(chunk) >= GET_ITERATOR_CHUNK_SIZE:
+                pending.append((chunk, [workers.pool.submit(loader.load)
+                                        for loader in self._set_loaders(chunk)]))
+                chunk = []
+                if len(pending) > concurrency:
+                    objects, results = pending.pop(0)
+                    for result in results:
+                        result.wait()
+                    for fetched in objects:
+                        yield fetched
+        if chunk:
+            pending.append((chunk, [workers.pool.submit(loader.load)
+                                    for loader in self._set_loaders(chunk)]))
+        for objects, results in pending:
+            for result in results:
+                result.wait()
+            for fetched in objects:
+                yield fetched
+
+
+    def _set_loaders(self, objects):
+        """
+        makes the versioned fields of all ``objects`` load their content at
+        ``self._rev`` on first access. returns the created loaders.
+
+        """
+        loaders = []
+        if not objects:
+            return loaders
+        for field in objects[0]._meta.fields:
+            if not getattr(field, 'IS_VERSIONED', False):
+                continue
+            # deferred fields are not in __dict__, leave them alone
+            loaded = [obj for obj in objects if field.attname in obj.__dict__]
+            if not loaded:
+                continue
+            loader = RevisionLoader([field.get_rcskey(obj) for obj in loaded], self._rev)
+            loaders.append(loader)
+            for obj in loaded:
+                descriptor = _get_descriptor(obj.__class__, field.attname)
+                if hasattr(descriptor, 'set_loader'):
+                    descriptor.set_loader(obj, loader, field.get_rcskey(obj), self._rev)
+        return loaders
 
 
     def _clone(self, klass=None, setup=False, **kwargs):
@@ -77,3 +219,13 @@ class RevisionManager(models.Manager):
 
     def rev(self, rev='head'):
         return self.get_query_set(rev)
+
+    def search_revisions(self, query, fields=None, limit=None):
+        """
+        returns ``(pk, field name, revision)`` tuples for every revision of
+        the versioned fields whose content matches the full-text ``query``,
+        see ``rcsfield.search``.
+
+        """
+        from rcsfield.search import search_model
+        return search_model(self.model, query, fields, limit)
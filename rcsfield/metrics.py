@@ -0,0 +1,289 @@
+"""
+Instrumentation for django-rcsfield.
+
+``InstrumentedBackend`` wraps the backend module selected by
+``settings.RCS_BACKEND`` and times every call. For each call
+
+  * the ``backend_call`` signal is sent with ``operation``, ``key``,
+    ``revision``, ``duration`` (seconds) and ``bytes``
+  * the callable named by ``settings.RCS_METRICS_CALLBACK`` (a dotted
+    path, optional) is called with the same keyword arguments
+  * in-process counters and a latency histogram per operation are updated
+
+Exceptions raised by signal receivers or the callback are logged on the
+``rcsfield`` logger, they never fail the backend call.
+
+Enable it in your settings::
+
+    RCS_METRICS = True
+
+The counters can be scraped in the Prometheus text format by pointing an
+url at ``rcsfield.metrics.metrics_view``. Add
+``rcsfield.metrics.RequestSummaryMiddleware`` to ``MIDDLEWARE_CLASSES``
+to get an ``X-Rcsfield`` response header (and a log line on the
+``rcsfield`` logger) summarizing the backend calls of every request.
+
+"""
+
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.http import HttpResponse
+
+
+backend_call = Signal(providing_args=['operation', 'key', 'revision', 'duration', 'bytes'])
+
+logger = logging.getLogger('rcsfield')
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+OPERATIONS = ('fetch', 'fetch_many', 'fetch_stream', 'commit', 'commit_many', 'bulk_import',
+              'get_revisions', 'get_revisions_many', 'get_history', 'get_revision_log', 'move',
+              'move_many', 'diff', 'diff_stream', 'annotate', 'search', 'compact', 'repack')
+
+# operations returning iterators which do the work while they are consumed
+STREAMS = ('fetch_stream', 'diff', 'diff_stream')
+
+
+class Metrics(object):
+    """
+    Thread-safe call counters and latency histograms per operation.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.operations = {}
+
+    def add(self, operation, duration, bytes, error=False):
+        self._lock.acquire()
+        try:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {
+                    'calls': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0,
+                    'buckets': [0] * len(BUCKETS),
+                }
+            stats['calls'] += 1
+            stats['seconds'] += duration
+            stats['bytes'] += bytes
+            if error:
+                stats['errors'] += 1
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats['buckets'][i] += 1
+                    break
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        returns a copy of the counters.
+
+        """
+        self._lock.acquire()
+        try:
+            result = {}
+            for operation, stats in self.operations.items():
+                result[operation] = dict(stats, buckets=list(stats['buckets']))
+            return result
+        finally:
+            self._lock.release()
+
+    def render(self):
+        """
+        returns the counters in the Prometheus text format.
+
+        """
+        lines = []
+        for operation, stats in sorted(self.snapshot().items()):
+            labels = 'operation="%s"' % operation
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stats['buckets']):
+                cumulative += count
+                if bound == float('inf'):
+                    le = '+Inf'
+                else:
+                    le = repr(bound)
+                lines.append('rcsfield_backend_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+            lines.append('rcsfield_backend_seconds_sum{%s} %f' % (labels, stats['seconds']))
+            lines.append('rcsfield_backend_seconds_count{%s} %d' % (labels, stats['calls']))
+            lines.append('rcsfield_backend_errors_total{%s} %d' % (labels, stats['errors']))
+            lines.append('rcsfield_backend_bytes_total{%s} %d' % (labels, stats['bytes']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+_request = threading.local()
+
+
+def _sizeof(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum([_sizeof(v) for v in value.values()])
+    if isinstance(value, (list, tuple)):
+        return sum([_sizeof(v) for v in value])
+    return 0
+
+
+def _describe(operation, args, result):
+    """
+    returns ``(key, revision, bytes)`` of a backend call.
+
+    """
+    key = revision = None
+    bytes = 0
+    if operation == 'fetch':
+        key, revision = args[0], args[1]
+        bytes = _sizeof(result)
+    elif operation == 'fetch_stream':
+        key, revision = args[0], args[1]
+    elif operation == 'fetch_many':
+        key, revision = list(args[0]), args[1]
+        bytes = _sizeof(result)
+    elif operation == 'commit':
+        key, revision = args[0], result
+        bytes = _sizeof(args[1])
+    elif operation == 'commit_many':
+        key, revision = [k for k, d in args[0]], result
+        bytes = sum([_sizeof(d) for k, d in args[0]])
+    elif operation == 'bulk_import':
+        key = [k for keys, rev in result or [] for k in keys]
+        revision = [rev for keys, rev in result or []]
+    elif operation == 'move':
+        key, revision = args[1], result
+    elif operation == 'move_many':
+        key, revision = [k for f, k in args[0]], result
+    elif operation in ('diff', 'diff_stream'):
+        key, revision = args[0], (args[1], args[3])
+    elif operation in ('compact', 'repack'):
+        pass # the whole repository
+    elif operation == 'annotate':
+        key, revision = args[0], args[1]
+        bytes = _sizeof(result)
+    elif args:
+        key = args[0]
+    return key, revision, bytes
+
+
+class InstrumentedBackend(object):
+    """
+    Wraps a backend module and reports the duration and size of every
+    call of the backend API.
+
+    """
+
+    def __init__(self, backend, callback=None):
+        if callback is None:
+            path = getattr(settings, 'RCS_METRICS_CALLBACK', None)
+            if path:
+                module, attr = path.rsplit('.', 1)
+                callback = getattr(__import__(module, {}, {}, [attr]), attr)
+        self.backend = backend
+        self.callback = callback
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name in OPERATIONS:
+            return self._instrument(name, attr)
+        return attr
+
+    def _instrument(self, operation, func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                self._report(operation, args, None, time.time() - start, error=True)
+                raise
+            if operation in STREAMS:
+                return self._stream(operation, args, result, start)
+            self._report(operation, args, result, time.time() - start)
+            return result
+        return wrapper
+
+    def _stream(self, operation, args, result, start):
+        """
+        passes the chunks or lines of ``result`` through and reports the
+        call once it is exhausted (or closed), without holding more than
+        one chunk. The duration includes the time the consumer spent
+        between the chunks.
+
+        """
+        size = 0
+        error = True
+        try:
+            try:
+                for chunk in result:
+                    size += len(chunk)
+                    yield chunk
+                error = False
+            except GeneratorExit:
+                error = False
+                raise
+        finally:
+            self._report(operation, args, None, time.time() - start, error=error, size=size)
+
+    def _report(self, operation, args, result, duration, error=False, size=None):
+        try:
+            key, revision, bytes = _describe(operation, args, result)
+        except (IndexError, TypeError, ValueError):
+            key, revision, bytes = None, None, 0
+        if size is not None:
+            bytes = size
+        metrics.add(operation, duration, bytes, error)
+        summary = getattr(_request, 'summary', None)
+        if summary is not None:
+            summary['calls'] += 1
+            summary['seconds'] += duration
+            summary['bytes'] += bytes
+        # a broken receiver or callback must not fail the backend call
+        for receiver, response in backend_call.send_robust(sender=self, operation=operation,
+                                                           key=key, revision=revision,
+                                                           duration=duration, bytes=bytes):
+            if isinstance(response, Exception):
+                logger.error("rcsfield: backend_call receiver %r failed: %s" % (receiver, response))
+        if self.callback is not None:
+            try:
+                self.callback(operation=operation, key=key, revision=revision,
+                              duration=duration, bytes=bytes)
+            except Exception:
+                logger.exception("rcsfield: metrics callback %r failed for %s" % (self.callback, operation))
+
+
+def metrics_view(request):
+    """
+    serves the counters for scraping.
+
+    """
+    return HttpResponse(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+class RequestSummaryMiddleware(object):
+    """
+    Adds an ``X-Rcsfield`` header with the number, duration and size of
+    all backend calls made while handling the request, and logs the same
+    summary at debug level.
+
+    """
+
+    def process_request(self, request):
+        _request.summary = {'calls': 0, 'seconds': 0.0, 'bytes': 0}
+
+    def process_response(self, request, response):
+        summary = getattr(_request, 'summary', None)
+        _request.summary = None
+        if summary is not None and summary['calls']:
+            text = 'calls=%(calls)d time=%(seconds).4fs bytes=%(bytes)d' % summary
+            response['X-Rcsfield'] = text
+            logger.debug("rcsfield: %s %s" % (request.path, text))
+        return response
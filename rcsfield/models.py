@@ -0,0 +1,80 @@
+from django.db import models
+
+
+
+class RevisionIndex(models.Model):
+    """
+    One row per revision in which a versioned key changed. Maintained by
+    ``rcsfield.index.IndexedBackend`` so revision lists can be answered
+    without asking the revision control backend.
+
+    ``sequence`` is the revision number for backends with numeric
+    revisions (bzr, svn) and the position in the history of the key
+    (oldest is 1) for backends using hashes (git).
+
+    """
+    key = models.CharField(max_length=255)
+    revision = models.CharField(max_length=64)
+    sequence = models.PositiveIntegerField()
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('key', 'sequence'),)
+        ordering = ('-sequence',)
+
+    def __unicode__(self):
+        return u'%s@%s' % (self.key, self.revision)
+
+
+
+class IndexedKey(models.Model):
+    """
+    Marks a key whose complete history is in ``RevisionIndex``, written by
+    ``IndexedBackend.rebuild`` and on the first commit of a new key. Keys
+    without it are answered by the revision control backend.
+
+    """
+    key = models.CharField(max_length=255, unique=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+
+class Changeset(models.Model):
+    """
+    A revision of the ``db`` backend, groups the contents of all keys
+    committed together. The id is the revision number.
+
+    """
+    timestamp = models.DateTimeField()
+    message = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'%s' % self.pk
+
+
+
+class RevisionContent(models.Model):
+    """
+    Content of a key in one revision of the ``db`` backend. Every
+    ``RCS_DB_SNAPSHOT_INTERVAL``-th revision of a key and its head revision
+    are stored in full, all others as reverse deltas against the next
+    newer revision of the key.
+
+    """
+    FULL = 'f'
+    DELTA = 'd'
+
+    key = models.CharField(max_length=255)
+    changeset = models.ForeignKey(Changeset)
+    sequence = models.PositiveIntegerField()
+    kind = models.CharField(max_length=1, choices=((FULL, 'full'), (DELTA, 'delta')))
+    data = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = (('key', 'sequence'),)
+        ordering = ('-sequence',)
+
+    def __unicode__(self):
+        return u'%s@%s' % (self.key, self.changeset_id)
@@ -0,0 +1,84 @@
+"""
+Retention policies for django-rcsfield.
+
+A policy decides which revisions of a key survive ``./manage.py compact_rcs``.
+They are configured per model or per field in the settings::
+
+    RCS_RETENTION = {
+        # keep everything from the last 90 days, one revision per day before
+        'wiki.Page': {'keep_days': 90, 'snapshots': 'daily'},
+        # a field can have its own policy
+        'wiki.Page.scratch': {'keep_days': 7, 'snapshots': None},
+        # default for all other versioned fields
+        '*': {'keep_days': 365, 'snapshots': 'monthly'},
+    }
+
+Keys without a policy keep all their revisions. The newest revision of a
+key is always kept.
+
+"""
+
+import datetime
+
+from django.conf import settings
+
+
+SNAPSHOTS = {
+    'daily': lambda t: t.date(),
+    'weekly': lambda t: t.isocalendar()[:2],
+    'monthly': lambda t: (t.year, t.month),
+}
+
+
+class Retention(object):
+    """
+    Keeps all revisions of the last ``keep_days`` days and the newest
+    revision of every day, week or month (``snapshots``) before that.
+    With ``snapshots=None`` older revisions are dropped.
+
+    """
+
+    def __init__(self, keep_days=90, snapshots='daily', now=None):
+        if snapshots is not None and snapshots not in SNAPSHOTS:
+            raise ValueError("snapshots must be one of %s or None" % ', '.join(SNAPSHOTS.keys()))
+        self.keep_days = keep_days
+        self.snapshots = snapshots
+        self.now = now
+
+    def __call__(self, key, history):
+        """
+        returns the revisions to keep of ``history``, a list of
+        ``(revision, datetime)`` tuples newest first.
+
+        """
+        now = self.now or datetime.datetime.now()
+        cutoff = now - datetime.timedelta(days=self.keep_days)
+        kept = []
+        buckets = {}
+        for rev, timestamp in history:
+            if timestamp >= cutoff:
+                kept.append(rev)
+            elif self.snapshots is not None:
+                bucket = SNAPSHOTS[self.snapshots](timestamp)
+                if bucket not in buckets:
+                    buckets[bucket] = True
+                    kept.append(rev)
+        return kept
+
+    def __repr__(self):
+        return '<Retention keep_days=%s snapshots=%s>' % (self.keep_days, self.snapshots)
+
+
+
+def get_policy(model, field):
+    """
+    returns the ``Retention`` configured for ``field`` of ``model`` in
+    ``settings.RCS_RETENTION`` or ``None`` to keep everything.
+
+    """
+    policies = getattr(settings, 'RCS_RETENTION', {})
+    label = '%s.%s' % (model._meta.app_label, model.__name__)
+    for name in ('%s.%s' % (label, field.name), label, '*'):
+        if name in policies:
+            return Retention(**policies[name])
+    return None
@@ -0,0 +1,357 @@
+"""
+Full-text search over the history of versioned fields.
+
+Finding the revisions which ever contained some text would mean fetching
+every revision of every key. ``SearchBackend`` wraps the backend module
+selected by ``settings.RCS_BACKEND`` and adds the content of every
+``commit`` to a local SQLite full-text index, so such questions become a
+single query.
+
+Enable it in your settings::
+
+    RCS_SEARCH = True
+    RCS_SEARCH_PATH = '/var/lib/rcsfield/search.db'
+
+index the already existing history with::
+
+    ./manage.py rebuild_rcssearch
+
+and search it through the ``RevisionManager`` of a model::
+
+    >>> Entry.objects.search_revisions('"exact phrase"')
+    [(1, 'text', 12), (1, 'text', 9), (4, 'text', 3)]
+
+Queries use the SQLite FTS ``MATCH`` syntax, malformed queries raise a
+``ValueError``. Only the search index is kept, not the content, when
+SQLite supports contentless FTS4 tables.
+
+Entries replaced by ``rebuild_rcssearch`` or left by a failed bulk import
+stay in contentless tables. Reclaim them, keeping the history of deleted
+objects, with::
+
+    ./manage.py rebuild_rcssearch --optimize
+
+"""
+
+import sqlite3
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from rcsfield.index import _to_revision
+from rcsfield.sqlitestore import SQLiteStore
+
+
+# stands in for the primary key while turning a ``rcskey_format`` into a
+# pattern matching the keys of all objects
+_PK = '\x01pk\x01'
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SearchIndex(SQLiteStore):
+    """
+    SQLite full-text index of the content of keys in the revisions they
+    changed.
+
+    Entries are removed by deleting their row in ``rcs_revisions`` only,
+    contentless FTS tables do not support deletes. Their stale index
+    entries are ignored and dropped by ``clear()`` and ``optimize()``.
+
+    """
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS rcs_revisions ('
+                     'id INTEGER PRIMARY KEY, key TEXT NOT NULL, revision TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS rcs_revisions_key ON rcs_revisions (key)')
+        try:
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS rcs_content USING fts4(body, content="")')
+        except sqlite3.OperationalError:
+            # no contentless fts4 tables, store the content in the index as well
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS rcs_content USING fts3(body)')
+        conn.commit()
+
+    def add(self, items, rev):
+        """
+        indexes ``items``, a list of ``(key, data)`` tuples, as changed in
+        revision ``rev``. returns the first and last id of the new entries.
+
+        """
+        conn = self.connection()
+        if rev is not None:
+            rev = str(rev)
+        first = last = None
+        try:
+            for key, data in items:
+                last = conn.execute('INSERT INTO rcs_revisions (key, revision) VALUES (?, ?)',
+                                    (key.decode('utf-8'), rev)).lastrowid
+                conn.execute('INSERT INTO rcs_content (docid, body) VALUES (?, ?)',
+                             (last, data.decode('utf-8', 'replace')))
+                if first is None:
+                    first = last
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return first, last
+
+    def set_revision(self, first, last, rev):
+        """
+        sets the revision of the entries ``first`` to ``last``, added by
+        ``add`` before the revision was known.
+
+        """
+        conn = self.connection()
+        conn.execute('UPDATE rcs_revisions SET revision = ? WHERE id BETWEEN ? AND ?',
+                     (str(rev), first, last))
+        conn.commit()
+
+    def remove(self, first, last):
+        conn = self.connection()
+        conn.execute('DELETE FROM rcs_revisions WHERE id BETWEEN ? AND ?', (first, last))
+        conn.commit()
+
+    def remove_key(self, key):
+        conn = self.connection()
+        conn.execute('DELETE FROM rcs_revisions WHERE key = ?', (key.decode('utf-8'),))
+        conn.commit()
+
+    def move(self, key_from, key_to):
+        conn = self.connection()
+        conn.execute('UPDATE rcs_revisions SET key = ? WHERE key = ?',
+                     (key_to.decode('utf-8'), key_from.decode('utf-8')))
+        conn.commit()
+
+    def clear(self):
+        """
+        removes all entries, including stale ones.
+
+        """
+        conn = self.connection()
+        conn.execute('DROP TABLE IF EXISTS rcs_content')
+        conn.execute('DROP TABLE IF EXISTS rcs_revisions')
+        conn.commit()
+        self.create_tables(conn)
+
+    def optimize(self, fetch):
+        """
+        drops the stale index entries and merges the index. Contentless
+        tables are rebuilt from the content of every entry, fetched with
+        ``fetch(key, revision)``. Entries whose content can not be fetched
+        anymore and the ones left behind by an interrupted bulk import are
+        removed. returns the number of entries.
+
+        """
+        conn = self.connection()
+        try:
+            conn.execute('DELETE FROM rcs_content WHERE docid NOT IN (SELECT id FROM rcs_revisions)')
+            conn.execute('DELETE FROM rcs_revisions WHERE revision IS NULL')
+            conn.commit()
+        except sqlite3.OperationalError:
+            # contentless
+            conn.rollback()
+            self._rebuild_content(conn, fetch)
+        conn.execute("INSERT INTO rcs_content (rcs_content) VALUES ('optimize')")
+        conn.commit()
+        conn.execute('VACUUM')
+        return conn.execute('SELECT COUNT(*) FROM rcs_revisions').fetchone()[0]
+
+    def _rebuild_content(self, conn, fetch):
+        # fills a new table with the content of all entries, the ones added
+        # meanwhile are copied while swapping the tables.
+        def copy(last):
+            rows = conn.execute('SELECT id, key, revision FROM rcs_revisions WHERE id > ? '
+                                'AND revision IS NOT NULL ORDER BY id', (last,)).fetchall()
+            for id, key, rev in rows:
+                try:
+                    data = fetch(key.encode('utf-8'), _to_revision(str(rev)))
+                except Exception:
+                    conn.execute('DELETE FROM rcs_revisions WHERE id = ?', (id,))
+                else:
+                    conn.execute('INSERT INTO rcs_content_new (docid, body) VALUES (?, ?)',
+                                 (id, data.decode('utf-8', 'replace')))
+                last = id
+            return last
+        conn.execute('DROP TABLE IF EXISTS rcs_content_new')
+        conn.execute('CREATE VIRTUAL TABLE rcs_content_new USING fts4(body, content="")')
+        conn.commit()
+        last = copy(0)
+        conn.commit()
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None # DDL has to be part of the transaction
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                copy(last)
+                conn.execute('DELETE FROM rcs_revisions WHERE revision IS NULL')
+                conn.execute('DROP TABLE rcs_content')
+                conn.execute('ALTER TABLE rcs_content_new RENAME TO rcs_content')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.isolation_level = isolation_level
+
+    def search(self, query, pattern=None, limit=None):
+        """
+        returns ``(key, revision)`` tuples of all entries matching the FTS
+        ``query``, only for keys matching the SQL ``LIKE`` ``pattern``.
+        raises ``ValueError`` if ``query`` is not valid FTS syntax.
+
+        """
+        sql = ('SELECT r.key, r.revision FROM rcs_content c JOIN rcs_revisions r '
+               'ON r.id = c.docid WHERE c.body MATCH ? AND r.revision IS NOT NULL')
+        params = [query]
+        if pattern is not None:
+            sql += " AND r.key LIKE ? ESCAPE '\\'"
+            params.append(pattern)
+        sql += ' ORDER BY r.id DESC'
+        if limit:
+            sql += ' LIMIT %d' % int(limit)
+        try:
+            return [(key.encode('utf-8'), _to_revision(str(rev)))
+                    for key, rev in self.connection().execute(sql, params)]
+        except sqlite3.OperationalError, e:
+            message = str(e)
+            if 'MATCH' in message or 'syntax' in message or 'unterminated' in message:
+                raise ValueError("Invalid search query %r: %s" % (query, message))
+            raise
+
+
+
+class SearchBackend(object):
+    """
+    Wraps a backend module and adds the content of every commit to a
+    ``SearchIndex``. Everything else is passed through to the wrapped
+    backend.
+
+    """
+
+    def __init__(self, backend, path=None):
+        if path is None:
+            path = getattr(settings, 'RCS_SEARCH_PATH', None)
+        if not path:
+            raise ImproperlyConfigured("RCS_SEARCH_PATH must be set to use the search index.")
+        self.backend = backend
+        self.index = SearchIndex(path)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def commit(self, key, data):
+        rev = self.backend.commit(key, data)
+        if rev is not None:
+            self.index.add([(key, data)], rev)
+        return rev
+
+    def commit_many(self, items):
+        rev = self.backend.commit_many(items)
+        if rev is not None:
+            self.index.add(items, rev)
+        return rev
+
+    def bulk_import(self, chunks):
+        """
+        indexes the chunks while they are passed to the backend, only the
+        ids of the index entries are kept until the revisions are known.
+
+        """
+        ranges = [] # (keys, first, last) of every non-empty chunk
+        def index(chunks):
+            for chunk in chunks:
+                if chunk:
+                    first, last = self.index.add(chunk, None)
+                    ranges.append(([key for key, data in chunk], first, last))
+                yield chunk
+        try:
+            result = self.backend.bulk_import(index(chunks))
+        except:
+            for keys, first, last in ranges:
+                self.index.remove(first, last)
+            raise
+        # backends leave chunks out of the result (e.g. empty ones), match
+        # the ranges by their keys
+        pending = list(ranges)
+        for keys, rev in result:
+            keys = list(keys)
+            for position, (chunk_keys, first, last) in enumerate(pending):
+                if chunk_keys == keys:
+                    del pending[position]
+                    if rev is None:
+                        self.index.remove(first, last)
+                    else:
+                        self.index.set_revision(first, last, rev)
+                    break
+        for keys, first, last in pending:
+            self.index.remove(first, last)
+        return result
+
+    def move(self, key_from, key_to):
+        rev = self.backend.move(key_from, key_to)
+        if rev:
+            self.index.move(key_from, key_to)
+        return rev
+
+    def move_many(self, moves):
+        rev = self.backend.move_many(moves)
+        if rev:
+            for key_from, key_to in moves:
+                self.index.move(key_from, key_to)
+        return rev
+
+    def search(self, query, pattern=None, limit=None):
+        return self.index.search(query, pattern, limit)
+
+    def optimize_search(self):
+        """
+        drops stale entries from the search index, see
+        ``SearchIndex.optimize``.
+
+        """
+        return self.index.optimize(self.backend.fetch)
+
+    def reindex_search(self, key):
+        """
+        replaces the index entries of ``key`` with the content of every
+        revision in its history. returns the number of revisions indexed.
+
+        """
+        history = self.backend.get_history(key)
+        self.index.remove_key(key)
+        for rev, timestamp in reversed(history):
+            self.index.add([(key, self.backend.fetch(key, rev))], rev)
+        return len(history)
+
+
+
+def search_model(model, query, fields=None, limit=None):
+    """
+    returns ``(pk, field name, revision)`` tuples for the revisions of the
+    versioned fields of ``model`` (or only the ones named in ``fields``)
+    whose content matches ``query``. Objects which were deleted since are
+    included. raises ``ValueError`` for malformed queries.
+
+    """
+    from rcsfield.backends import backend
+    if not hasattr(backend, 'search'):
+        raise ImproperlyConfigured("The search index is not enabled, set RCS_SEARCH = True in your settings.")
+    versioned = [f for f in model._meta.fields if getattr(f, 'IS_VERSIONED', False)]
+    if fields is not None:
+        versioned = [f for f in versioned if f.name in fields]
+    result = []
+    for field in versioned:
+        template = field.rcskey_format % (model._meta.app_label, model.__name__,
+                                          field.attname, _PK)
+        prefix, suffix = template.split(_PK)
+        pattern = '%s%%%s' % (_escape_like(prefix), _escape_like(suffix))
+        for key, rev in backend.search(query, pattern, limit and limit - len(result)):
+            if not key.startswith(prefix) or not key.endswith(suffix):
+                continue # LIKE ignores case
+            pk = key[len(prefix):len(key) - len(suffix)]
+            result.append((model._meta.pk.to_python(pk), field.name, rev))
+        if limit and len(result) >= limit:
+            break
+    return result
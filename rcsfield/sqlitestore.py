@@ -0,0 +1,37 @@
+"""
+Local SQLite files used as side stores next to the repository, see
+``rcsfield.search`` and ``rcsfield.diffstore``.
+
+"""
+
+import os
+import sqlite3
+import threading
+
+
+
+class SQLiteStore(object):
+    """
+    Base class for stores kept in the SQLite database at ``path``. Every
+    thread uses its own connection, the tables are created by
+    ``create_tables`` when the first one is opened.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def create_tables(self, conn):
+        raise NotImplementedError
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=30)
+            self.create_tables(conn)
+            self._local.conn = conn
+        return conn
@@ -24,9 +24,9 @@ class HistoryTrailNode(template.Node):
 
     def render(self, context):
         instance = template.resolve_variable(self.model, context)
-        revs = instance.get_changed_revisions()
-        if self.count > 0:
-            revs = revs[:self.count]
+        # one log query for revisions, authors and dates, the first entry
+        # is the head revision
+        revs = instance.get_revision_log(limit=self.count and self.count + 1 or None)[1:]
         # Note: as long as there is no support for {{ forloop.previous }}
         # we need a list of tuples with (current,previous) revisions
         tlist = [(revs[c],revs[c-1]) for c in range(len(revs))]
@@ -0,0 +1,178 @@
+"""
+Transaction-scoped commits for django-rcsfield.
+
+Normally every save of a model with versioned fields is committed to the
+repository immediately, even if the surrounding database transaction is
+rolled back later. With ``settings.RCS_TRANSACTION_COMMITS = True``
+changes made while a transaction is managed (``TransactionMiddleware``,
+``commit_on_success``, ``commit_manually``, ...) are buffered instead:
+
+  * on database commit the buffered changes are marked as committed, they
+    are committed to the repository as a single changeset once the
+    outermost managed block has been left. Writing to the repository
+    inside the block would make it dirty again (the ``db`` backend and
+    the revision index write rows), so that it is rolled back.
+  * on rollback the changes since the last commit are discarded, on
+    rollback to a savepoint the changes made after the savepoint.
+
+Django does not provide hooks for this, so ``django.db.transaction.commit``,
+``rollback``, ``savepoint``, ``savepoint_rollback`` and
+``leave_transaction_management`` are wrapped when this module is enabled.
+
+"""
+
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+
+_state = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'RCS_TRANSACTION_COMMITS', False)
+
+
+def active():
+    """
+    returns ``True`` if changes should be buffered right now.
+
+    """
+    return enabled() and transaction.is_managed()
+
+
+def _buffer():
+    if not hasattr(_state, 'items'):
+        _state.items = {}     # pending changes
+        _state.order = []
+        _state.committed = {} # changes committed to the db
+        _state.committed_order = []
+        _state.savepoints = {}
+    return _state
+
+
+def add(items):
+    """
+    buffers ``items``, a list of ``(key, data)`` tuples, until the current
+    transaction ends. A later change of the same key replaces an earlier one.
+
+    """
+    state = _buffer()
+    for key, data in items:
+        if key not in state.items:
+            state.order.append(key)
+        state.items[key] = data
+
+
+def mark_committed():
+    """
+    moves the pending changes to the ones committed to the db, they are
+    flushed when the outermost managed block is left.
+
+    """
+    state = _buffer()
+    for key in state.order:
+        if key not in state.committed:
+            state.committed_order.append(key)
+        state.committed[key] = state.items[key]
+    state.items = {}
+    state.order = []
+    state.savepoints = {}
+
+
+def flush():
+    """
+    commits all buffered changes as one changeset.
+
+    """
+    mark_committed()
+    state = _buffer()
+    if not state.committed_order:
+        return
+    items = [(key, state.committed[key]) for key in state.committed_order]
+    state.committed = {}
+    state.committed_order = []
+    from rcsfield import writebehind
+    if writebehind.enabled():
+        for key, data in items:
+            writebehind.put(key, data)
+    else:
+        from rcsfield.backends import backend
+        backend.commit_many(items)
+
+
+def discard():
+    """
+    drops the changes made since the last commit.
+
+    """
+    state = _buffer()
+    state.items = {}
+    state.order = []
+    state.savepoints = {}
+
+
+def _wrap_savepoint(func):
+    def wrapper(*args, **kwargs):
+        sid = func(*args, **kwargs)
+        state = _buffer()
+        state.savepoints[sid] = (state.items.copy(), state.order[:])
+        return sid
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper._rcsfield_wrapped = func
+    return wrapper
+
+
+def _wrap_savepoint_rollback(func):
+    def wrapper(sid, *args, **kwargs):
+        result = func(sid, *args, **kwargs)
+        state = _buffer()
+        if sid in state.savepoints:
+            items, order = state.savepoints[sid]
+            state.items, state.order = items.copy(), order[:]
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper._rcsfield_wrapped = func
+    return wrapper
+
+
+def _wrap(func, after):
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        after()
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper._rcsfield_wrapped = func
+    return wrapper
+
+
+def _after_leave():
+    # the repository is only written once the outermost block is left,
+    # changes buffered outside of an explicit commit (e.g. nothing was
+    # written to the db) are committed as well.
+    if not transaction.is_managed():
+        flush()
+
+
+def install():
+    """
+    wraps django's transaction functions, called once on import.
+
+    """
+    if hasattr(transaction.commit, '_rcsfield_wrapped'):
+        return
+    transaction.commit = _wrap(transaction.commit, mark_committed)
+    transaction.rollback = _wrap(transaction.rollback, discard)
+    if hasattr(transaction, 'savepoint'):
+        transaction.savepoint = _wrap_savepoint(transaction.savepoint)
+        transaction.savepoint_rollback = _wrap_savepoint_rollback(transaction.savepoint_rollback)
+    transaction.leave_transaction_management = _wrap(transaction.leave_transaction_management,
+                                                     _after_leave)
+
+
+if enabled():
+    install()
@@ -3,7 +3,8 @@ from rcsfield.backends import backend
 
 
 
-def migrate_keyformat(model, fieldname, old_format, new_format):
+def migrate_keyformat(model, fieldname, old_format, new_format, chunk_size=1000,
+                      start_pk=None, progress=None):
     """
     Little helper to migrate a repo to a new ``rcskey_format``
     For all objects of ``model`` the file in the repo is moved
@@ -13,21 +14,46 @@ def migrate_keyformat(model, fieldname, old_format, new_format):
 
     >>> migrate_keyformat(MyModel, 'myfieldname', '%s/%s_%s_%s.txt', '%s/%s/%s/%s.txt')
 
+    The objects are processed in chunks of ``chunk_size`` ordered by primary
+    key and every chunk is moved with a single ``backend.move_many`` call,
+    so there is one new revision per chunk instead of one per object.
+
+    ``progress`` is an optional callable which is called after every chunk
+    with the number of objects processed so far, the total number of
+    objects and the last primary key processed. To resume an interrupted
+    migration pass that primary key as ``start_pk``. Running the migration
+    again from the beginning is safe as well, keys which were already
+    moved are skipped by the backend.
+
     Note:
     You have to run this function once for every model and every fieldname on
     that model, which you have changed.
-    As the move is commited you will have for every field per model instance one
-    new revision that shows up when using the get_revisions() method.
+    As the move is commited you will have one new revision per chunk that
+    shows up when using the get_revisions() method.
+
+    returns the last primary key processed.
 
     """
-    object_list = model.objects.all()
-    for obj in object_list:
-        backend.move(old_format % (obj._meta.app_label,
-                                   obj.__class__.__name__,
-                                   fieldname,
-                                   obj.pk),
-                     new_format % (obj._meta.app_label,
-                                   obj.__class__.__name__,
-                                   fieldname,
-                                   obj.pk)
-                     )
+    app_label = model._meta.app_label
+    name = model.__name__
+    pks = model._default_manager.order_by('pk').values_list('pk', flat=True)
+    if start_pk is not None:
+        pks = pks.filter(pk__gt=start_pk)
+    total = pks.count()
+    done = 0
+    last_pk = start_pk
+    while True:
+        if last_pk is None:
+            chunk = list(pks[:chunk_size])
+        else:
+            chunk = list(pks.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        moves = [(old_format % (app_label, name, fieldname, pk),
+                  new_format % (app_label, name, fieldname, pk)) for pk in chunk]
+        backend.move_many(moves)
+        done += len(chunk)
+        last_pk = chunk[-1]
+        if progress is not None:
+            progress(done, total, last_pk)
+    return last_pk
@@ -0,0 +1,139 @@
+"""
+Non-blocking backend calls for django-rcsfield.
+
+All backend calls block on subprocesses or VCS libraries. The functions
+here run them in a bounded pool of worker threads and return a ``Result``
+immediately, so a caller can start several slow history lookups at once
+and wait for them later::
+
+    from rcsfield import workers
+
+    old = workers.afetch(key, 15)
+    revs = workers.aget_revisions(key)
+    ...
+    render(old.get(), revs.get())
+
+The number of threads is ``settings.RCS_WORKER_THREADS`` (default 4).
+``RevisionQuerySet.prefetch`` uses the same pool to fetch historical
+contents concurrently.
+
+"""
+
+import sys
+import threading
+
+from django.conf import settings
+
+
+class Result(object):
+    """
+    The pending result of a call running in the worker pool.
+
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def _set(self, value=None, exc_info=None):
+        self._value = value
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """
+        waits until the call finished. returns ``False`` on timeout.
+
+        """
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def get(self, timeout=None):
+        """
+        returns the return value of the call, re-raising its exception.
+
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("rcsfield: backend call did not finish in time")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads executing submitted calls in order.
+
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = getattr(settings, 'RCS_WORKER_THREADS', 4)
+        self.size = max(1, size)
+        self._queue = []
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        runs ``func(*args, **kwargs)`` in a worker thread and returns a
+        ``Result``.
+
+        """
+        result = Result()
+        self._cond.acquire()
+        try:
+            self._queue.append((result, func, args, kwargs))
+            self._threads = [t for t in self._threads if t.isAlive()]
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run, name='rcsfield-worker')
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return result
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._queue:
+                    self._cond.wait()
+                result, func, args, kwargs = self._queue.pop(0)
+            finally:
+                self._cond.release()
+            try:
+                result._set(func(*args, **kwargs))
+            except:
+                result._set(exc_info=sys.exc_info())
+
+
+
+pool = WorkerPool()
+
+def _backend():
+    from rcsfield.backends import backend
+    return backend
+
+def afetch(key, rev):
+    return pool.submit(lambda: _backend().fetch(key, rev))
+
+def afetch_many(keys, rev):
+    return pool.submit(lambda: _backend().fetch_many(keys, rev))
+
+def acommit(key, data):
+    return pool.submit(lambda: _backend().commit(key, data))
+
+def aget_revisions(key, limit=None, before=None, after=None):
+    return pool.submit(lambda: _backend().get_revisions(key, limit, before, after))
+
+def adiff(key1, rev1, key2, rev2):
+    # materialize the diff in the worker, it is usually a generator
+    return pool.submit(lambda: list(_backend().diff(key1, rev1, key2, rev2)))
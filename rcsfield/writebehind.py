@@ -0,0 +1,208 @@
+"""
+Write-behind commit queue for django-rcsfield.
+
+Committing to the revision control backend is by far the most expensive
+part of saving a model with versioned fields. With write-behind enabled
+``RcsTextField.post_save`` only puts ``(key, data)`` into a queue and
+returns, a background thread commits the queued changes.
+
+Several pending changes of the same key are coalesced into the last one,
+and all keys waiting in the queue are committed with a single
+``commit_many`` call.
+
+Enable it in your settings::
+
+    RCS_WRITE_BEHIND = True
+    RCS_WRITE_BEHIND_DELAY = 0.5     # seconds to wait for more changes
+    RCS_WRITE_BEHIND_BATCH = 100     # max. number of keys per commit
+    RCS_WRITE_BEHIND_BACKOFF = 1.0   # seconds to wait after a failed commit
+
+A batch whose commit failed is put back into the queue (unless a key was
+changed again meanwhile) and retried, the wait between retries doubles up
+to ``MAX_BACKOFF`` seconds. ``queue.failures`` counts the failed commits.
+
+Use ``flush()`` to wait until everything queued so far has been committed,
+e.g. in tests. It returns ``False`` if a commit failed meanwhile, the
+changes stay queued then. Pending changes are flushed when the interpreter
+exits.
+
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger('rcsfield')
+
+# upper bound of the wait between retries of a failed commit in seconds
+MAX_BACKOFF = 60.0
+
+
+class CommitQueue(object):
+    """
+    Collects changes and commits them from a background thread.
+
+    """
+
+    def __init__(self, delay=None, batch_size=None, backoff=None):
+        if delay is None:
+            delay = getattr(settings, 'RCS_WRITE_BEHIND_DELAY', 0.5)
+        if batch_size is None:
+            batch_size = getattr(settings, 'RCS_WRITE_BEHIND_BATCH', 100)
+        if backoff is None:
+            backoff = getattr(settings, 'RCS_WRITE_BEHIND_BACKOFF', 1.0)
+        self.delay = delay
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.committed = 0 # number of commits made by the worker
+        self.failures = 0 # number of failed commits
+        self._retries = 0 # failed commits in a row
+        self._pending = {} # key -> data, coalesces changes of the same key
+        self._order = [] # keys in the order they were first queued
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def put(self, key, data):
+        """
+        queues ``data`` to be committed to ``key``. replaces any change of
+        ``key`` that is still waiting in the queue.
+
+        """
+        self._cond.acquire()
+        try:
+            if key not in self._pending:
+                self._order.append(key)
+            self._pending[key] = data
+            self._ensure_worker()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def flush(self, timeout=None):
+        """
+        blocks until all queued changes are committed. returns ``False`` if
+        ``timeout`` seconds passed or a commit failed before that.
+
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            failures = self.failures
+            if self._pending:
+                self._ensure_worker()
+            while self._pending or self._busy:
+                if self.failures != failures:
+                    return False
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def pending(self):
+        """
+        returns the number of keys waiting to be committed.
+
+        """
+        return len(self._pending)
+
+    def _ensure_worker(self):
+        # must be called with the lock held. (re)start the worker thread,
+        # e.g. after the process was forked.
+        if self._thread is None or self._pid != os.getpid() or not self._thread.isAlive():
+            self._pid = os.getpid()
+            self._busy = False
+            self._thread = threading.Thread(target=self._run, name='rcsfield-write-behind')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _take(self):
+        # must be called with the lock held.
+        keys = self._order[:self.batch_size]
+        del self._order[:self.batch_size]
+        items = [(key, self._pending.pop(key)) for key in keys]
+        return items
+
+    def _requeue(self, items):
+        # must be called with the lock held. puts a failed batch back in
+        # front of the queue, keys changed since are left alone.
+        keys = []
+        for key, data in items:
+            if key not in self._pending:
+                self._pending[key] = data
+                keys.append(key)
+        self._order[:0] = keys
+
+    def _run(self):
+        from rcsfield.backends import backend
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._pending:
+                    self._cond.wait()
+            finally:
+                self._cond.release()
+
+            if self._retries:
+                time.sleep(min(self.backoff * 2 ** (self._retries - 1), MAX_BACKOFF))
+            elif self.delay:
+                # give further changes the chance to join this commit
+                time.sleep(self.delay)
+
+            self._cond.acquire()
+            try:
+                items = self._take()
+                self._busy = True
+            finally:
+                self._cond.release()
+
+            failed = False
+            try:
+                try:
+                    backend.commit_many(items)
+                except:
+                    failed = True
+                    logger.exception("rcsfield: write-behind commit of %d keys failed, "
+                                     "retrying" % len(items))
+            finally:
+                self._cond.acquire()
+                try:
+                    if failed:
+                        self._requeue(items)
+                        self.failures += 1
+                        self._retries += 1
+                    else:
+                        self.committed += 1
+                        self._retries = 0
+                    self._busy = False
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
+
+
+
+queue = CommitQueue()
+
+def enabled():
+    return getattr(settings, 'RCS_WRITE_BEHIND', False)
+
+def put(key, data):
+    queue.put(key, data)
+
+def flush(timeout=None):
+    return queue.flush(timeout)
+
+atexit.register(flush)
@@ -6,7 +6,8 @@ setup(name='rcsfield',
       author='Arne Brodowski',
       author_email='mail@arnebrodowski.de',
       url='http://code.google.com/p/django-rcsfield/',
-      packages=['rcsfield', 'rcsfield.templatetags', 'rcsfield.backends'],
+      packages=['rcsfield', 'rcsfield.templatetags', 'rcsfield.backends',
+                'rcsfield.management', 'rcsfield.management.commands'],
       package_dir={'rcsfield': 'rcsfield'},
       classifiers=['Development Status :: 4 - Beta',
                    'Environment :: Web Environment',